@@ -3,8 +3,15 @@ from huggingface_hub.file_download import repo_folder_name
 from pathlib import Path
 import shutil
 
+from python_coreml_stable_diffusion.pipeline_resources import (
+    download_pipeline_resources,
+    get_resources_path,
+)
+
 repo_id = "apple/coreml-stable-diffusion-2-base"
 variant = "split_einsum/packages"
+# The checkpoint the Core ML models of `repo_id` were converted from
+model_version = "stabilityai/stable-diffusion-2-base"
 
 def download_model(repo_id, variant, output_dir):
     destination = Path(output_dir) / (repo_id.split("/")[-1] + "_" + variant.replace("/", "_"))
@@ -22,4 +29,8 @@ def download_model(repo_id, variant, output_dir):
     return destination
 
 model_path = download_model(repo_id, variant, output_dir="./models")
-print(f"Model downloaded at {model_path}")
\ No newline at end of file
+print(f"Model downloaded at {model_path}")
+
+# Tokenizer, scheduler and feature extractor, so that the pipeline loads offline
+resources_dir = download_pipeline_resources(model_version, get_resources_path(model_path, model_version))
+print(f"Pipeline resources downloaded at {resources_dir}")
@@ -0,0 +1,91 @@
+from PyQt6.QtGui import QImage
+
+import numpy as np
+from threading import Lock
+
+
+def wrap_ndarray(image):
+    """ Wraps a contiguous HxWx3 uint8 array as a QImage without copying.
+    The caller must keep `image` alive for as long as the QImage is used
+    """
+    return QImage(image.data, image.shape[1], image.shape[0], image.strides[0], QImage.Format.Format_RGB888)
+
+
+def ndarray_to_image(image):
+    # convert numpy array to a QImage that owns its pixels
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    return wrap_ndarray(image).copy()
+
+
+class FramePresenter:
+    """ Hands preview frames from the generation thread over to the GUI thread.
+
+    Frames are copied into a small ring of preallocated buffers which are wrapped
+    as QImages once. Only the latest frame is kept pending: if the GUI thread has
+    not taken the previous frame yet, it is dropped instead of queueing up.
+    """
+
+    def __init__(self, shape=(512, 512, 3), ring_size=3):
+        # One buffer is being drawn, one is pending and one is being written
+        assert ring_size >= 3
+
+        self.ring_size = ring_size
+        self.lock = Lock()
+
+        self.presented_frames = 0
+        self.dropped_frames = 0
+
+        self.drawing = None
+        self.retired = None
+        self.allocate(shape)
+
+    def allocate(self, shape):
+        if self.drawing is not None:
+            # Keep the ring that is being drawn alive until it is released
+            self.retired = (self.buffers, self.images)
+
+        self.shape = tuple(shape)
+        self.buffers = [np.zeros(self.shape, dtype=np.uint8) for _ in range(self.ring_size)]
+        self.images = [wrap_ndarray(buffer) for buffer in self.buffers]
+
+        self.pending = None
+        self.drawing = None
+
+    def submit(self, image):
+        """ Copies `image` into a free buffer and makes it the pending frame.
+        Returns True if the GUI thread has to be notified about a new frame
+        """
+        with self.lock:
+            if image.shape != self.shape:
+                self.allocate(image.shape)
+
+            index = next(i for i in range(self.ring_size) if i not in (self.pending, self.drawing))
+
+        np.copyto(self.buffers[index], image, casting="unsafe")
+
+        with self.lock:
+            notify = self.pending is None
+            if not notify:
+                self.dropped_frames += 1
+
+            self.pending = index
+
+        return notify
+
+    def take(self):
+        """ Returns the latest frame as a QImage, or None if there is nothing new.
+        The frame stays valid until `release` is called
+        """
+        with self.lock:
+            if self.pending is None:
+                return None
+
+            self.drawing, self.pending = self.pending, None
+            self.presented_frames += 1
+
+            return self.images[self.drawing]
+
+    def release(self):
+        with self.lock:
+            self.drawing = None
+            self.retired = None
@@ -1,22 +1,14 @@
-from PyQt6.QtGui import QColor, QImage
-
-import PIL
+from python_coreml_stable_diffusion import latent_preview
+from python_coreml_stable_diffusion.history_writer import HISTORY_WRITERS
+from python_coreml_stable_diffusion.latent_history import LatentHistory
+from python_coreml_stable_diffusion.output_writer import OutputWriter
 
 import numpy as np
 import os
+import tempfile
 from time import sleep
 
 
-def ndarray_to_image(image):
-    # convert numpy array to QPixmap
-    qt_image = QImage(image.shape[1], image.shape[0], QImage.Format.Format_RGB888)
-    for x in range(image.shape[1]):
-        for y in range(image.shape[0]):
-            qt_image.setPixel(x, y, QColor(image[y, x, 0], image[y, x, 1], image[y, x, 2]).rgb())
-    
-    return qt_image
-
-
 class ImageGenerator:
     def __init__(self, model, logger, args={}):
         self.model = model
@@ -26,20 +18,47 @@ class ImageGenerator:
         self.is_generating = False
         self.is_cancelled = False
 
+        # Images and history are encoded and written on a background thread
+        self.png_compress_level = getattr(args, "png_compress_level", 6)
+        self.output_writer = OutputWriter(compress_level=self.png_compress_level)
+
+        self.latent_history = None
         self.reset_history()
 
         self.history_frame_duration = 100
         self.history_looped = True
+        # History is kept as latents and decoded on export, "gif" or lossless "png" (APNG)
+        self.history_format = getattr(args, "history_format", "gif")
+        # If specified, history latents are memory-mapped from a file in this directory
+        self.history_dir = getattr(args, "history_dir", None)
+
+        # "latent" previews steps with a cheap linear projection of the latents,
+        # "decoder" runs the preview decoder on every step
+        self.preview_mode = getattr(args, "preview", "latent")
+        self.latent_rgb_factors = latent_preview.get_latent_rgb_factors(getattr(args, "model_version", None))
+
+        # Previews run on a worker thread and never stall the denoising loop
+        self.async_preview = True
+        # Fraction of the generation time previews may take, None previews every step
+        self.preview_budget = getattr(args, "preview_budget", None)
 
     def reset_history(self):
         self.image = None
+        self.images = []
+        self.latents = None
+
+        if self.latent_history is not None:
+            # Closed after a pending export of the history (if any) is written
+            self.output_writer.submit(self.latent_history.close, "latent history")
+            self.latent_history = None
+
         self.history = {
             "prompt": None,
             "negative_prompt": None,
             "steps": None,
             "guidence": None,
-            "seed": None,
-            "images" : []
+            "seeds": [],
+            "frames": 0
         }
     
     def start_generation(self):
@@ -50,8 +69,13 @@ class ImageGenerator:
         self.is_cancelled = True
     
     def end_generation(self, to_save_image=True, to_save_history=True):
-        if self.history_frame_duration < 1 and self.latents is not None:
-            self.image = (self.model.decode_latents(self.latents)[0] * 255).astype(np.uint8)
+        previews_are_exact = self.preview_mode == "decoder" and self.model.preview_decoder is None
+        if self.latents is not None and not previews_are_exact:
+            # Previews are approximate, the final images are decoded once with the full decoder
+            self.images = list((self.model.decode_latents(self.latents) * 255).astype(np.uint8))
+            self.image = self.images[0]
+        elif self.image is not None:
+            self.images = [self.image]
 
         self.is_generating = False
         self.is_cancelled = False
@@ -59,26 +83,77 @@ class ImageGenerator:
         if to_save_image:
             self.save_image()
 
-        if to_save_history and self.history_frame_duration > 0:
+        if to_save_history and self.history_frame_duration > 0 and self.history["frames"] > 0:
             self.save_history()
 
-    def save_image(self):
-        path = self.generate_image_path() + '.png'
+    def abort_generation(self):
+        self.is_generating = False
+        self.is_cancelled = False
 
-        image = PIL.Image.fromarray(self.image)
-        image.save(path)
+    def append_history(self, latents):
+        if self.latent_history is None:
+            path = None
+            if self.history_dir is not None:
+                os.makedirs(self.history_dir, exist_ok=True)
+                # Unique, the previous history may still be exported in the background
+                fd, path = tempfile.mkstemp(suffix=".npy", prefix="latent_history_", dir=self.history_dir)
+                os.close(fd)
 
-        self.logger.info("image saved to " + str(path))
+            self.latent_history = LatentHistory(
+                latents.shape, capacity=self.history["steps"] + 1, path=path)
+
+        self.latent_history.append(latents)
+        self.history["frames"] += 1
+
+    def history_frame(self, index, sample=0):
+        """ Decodes a single history frame, e.g. for scrubbing through the history
+        """
+        return next(self.latent_history.decode(self.model.decode_latents, [index], sample=sample))
+
+    def save_image(self):
+        for sample, image in enumerate(self.images):
+            path = self.generate_image_path(sample) + '.png'
+
+            self.output_writer.write_image(path, image)
 
     def save_history(self):
-        path = self.generate_image_path() + '.gif'
-    
-        images = [PIL.Image.fromarray(img) for img in self.history['images']]
-        images[0].save(path, save_all=True, append_images=images[1:], duration=self.history_frame_duration)
-    
-        self.logger.info("history saved to " + str(path))
+        for sample in range(len(self.history["seeds"])):
+            self.save_sample_history(sample)
+
+    def save_sample_history(self, sample):
+        writer_class = HISTORY_WRITERS[self.history_format]
+        path = self.generate_image_path(sample) + writer_class.extension
+
+        writer_kwargs = {}
+        if self.history_format == "png":
+            writer_kwargs["compress_level"] = self.png_compress_level
+
+        # Captured now, the generator moves on to the next image while the job is pending
+        latent_history = self.latent_history
+        frame_duration = self.history_frame_duration
+        looped = self.history_looped
+
+        def job():
+            writer = writer_class(path + ".partial", frame_duration, looped, **writer_kwargs)
+            try:
+                # Frames are decoded in batches and streamed into the file
+                for frame in latent_history.decode(self.model.decode_latents, sample=sample):
+                    writer.append(frame)
+            except BaseException:
+                writer.abort()
+                raise
+
+            return writer.close(path)
+
+        self.output_writer.submit(job, path)
+
+    def close(self):
+        """ Waits until all pending outputs are written
+        """
+        self.reset_history()
+        self.output_writer.close()
 
-    def generate_image_path(self):
+    def generate_image_path(self, sample=0):
         prompt = self.history['prompt']
         negative_prompt = self.history['negative_prompt']
 
@@ -101,7 +176,7 @@ class ImageGenerator:
         folder = os.path.join(self.args.o, '_'.join(text))
         os.makedirs(folder, exist_ok=True)
 
-        name = f"{self.history['seed']}_{len(self.history['images'])}_{self.history['guidence']}".replace(".", "_")
+        name = f"{self.history['seeds'][sample]}_{self.history['frames']}_{self.history['guidence']}".replace(".", "_")
         return os.path.join(folder, name)
 
     def create_step_callback(self, external_callback):
@@ -115,12 +190,13 @@ class ImageGenerator:
                 else:
                     image = (np.random.random((512, 512, 3)) * 255).astype(np.uint8)
             else:
-                if self.history_frame_duration < 1:
-                    image = latents[0].astype(np.uint8)
-                    image = image[:3, :, :]
-                    image = image.transpose(1, 2, 0)
+                if self.preview_mode == "decoder":
+                    image = (self.model.decode_preview_latents(latents)[0] * 255).astype(np.uint8)
                 else:
-                    image = (self.model.decode_latents(latents)[0] * 255).astype(np.uint8)                
+                    image = latent_preview.latents_to_rgb(
+                        latents,
+                        self.latent_rgb_factors,
+                        upsample=self.model.height // latents.shape[2])
 
             self.latents = latents
             self.iter = iter
@@ -128,7 +204,8 @@ class ImageGenerator:
 
             external_callback(iter, time_left, image)
 
-            self.history["images"].append(image)
+            if latents is not None:
+                self.append_history(latents)
             self.image = image
 
             if self.is_cancelled:
@@ -139,6 +216,9 @@ class ImageGenerator:
         return callback
 
     def __call__(self, prompt, negative_prompt, steps, guidence, seed, external_callback):
+        """ Generates an image per seed, `seed` is either a seed or a list of seeds.
+        All images are denoised together, ideally at most `model.batch_size` of them
+        """
         if self.is_generating:
             return
         else:
@@ -148,17 +228,25 @@ class ImageGenerator:
         self.history["negative_prompt"] = negative_prompt
         self.history["steps"] = steps
         self.history["guidence"] = guidence
-        self.history["seed"] = seed
-
-        self.model(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            height=self.model.height,
-            width=self.model.width,
-            num_inference_steps=steps,
-            guidance_scale=guidence,
-            seed=seed,
-            callback=self.create_step_callback(external_callback)
-        )
+        self.history["seeds"] = list(seed) if isinstance(seed, (list, tuple)) else [seed]
+
+        try:
+            self.model(
+                prompt=prompt,
+                negative_prompt=negative_prompt,
+                num_images_per_prompt=len(self.history["seeds"]),
+                height=self.model.height,
+                width=self.model.width,
+                num_inference_steps=steps,
+                guidance_scale=guidence,
+                seed=self.history["seeds"],
+                callback=self.create_step_callback(external_callback),
+                callback_steps=1 if self.preview_budget is None else "adaptive",
+                callback_async=self.async_preview,
+                preview_budget=self.preview_budget
+            )
+        except BaseException:
+            self.abort_generation()
+            raise
 
         self.end_generation()
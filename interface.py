@@ -1,4 +1,5 @@
-from image_generator import ImageGenerator, ndarray_to_image
+from image_generator import ImageGenerator
+from frame_presenter import FramePresenter
 
 from PyQt6.QtWidgets import (
     QMainWindow, QApplication, QWidget,
@@ -23,6 +24,8 @@ class MainWindow(QMainWindow):
         self.image_generator = image_generator
         self.logger = image_generator.logger
 
+        self.presenter = FramePresenter()
+
         self.init_ui()
         self.callback = self.create_step_callback()
 
@@ -115,10 +118,16 @@ class MainWindow(QMainWindow):
         self.canvas_sync.connect(self.redraw_canvas)
     
     def redraw_canvas(self):
+        qt_image = self.presenter.take()
+        if qt_image is None:
+            return
+
         painter = QPainter(self.canvas)
-        painter.drawImage(0, 0, self.qt_image)
+        painter.drawImage(0, 0, qt_image)
         painter.end()
 
+        self.presenter.release()
+
         self.image_label.setPixmap(self.canvas)
     
     def set_max_progress(self, max_progress):
@@ -190,18 +199,25 @@ class MainWindow(QMainWindow):
             if image.shape != (512, 512, 3):
                 return
 
-            self.qt_image = ndarray_to_image(image)
-            self.canvas_sync.emit()
+            if self.presenter.submit(image):
+                self.canvas_sync.emit()
 
         return callback
     
     def generate_thread(self, prompt, negative_prompt, steps, guidence, seed, count):
+        seeds = []
         for i in range(count):
             seed += 1024 * i
-            self.logger.info(f"Seed: {seed}")
+            seeds.append(seed)
+
+        # Images are generated in batches as large as the model supports
+        batch_size = self.image_generator.model.batch_size
+        for start in range(0, count, batch_size):
+            batch_seeds = seeds[start:start + batch_size]
+            self.logger.info(f"Seeds: {batch_seeds}")
             self.set_max_progress(steps)
 
-            self.image_generator(prompt, negative_prompt, steps, guidence, seed, self.callback)
+            self.image_generator(prompt, negative_prompt, steps, guidence, batch_seeds, self.callback)
             self.progress_bar.setValue(0)
 
         self.exit_generating_mode()
@@ -218,3 +234,5 @@ class UI:
         
     def exec(self):
         UI.app.exec()
+        # Flush images and history still waiting to be written
+        self.image_generator.close()
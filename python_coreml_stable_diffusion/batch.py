@@ -0,0 +1,464 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import argparse
+from collections import OrderedDict
+import json
+import logging
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+import numpy as np
+import os
+import time
+
+from python_coreml_stable_diffusion import pipeline
+from python_coreml_stable_diffusion.coreml_model import get_available_compute_units
+from python_coreml_stable_diffusion.output_writer import OutputWriter
+from python_coreml_stable_diffusion.staged_pipeline import StagedJob, StagedPipeline
+from python_coreml_stable_diffusion.worker_pool import WorkerPool
+
+MANIFEST_FILENAME = "manifest.jsonl"
+
+# Job keys and the `args` attribute holding their default
+JOB_DEFAULTS = {
+    "negative_prompt": None,
+    "num_inference_steps": "num_inference_steps",
+    "guidance_scale": "guidance_scale",
+    "scheduler": "scheduler",
+}
+
+
+def load_jobs(jobs_path, args):
+    """ Reads the jobs of a JSONL file, one JSON object per line with a "prompt" and
+    optionally "id", "negative_prompt", "seed", "num_inference_steps", "guidance_scale"
+    and "scheduler". Missing options default to the command line arguments and jobs
+    without a seed get `args.seed` plus their line number, so that reruns reproduce them
+    """
+    jobs = []
+    with open(jobs_path) as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+
+            job = json.loads(line)
+            if "prompt" not in job:
+                raise ValueError(f"Job on line {line_number + 1} of {jobs_path} has no prompt")
+
+            job.setdefault("id", f"{line_number:06d}")
+            job["id"] = str(job["id"])
+            job.setdefault("seed", args.seed + line_number)
+            for k, default in JOB_DEFAULTS.items():
+                job.setdefault(k, getattr(args, default) if default is not None else None)
+
+            if job["scheduler"] is not None and job["scheduler"] not in pipeline.SCHEDULER_MAP:
+                raise ValueError(f"Job {job['id']} has an unknown scheduler: {job['scheduler']}")
+
+            jobs.append(job)
+
+    ids = [job["id"] for job in jobs]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"{jobs_path} has duplicate job ids")
+
+    return jobs
+
+
+def load_manifest(manifest_path):
+    """ Returns the results of the jobs completed by previous runs by job id
+    """
+    results = {}
+    if not os.path.exists(manifest_path):
+        return results
+
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line of a run that was interrupted while writing it
+                logger.warning(f"Skipping truncated line in {manifest_path}")
+                continue
+            results[result["id"]] = result
+
+    return results
+
+
+def group_jobs(jobs, batch_size):
+    """ Groups jobs that can be generated in a single pipeline call (same prompts, steps,
+    guidance and scheduler) into batches of up to `batch_size` images. Jobs sharing
+    prompts also share their cached text embeddings
+    """
+    groups = OrderedDict()
+    for job in jobs:
+        key = (job["prompt"], job["negative_prompt"], job["num_inference_steps"],
+               job["guidance_scale"], job["scheduler"])
+        groups.setdefault(key, []).append(job)
+
+    return [
+        group[i:i + batch_size]
+        for group in groups.values()
+        for i in range(0, len(group), batch_size)
+    ]
+
+
+def percentiles(values):
+    return {
+        f"p{q}": float(np.percentile(values, q))
+        for q in (50, 90, 99)
+    }
+
+
+def pending_jobs(jobs, manifest_path):
+    """ Returns the jobs that are not in the manifest of previous runs
+    """
+    completed = load_manifest(manifest_path)
+    pending = [job for job in jobs if job["id"] not in completed]
+    if len(pending) < len(jobs):
+        logger.info(f"Resuming: {len(jobs) - len(pending)} of {len(jobs)} jobs already done")
+    return pending
+
+
+def image_path(out_dir, job):
+    return os.path.join(out_dir, f"{job['id']}.png")
+
+
+def manifest_entry(job, path, nsfw_content_detected, timings):
+    return dict(job, path=path, nsfw_content_detected=nsfw_content_detected, timings=timings)
+
+
+def make_report(num_jobs, num_generated, seconds, stage_timings):
+    """ Returns the throughput and stage latency percentiles of a run given the seconds
+    per call of every stage
+    """
+    report = {
+        "num_jobs": num_jobs,
+        "num_generated": num_generated,
+        "num_skipped": num_jobs - num_generated,
+        "seconds": seconds,
+        "images_per_minute": num_generated / seconds * 60 if seconds > 0 else 0.,
+        "stage_latency": {
+            stage: percentiles(values)
+            for stage, values in stage_timings.items()
+        },
+    }
+
+    logger.info(f"{report['images_per_minute']:.2f} images/min")
+    for stage, latency in report["stage_latency"].items():
+        logger.info(f"{stage}: " + ", ".join(f"{q} {v * 1e3:.0f} ms" for q, v in latency.items()))
+
+    return report
+
+
+class BatchRunner:
+    """ Generates the jobs of a JSONL file with a single pipeline, writing images and a
+    results manifest to `out_dir`. Jobs already in the manifest are skipped, so an
+    interrupted run resumes where it stopped.
+
+    If `staged` is True, batches go through a `StagedPipeline` so that encoding,
+    denoising, decoding and saving of consecutive batches overlap
+    """
+
+    def __init__(self,
+                 coreml_pipe,
+                 out_dir,
+                 scheduler_backend="numpy",
+                 compress_level=6,
+                 staged=False):
+        self.coreml_pipe = coreml_pipe
+        self.staged = staged
+        self.out_dir = out_dir
+        self.manifest_path = os.path.join(out_dir, MANIFEST_FILENAME)
+        self.scheduler_backend = scheduler_backend
+        os.makedirs(out_dir, exist_ok=True)
+
+        # Schedulers by name, None is the scheduler the pipe was loaded with
+        self.schedulers = {None: coreml_pipe.scheduler}
+
+        self.compress_level = compress_level
+        self.output_writer = None
+        # Seconds per pipeline call by stage
+        self.stage_timings = {}
+
+    def _get_scheduler(self, name):
+        if name not in self.schedulers:
+            default_scheduler = self.schedulers[None]
+            self.schedulers[name] = pipeline.get_scheduler(
+                default_scheduler, name, self.scheduler_backend) or default_scheduler
+        return self.schedulers[name]
+
+    def _record(self, stage, seconds):
+        self.stage_timings.setdefault(stage, []).append(seconds)
+
+    def _write_outputs(self, jobs, images, has_nsfw_concept, timings):
+        """ Queues the images of `jobs` and their manifest entries, the entry of a job is
+        only written once its image is saved
+        """
+        for job, image, nsfw in zip(jobs, images, has_nsfw_concept or [None] * len(jobs)):
+            path = image_path(self.out_dir, job)
+            result = manifest_entry(job, path, nsfw, timings)
+
+            def write(image=image, path=path, result=result):
+                start = time.perf_counter()
+                image.save(path, compress_level=self.compress_level)
+                self._record("save", time.perf_counter() - start)
+
+                with open(self.manifest_path, "a") as f:
+                    f.write(json.dumps(result) + "\n")
+                return path
+
+            self.output_writer.submit(write, path)
+
+    def run(self, jobs):
+        pending = pending_jobs(jobs, self.manifest_path)
+        batches = group_jobs(pending, self.coreml_pipe.batch_size)
+        logger.info(f"Generating {len(pending)} images in {len(batches)} pipeline calls")
+
+        start = time.perf_counter()
+        if self.staged:
+            utilization = self._run_staged(batches)
+            report = make_report(len(jobs), len(pending), time.perf_counter() - start,
+                                 self.stage_timings)
+            report["stage_utilization"] = utilization
+            return report
+
+        self.output_writer = OutputWriter(compress_level=self.compress_level)
+        try:
+            for i, batch in enumerate(batches):
+                images, has_nsfw_concept, timings = self.generate(batch)
+                self._write_outputs(batch, images, has_nsfw_concept, timings)
+                logger.info(f"Batch {i + 1}/{len(batches)} done ({', '.join(job['id'] for job in batch)})")
+        finally:
+            self.output_writer.close()
+
+        return make_report(len(jobs), len(pending), time.perf_counter() - start, self.stage_timings)
+
+    def _run_staged(self, batches):
+        """ Generates `batches` on a `StagedPipeline` and returns its stage utilization
+        """
+        def save(staged_job):
+            batch = staged_job.context
+            nsfw_flags = staged_job.has_nsfw_concept or [None] * len(batch)
+            for job, image, nsfw in zip(batch, staged_job.images, nsfw_flags):
+                path = image_path(self.out_dir, job)
+                image.save(path, compress_level=self.compress_level)
+                with open(self.manifest_path, "a") as f:
+                    f.write(json.dumps(manifest_entry(job, path, nsfw, staged_job.stage_timings)) + "\n")
+
+        staged_pipe = StagedPipeline(self.coreml_pipe, save_fn=save)
+        staged_jobs = []
+        try:
+            for batch in batches:
+                first = batch[0]
+                staged_jobs.append(staged_pipe.submit(StagedJob(
+                    prompt=first["prompt"],
+                    negative_prompt=first["negative_prompt"],
+                    num_images_per_prompt=len(batch),
+                    seed=[job["seed"] for job in batch],
+                    num_inference_steps=first["num_inference_steps"],
+                    guidance_scale=first["guidance_scale"],
+                    scheduler=self._get_scheduler(first["scheduler"]),
+                    context=batch,
+                )))
+        finally:
+            staged_pipe.close()
+
+        for staged_job in staged_jobs:
+            for stage, seconds in staged_job.stage_timings.items():
+                self._record(stage, seconds)
+        for staged_job in staged_jobs:
+            # Raised once all other batches are saved
+            staged_job.wait()
+
+        utilization = staged_pipe.utilization()
+        for stage, stats in utilization.items():
+            logger.info(f"{stage}: {stats['utilization']:.0%} busy")
+        return utilization
+
+    def generate(self, batch):
+        """ Generates a batch of `group_jobs` in a single pipeline call and returns the
+        images, their NSFW flags (or None) and the stage timings of the call
+        """
+        first = batch[0]
+        self.coreml_pipe.scheduler = self._get_scheduler(first["scheduler"])
+
+        call_start = time.perf_counter()
+        output = self.coreml_pipe(
+            prompt=first["prompt"],
+            negative_prompt=first["negative_prompt"],
+            height=self.coreml_pipe.height,
+            width=self.coreml_pipe.width,
+            num_inference_steps=first["num_inference_steps"],
+            guidance_scale=first["guidance_scale"],
+            num_images_per_prompt=len(batch),
+            seed=[job["seed"] for job in batch],
+        )
+        self._record("total", time.perf_counter() - call_start)
+
+        timings = dict(self.coreml_pipe.stage_timings)
+        for stage, seconds in timings.items():
+            self._record(stage, seconds)
+
+        return output.images, output.nsfw_content_detected, timings
+
+
+def run_with_workers(jobs, args):
+    """ Like `BatchRunner.run` with `args.num_workers` worker processes, each with its
+    own pipeline
+    """
+    os.makedirs(args.o, exist_ok=True)
+    manifest_path = os.path.join(args.o, MANIFEST_FILENAME)
+    pending = pending_jobs(jobs, manifest_path)
+
+    def on_result(entry):
+        with open(manifest_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    memory_budget = None if args.memory_budget is None else int(args.memory_budget * 2**30)
+    pool = WorkerPool(args, args.num_workers, memory_budget=memory_budget)
+
+    start = time.perf_counter()
+    entries = [entry for entry in pool.run(pending, on_result) if entry is not None]
+    elapsed = time.perf_counter() - start
+
+    # Timings are per pipeline call, which every job of a batch shares
+    stage_timings = {}
+    for entry in entries:
+        for stage, seconds in entry["timings"].items():
+            stage_timings.setdefault(stage, []).append(seconds)
+
+    return make_report(len(jobs), len(entries), elapsed, stage_timings)
+
+
+def main(args):
+    jobs = load_jobs(args.jobs, args)
+
+    if args.num_workers > 1:
+        report = run_with_workers(jobs, args)
+    else:
+        coreml_pipe = pipeline.load_model(args)
+        runner = BatchRunner(coreml_pipe,
+                             args.o,
+                             scheduler_backend=args.scheduler_backend,
+                             compress_level=args.png_compress_level,
+                             staged=args.staged)
+        report = runner.run(jobs)
+
+    report_path = os.path.join(args.o, "report.json")
+    logger.info(f"Saving the run report to {report_path}")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--jobs",
+        required=True,
+        help="Path to a JSONL file with one job per line, e.g. "
+        '{"id": "cat", "prompt": "a photo of a cat", "seed": 93, "num_inference_steps": 25}')
+    parser.add_argument(
+        "-i",
+        default="models/coreml-stable-diffusion-2-base_original_packages",
+        help=("Path to input directory with the .mlpackage files generated by "
+              "python_coreml_stable_diffusion.torch2coreml"))
+    parser.add_argument(
+        "-o",
+        default="output",
+        help="Path to output directory for images, the manifest and the run report")
+    parser.add_argument(
+        "--model-version",
+        default="stabilityai/stable-diffusion-2-base",
+        help="The pre-trained model checkpoint and configuration to restore")
+    parser.add_argument(
+        "--compute-unit",
+        choices=get_available_compute_units(),
+        default="ALL",
+        help="The compute units to be used when executing Core ML models")
+    parser.add_argument(
+        "--seed",
+        default=93,
+        type=int,
+        help="Seeds of jobs without one are this plus their line number")
+    parser.add_argument(
+        "--scheduler",
+        choices=tuple(pipeline.SCHEDULER_MAP.keys()),
+        default=None,
+        help="Scheduler of jobs without one. If not specified, the default scheduler is utilized")
+    parser.add_argument(
+        "--scheduler-backend",
+        choices=("numpy", "torch"),
+        default="numpy")
+    parser.add_argument(
+        "--num-inference-steps",
+        default=50,
+        type=int,
+        help="Steps of jobs without \"num_inference_steps\"")
+    parser.add_argument(
+        "--guidance-scale",
+        default=7.5,
+        type=float,
+        help="Guidance scale of jobs without \"guidance_scale\"")
+    parser.add_argument(
+        "--embedding-cache-size",
+        default=64,
+        type=int,
+        help="Size (MB) of the in-memory cache of prompt embeddings")
+    parser.add_argument(
+        "--embedding-cache-dir",
+        default=None,
+        help="Directory where prompt embeddings are also cached across runs")
+    parser.add_argument(
+        "--load-workers",
+        type=int,
+        default=None,
+        help="Number of Core ML models loaded concurrently. Defaults to loading all of them at once")
+    parser.add_argument(
+        "--lazy-models",
+        nargs="*",
+        choices=pipeline.LAZY_MODEL_NAMES,
+        default=[],
+        help="Models loaded in the background and only waited for when first used")
+    parser.add_argument(
+        "--model-cache-dir",
+        default=None,
+        help="If specified, compiled Core ML models are cached in this directory")
+    parser.add_argument(
+        "--model-cache-size",
+        type=float,
+        default=10,
+        help="Size (GB) of the compiled model cache")
+    parser.add_argument(
+        "--png-compress-level",
+        type=int,
+        choices=range(10),
+        default=6,
+        help="zlib compression level (0-9) of saved PNG images")
+    parser.add_argument(
+        "--staged",
+        default=False,
+        action="store_true",
+        help=("If true, text encoding, denoising, decoding and saving of consecutive batches "
+              "run concurrently on separate threads"))
+    parser.add_argument(
+        "--num-workers",
+        default=1,
+        type=int,
+        help="Number of worker processes, each loading its own pipeline")
+    parser.add_argument(
+        "--memory-budget",
+        default=None,
+        type=float,
+        help=("Memory (GB) the workers may take for their models, fewer workers are started "
+              "if they do not fit. Defaults to 80%% of the physical memory"))
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
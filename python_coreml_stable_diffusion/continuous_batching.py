@@ -0,0 +1,262 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import copy
+import logging
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+import numpy as np
+from queue import Empty, Queue
+from threading import Event, Thread
+
+from python_coreml_stable_diffusion.numpy_schedulers import NumpyScheduler
+from python_coreml_stable_diffusion.pipeline import _predict_in_batches
+
+
+class DenoisingRequest:
+    """ A single image generation interleaved with others by `ContinuousBatcher`.
+
+    `callback(i, t, latents)` is called after every step like the pipeline callback and
+    returning False from it cancels the request. `on_start(request)` is called when the
+    request joins the batch and `on_done(request)` once it left it, finished or not
+    """
+
+    def __init__(self,
+                 prompt,
+                 negative_prompt=None,
+                 seed=None,
+                 num_inference_steps=50,
+                 guidance_scale=7.5,
+                 callback=None,
+                 on_start=None,
+                 on_done=None):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.seed = seed
+        self.num_inference_steps = num_inference_steps
+        self.guidance_scale = guidance_scale
+        self.do_classifier_free_guidance = guidance_scale > 1.0
+
+        self.callback = callback
+        self.on_start = on_start
+        self.on_done = on_done
+
+        # Denoising state, set up when the request joins the batch
+        self.scheduler = None
+        self.text_embeddings = None
+        self.latents = None
+        self.step_index = 0
+
+        self.image = None
+        self.has_nsfw_concept = None
+        self.error = None
+        self.cancelled = False
+        self.done = Event()
+
+    @property
+    def num_samples(self):
+        """ Number of unet batch entries per step
+        """
+        return 2 if self.do_classifier_free_guidance else 1
+
+    @property
+    def finished(self):
+        return self.cancelled or self.step_index == len(self.scheduler.timesteps)
+
+    def result(self, timeout=None):
+        """ Waits for the request and returns its image (None if cancelled)
+        """
+        if not self.done.wait(timeout):
+            raise TimeoutError("Request did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.image
+
+
+class ContinuousBatcher:
+    """ Interleaves the denoising loops of concurrent requests at step granularity.
+
+    Every iteration packs the current latents of up to `max_active` requests into a
+    single batched unet prediction (split into as many calls as the unet batch size
+    needs). Requests can be at different timesteps since the unet takes a timestep per
+    sample, and each has its own text embeddings, guidance scale and copy of the pipe's
+    scheduler. Requests join and leave at step boundaries, so a new request does not wait
+    for the current ones to finish.
+
+    Schedulers keep per-generation state, so only the NumPy schedulers, which are cheap to
+    copy per request, are supported
+    """
+
+    def __init__(self, coreml_pipe, max_active=None):
+        if not isinstance(coreml_pipe.scheduler, NumpyScheduler):
+            raise ValueError(
+                "Continuous batching requires a NumPy scheduler (`--scheduler-backend numpy`)")
+
+        self.coreml_pipe = coreml_pipe
+        self.max_active = max_active or coreml_pipe.batch_size
+
+        # Requests waiting to join, `submit` blocks while `max_active` are waiting
+        self.pending = Queue(maxsize=self.max_active)
+        self.active = []
+        # Number of active requests of every step
+        self.step_occupancy = []
+
+        self.thread = Thread(target=self._run, name="ContinuousBatcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        self.pending.put(request)
+        return request
+
+    def close(self):
+        """ Finishes the submitted requests and stops the thread
+        """
+        self.pending.put(None)
+        self.thread.join()
+
+    def stats(self):
+        return {
+            "steps": len(self.step_occupancy),
+            "mean_active": float(np.mean(self.step_occupancy)) if self.step_occupancy else 0.,
+            "max_active": self.max_active,
+        }
+
+    def _join(self, request):
+        pipe = self.coreml_pipe
+
+        request.text_embeddings = pipe._encode_prompt(
+            request.prompt,
+            1,
+            request.do_classifier_free_guidance,
+            request.negative_prompt,
+        ).astype(np.float16)
+
+        request.scheduler = copy.deepcopy(pipe.scheduler)
+        request.scheduler.set_timesteps(request.num_inference_steps)
+
+        request.latents = pipe.prepare_latents(
+            1,
+            pipe.unet.in_channels,
+            pipe.height,
+            pipe.width,
+            seeds=None if request.seed is None else [request.seed],
+        )
+
+        if request.on_start is not None:
+            request.on_start(request)
+
+    def _step(self):
+        """ Runs one denoising step of every active request in a single batched prediction
+        """
+        timesteps = [request.scheduler.timesteps[request.step_index] for request in self.active]
+
+        samples, sample_timesteps = [], []
+        for request, t in zip(self.active, timesteps):
+            latent_model_input = request.scheduler.scale_model_input(request.latents, t)
+            samples.extend([latent_model_input] * request.num_samples)
+            sample_timesteps.append(np.full(request.num_samples, t))
+
+        noise_pred = _predict_in_batches(
+            self.coreml_pipe.unet,
+            {
+                "sample": np.concatenate(samples).astype(np.float16),
+                "timestep": np.concatenate(sample_timesteps).astype(np.float16),
+                "encoder_hidden_states": np.concatenate(
+                    [request.text_embeddings for request in self.active]),
+            })["noise_pred"]
+        self.step_occupancy.append(len(self.active))
+
+        offset = 0
+        for request, t in zip(self.active, timesteps):
+            request_noise_pred = noise_pred[offset:offset + request.num_samples]
+            offset += request.num_samples
+
+            # perform guidance
+            if request.do_classifier_free_guidance:
+                noise_pred_uncond, noise_pred_text = np.split(request_noise_pred, 2)
+                request_noise_pred = noise_pred_text - noise_pred_uncond
+                request_noise_pred *= request.guidance_scale
+                request_noise_pred += noise_pred_uncond
+
+            request.latents = request.scheduler.step(request_noise_pred, t,
+                                                     request.latents).prev_sample
+
+            if request.callback is not None and \
+                    request.callback(request.step_index, t, request.latents) is False:
+                request.cancelled = True
+            request.step_index += 1
+
+    def _finish(self, requests):
+        """ Decodes the latents of finished requests in a single batch
+        """
+        pipe = self.coreml_pipe
+
+        completed = [request for request in requests if not request.cancelled]
+        if len(completed) > 0:
+            try:
+                images = pipe.decode_latents(
+                    np.concatenate([request.latents for request in completed]))
+                images, has_nsfw_concept = pipe.run_safety_checker(images)
+                images = pipe.numpy_to_pil(images)
+
+                for i, request in enumerate(completed):
+                    request.image = images[i]
+                    request.has_nsfw_concept = None if has_nsfw_concept is None else has_nsfw_concept[i]
+            except Exception as e:
+                logger.exception("Failed to decode finished requests")
+                for request in completed:
+                    request.error = e
+
+        for request in requests:
+            self._done(request)
+
+    def _done(self, request):
+        request.done.set()
+        if request.on_done is not None:
+            request.on_done(request)
+
+    def _run(self):
+        closing = False
+        while not closing or len(self.active) > 0:
+            # Admit pending requests, blocking only while there is nothing to run
+            while not closing and len(self.active) < self.max_active:
+                try:
+                    request = self.pending.get(block=len(self.active) == 0)
+                except Empty:
+                    break
+
+                if request is None:
+                    closing = True
+                    break
+
+                try:
+                    self._join(request)
+                except Exception as e:
+                    logger.exception("Failed to start request")
+                    request.error = e
+                    self._done(request)
+                    continue
+                self.active.append(request)
+
+            if len(self.active) == 0:
+                continue
+
+            try:
+                self._step()
+            except Exception as e:
+                logger.exception("Failed to run a batched denoising step")
+                for request in self.active:
+                    request.error = e
+                    self._done(request)
+                self.active = []
+                continue
+
+            finished = [request for request in self.active if request.finished]
+            self.active = [request for request in self.active if not request.finished]
+            if len(finished) > 0:
+                self._finish(finished)
@@ -3,6 +3,7 @@
 # Copyright (C) 2022 Apple Inc. All Rights Reserved.
 #
 
+from concurrent.futures import ThreadPoolExecutor
 import coremltools as ct
 
 import logging
@@ -14,44 +15,95 @@ logger.setLevel(logging.INFO)
 import numpy as np
 
 import os
+import shutil
 import time
 
 
+# Core ML multi-array data types
+DTYPE_MAP = {
+    65552: np.float16,
+    65568: np.float32,
+    131104: np.int32,
+}
+
+
+def describe_spec(spec):
+    """ Returns the input and output names, shapes and dtype names of a model spec
+    """
+    def describe(features):
+        return {
+            feature.name: {
+                "shape": list(feature.type.multiArrayType.shape),
+                "dtype": np.dtype(DTYPE_MAP[feature.type.multiArrayType.dataType]).name,
+            } if feature.type.WhichOneof("Type") == "multiArrayType" else {}
+            for feature in features
+        }
+
+    return {
+        "inputs": describe(spec.description.input),
+        "outputs": describe(spec.description.output),
+    }
+
+
+def compile_mlpackage(mlpackage_path, compiled_path):
+    """ Compiles `mlpackage_path` into the .mlmodelc directory `compiled_path` and returns
+    its `describe_spec`
+    """
+    compiled = ct.models.utils.compile_model(mlpackage_path)
+    shutil.move(compiled, compiled_path)
+    return describe_spec(ct.models.utils.load_spec(mlpackage_path))
+
+
 class CoreMLModel:
-    """ Wrapper for running CoreML models using coremltools
+    """ Wrapper for running CoreML models using coremltools.
+
+    With a `model_cache` (see `model_cache.ModelCache`), the model is compiled once and
+    later loads use the cached compiled model and input specs
     """
 
-    def __init__(self, model_path, compute_unit):
+    def __init__(self, model_path, compute_unit, model_cache=None):
         assert os.path.exists(model_path) and model_path.endswith(".mlpackage")
 
         logger.info(f"Loading {model_path}")
 
         start = time.time()
-        self.model = ct.models.MLModel(
-            model_path, compute_units=ct.ComputeUnit[compute_unit])
+        if model_cache is not None:
+            compiled_path, manifest = model_cache.get(model_path, compute_unit)
+            self.model = ct.models.CompiledMLModel(
+                compiled_path, compute_units=ct.ComputeUnit[compute_unit])
+        else:
+            self.model = ct.models.MLModel(
+                model_path, compute_units=ct.ComputeUnit[compute_unit])
         load_time = time.time() - start
         logger.info(f"Done. Took {load_time:.1f} seconds.")
+        self.load_time = load_time
 
-        if load_time > LOAD_TIME_INFO_MSG_TRIGGER:
+        if load_time > LOAD_TIME_INFO_MSG_TRIGGER and model_cache is None:
             logger.info(
                 "Loading a CoreML model through coremltools triggers compilation every time. "
-                "The Swift package we provide uses precompiled Core ML models (.mlmodelc) to avoid compile-on-load."
+                "Specify a model cache directory (`--model-cache-dir`) to compile once and reuse the "
+                "compiled model (.mlmodelc) on later loads."
             )
 
-
-        DTYPE_MAP = {
-            65552: np.float16,
-            65568: np.float32,
-            131104: np.int32,
-        }
-
-        self.expected_inputs = {
-            input_tensor.name: {
-                "shape": tuple(input_tensor.type.multiArrayType.shape),
-                "dtype": DTYPE_MAP[input_tensor.type.multiArrayType.dataType],
+        if model_cache is not None:
+            self.expected_inputs = {
+                name: {
+                    "shape": tuple(spec["shape"]),
+                    "dtype": np.dtype(spec["dtype"]).type,
+                }
+                for name, spec in manifest["inputs"].items()
             }
-            for input_tensor in self.model._spec.description.input
-        }
+        else:
+            self.expected_inputs = {
+                input_tensor.name: {
+                    "shape": tuple(input_tensor.type.multiArrayType.shape),
+                    "dtype": DTYPE_MAP[input_tensor.type.multiArrayType.dataType],
+                }
+                for input_tensor in self.model._spec.description.input
+            }
+
+        # Input shape signatures that passed `_verify_inputs`
+        self.verified_signatures = set()
 
     def _verify_inputs(self, **kwargs):
         for k, v in kwargs.items():
@@ -72,31 +124,119 @@ class CoreMLModel:
                         f"Expected shape {expected_shape}, got {v.shape} for input: {k}"
                     )
             else:
-                raise ValueError("Received unexpected input kwarg: {k}")
+                raise ValueError(f"Received unexpected input kwarg: {k}")
 
     def __call__(self, **kwargs):
-        self._verify_inputs(**kwargs)
+        # Inputs are verified once per shape signature instead of on every call
+        signature = tuple((k, type(v), getattr(v, "shape", None), getattr(v, "dtype", None))
+                          for k, v in kwargs.items())
+        if signature not in self.verified_signatures:
+            self._verify_inputs(**kwargs)
+            self.verified_signatures.add(signature)
+
         return self.model.predict(kwargs)
 
 
+class LazyCoreMLModel:
+    """ Stands in for a `CoreMLModel` that is still loading in the background (`future`).
+    Calls and attribute accesses block until it is loaded
+    """
+
+    def __init__(self, name, future):
+        self.name = name
+        self.future = future
+
+    @property
+    def loaded(self):
+        return self.future.done()
+
+    def get(self):
+        if not self.future.done():
+            logger.info(f"Waiting for {self.name} to finish loading")
+        return self.future.result()
+
+    def __call__(self, **kwargs):
+        return self.get()(**kwargs)
+
+    def __getattr__(self, name):
+        # Only called for attributes not set in `__init__`
+        if name in ("name", "future"):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+
 LOAD_TIME_INFO_MSG_TRIGGER = 10  # seconds
 
 
+def _get_mlpackage_path(submodule_name, mlpackages_dir, model_version):
+    fname = f"Stable_Diffusion_version_{model_version}_{submodule_name}.mlpackage".replace(
+        "/", "_")
+    return os.path.join(mlpackages_dir, fname)
+
+
 def _load_mlpackage(submodule_name, mlpackages_dir, model_version,
-                    compute_unit):
+                    compute_unit, model_cache=None):
     """ Load Core ML (mlpackage) models from disk (As exported by torch2coreml.py)
     """
     logger.info(f"Loading {submodule_name} mlpackage")
 
-    fname = f"Stable_Diffusion_version_{model_version}_{submodule_name}.mlpackage".replace(
-        "/", "_")
-    mlpackage_path = os.path.join(mlpackages_dir, fname)
+    mlpackage_path = _get_mlpackage_path(submodule_name, mlpackages_dir,
+                                         model_version)
 
     if not os.path.exists(mlpackage_path):
         raise FileNotFoundError(
             f"{submodule_name} CoreML model doesn't exist at {mlpackage_path}")
 
-    return CoreMLModel(mlpackage_path, compute_unit)
+    return CoreMLModel(mlpackage_path, compute_unit, model_cache=model_cache)
+
+
+def _load_mlpackages(submodule_names,
+                     mlpackages_dir,
+                     model_version,
+                     compute_unit,
+                     max_workers=None,
+                     lazy_submodule_names=(),
+                     load_timings=None,
+                     model_cache=None):
+    """ Loads the Core ML models `submodule_names` concurrently (on `max_workers` threads,
+    one per model by default) and returns them by name.
+
+    The models in `lazy_submodule_names` are only started once a thread is free and are
+    returned as `LazyCoreMLModel`s right away, so rarely used models such as the safety
+    checker finish loading while the first image is generated. The seconds every model
+    took to load are added to `load_timings` as they finish
+    """
+    if load_timings is None:
+        load_timings = {}
+
+    eager_names = [name for name in submodule_names if name not in lazy_submodule_names]
+    lazy_names = [name for name in submodule_names if name in lazy_submodule_names]
+    max_workers = max_workers or max(len(eager_names), 1)
+
+    def load(name):
+        model = _load_mlpackage(name, mlpackages_dir, model_version, compute_unit,
+                                model_cache=model_cache)
+        load_timings[name] = model.load_time
+        return model
+
+    start = time.time()
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="CoreMLModelLoader")
+    futures = {name: executor.submit(load, name) for name in eager_names + lazy_names}
+    # Lazy models keep loading after this returns
+    executor.shutdown(wait=False)
+
+    models = {name: futures[name].result() for name in eager_names}
+    logger.info(f"Loaded {len(eager_names)} models in {time.time() - start:.1f} seconds on "
+                f"{max_workers} threads")
+    for name in eager_names:
+        logger.info(f"{name}: {load_timings[name]:.1f} seconds")
+
+    for name in lazy_names:
+        logger.info(f"{name} is loading in the background")
+        models[name] = LazyCoreMLModel(name, futures[name])
+
+    return models
+
 
 def get_available_compute_units():
     return tuple(cu for cu in ct.ComputeUnit._member_names_)
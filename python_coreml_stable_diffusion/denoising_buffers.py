@@ -0,0 +1,79 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import numpy as np
+
+
+class DenoisingBuffers:
+    """ Preallocated unet inputs and outputs for the denoising loop of one generation.
+
+    The inputs are allocated once with the dtypes and the (zero padded) batch size
+    `unet.expected_inputs` requires, so every step only fills them in place instead of
+    concatenating, casting and padding new arrays. The text embeddings never change
+    during a generation and are cast once.
+
+    The returned noise predictions are overwritten by the next step, so they must not be
+    kept around (the NumPy schedulers copy what they keep)
+    """
+
+    def __init__(self, unet, text_embeddings, latents_shape, do_classifier_free_guidance):
+        self.unet = unet
+        self.do_classifier_free_guidance = do_classifier_free_guidance
+        self.num_latents = latents_shape[0]
+        self.num_samples = self.num_latents * (2 if do_classifier_free_guidance else 1)
+
+        if len(text_embeddings) != self.num_samples:
+            raise ValueError(
+                f"Expected text embeddings for {self.num_samples} samples, got {len(text_embeddings)}")
+
+        self.model_batch_size = unet.expected_inputs["sample"]["shape"][0]
+        num_padded = -(-self.num_samples // self.model_batch_size) * self.model_batch_size
+
+        def zeros(name, shape):
+            return np.zeros((num_padded, ) + tuple(shape), dtype=unet.expected_inputs[name]["dtype"])
+
+        self.sample = zeros("sample", latents_shape[1:])
+        self.timestep = zeros("timestep", ())
+        self.encoder_hidden_states = zeros("encoder_hidden_states", text_embeddings.shape[1:])
+        self.encoder_hidden_states[:self.num_samples] = text_embeddings
+
+        self.noise_pred = np.empty((self.num_samples, ) + tuple(latents_shape[1:]), dtype=np.float32)
+        self.guided_noise_pred = np.empty(latents_shape, dtype=np.float32) \
+            if do_classifier_free_guidance else None
+
+    def predict_noise(self, latent_model_input, t):
+        """ Runs the unet on `latent_model_input` (duplicated for classifier free guidance)
+        in as many calls as the batch needs and returns the noise prediction
+        """
+        n = self.num_latents
+        self.sample[:n] = latent_model_input
+        if self.do_classifier_free_guidance:
+            self.sample[n:2 * n] = latent_model_input
+        self.timestep[:] = t
+
+        for start in range(0, self.num_samples, self.model_batch_size):
+            end = min(start + self.model_batch_size, self.num_samples)
+            batch = slice(start, start + self.model_batch_size)
+            noise_pred = self.unet(
+                sample=self.sample[batch],
+                timestep=self.timestep[batch],
+                encoder_hidden_states=self.encoder_hidden_states[batch],
+            )["noise_pred"]
+            self.noise_pred[start:end] = noise_pred[:end - start]
+
+        return self.noise_pred
+
+    def guide(self, guidance_scale):
+        """ Combines the unconditional and text conditioned halves of the last noise
+        prediction with classifier free guidance
+        """
+        noise_pred_uncond = self.noise_pred[:self.num_latents]
+        noise_pred_text = self.noise_pred[self.num_latents:]
+
+        guided = self.guided_noise_pred
+        np.subtract(noise_pred_text, noise_pred_uncond, out=guided)
+        guided *= guidance_scale
+        guided += noise_pred_uncond
+        return guided
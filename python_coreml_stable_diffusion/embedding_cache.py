@@ -0,0 +1,120 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import logging
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+from collections import OrderedDict
+import hashlib
+import numpy as np
+import os
+from threading import Lock
+
+
+class EmbeddingCache:
+    """ Caches text encoder outputs keyed by model version and token ids.
+
+    Entries are kept in memory in least recently used order up to `max_bytes`. If
+    `cache_dir` is specified, every entry is also saved there as a .npy file, which is
+    memory-mapped on a memory miss, so embeddings persist across restarts
+    """
+
+    def __init__(self, max_bytes=64 * 2**20, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model_version, input_ids):
+        """ Returns the cache key of a single row of token ids
+        """
+        digest = hashlib.sha256(str(model_version).encode("utf-8"))
+        digest.update(np.ascontiguousarray(input_ids, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def _insert(self, key, embeddings):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+
+        if embeddings.nbytes > self.max_bytes:
+            return
+
+        self.entries[key] = embeddings
+        self.nbytes += embeddings.nbytes
+
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def get(self, key):
+        """ Returns the cached embeddings or None
+        """
+        with self.lock:
+            embeddings = self.entries.get(key)
+            if embeddings is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return embeddings
+
+            if self.cache_dir is not None and os.path.exists(self._disk_path(key)):
+                embeddings = np.array(np.load(self._disk_path(key), mmap_mode="r"))
+                embeddings.setflags(write=False)
+                self._insert(key, embeddings)
+                self.hits += 1
+                self.disk_hits += 1
+                return embeddings
+
+            self.misses += 1
+            return None
+
+    def put(self, key, embeddings):
+        # Cached arrays are shared by all callers
+        embeddings = np.array(embeddings)
+        embeddings.setflags(write=False)
+
+        with self.lock:
+            self._insert(key, embeddings)
+
+        if self.cache_dir is not None:
+            # Written to a temporary file first so that readers never see partial files
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, embeddings)
+            os.replace(tmp_path, path)
+
+    def clear(self):
+        """ Empties the in-memory tier, the disk tier is kept
+        """
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "bytes": self.nbytes,
+        }
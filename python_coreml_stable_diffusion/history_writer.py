@@ -0,0 +1,163 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import numpy as np
+import os
+from PIL import GifImagePlugin, Image
+import struct
+import zlib
+
+
+class HistoryWriter:
+    """ Appends generation history frames to an animation file as they arrive, so that
+    no frames are kept in memory. The file is written to `path` and moved to its final
+    location by `close`
+    """
+
+    extension = None
+
+    def __init__(self, path, duration, loop=True):
+        self.path = path
+        self.duration = duration
+        self.loop = loop
+        self.num_frames = 0
+
+        self.file = open(path, "wb")
+
+    def append(self, frame):
+        """ Appends an HxWx3 uint8 frame
+        """
+        raise NotImplementedError
+
+    def _finalize(self):
+        raise NotImplementedError
+
+    def close(self, final_path=None):
+        """ Completes the animation and moves it to `final_path` (if specified).
+        An animation without frames is removed. Returns the path of the file or None
+        """
+        if self.file.closed:
+            return None
+
+        if self.num_frames == 0:
+            self.abort()
+            return None
+
+        self._finalize()
+        self.file.close()
+
+        if final_path is not None:
+            os.replace(self.path, final_path)
+            self.path = final_path
+
+        return self.path
+
+    def abort(self):
+        """ Closes and removes the incomplete animation
+        """
+        if not self.file.closed:
+            self.file.close()
+            os.remove(self.path)
+
+
+class GIFHistoryWriter(HistoryWriter):
+    """ Streams frames into a GIF, each frame is quantized with its own color table
+    """
+
+    extension = ".gif"
+
+    def append(self, frame):
+        image = Image.fromarray(frame).quantize(256)
+
+        if self.num_frames == 0:
+            info = {"duration": self.duration}
+            if self.loop:
+                info["loop"] = 0
+
+            header, _ = GifImagePlugin.getheader(image, info=info)
+            self.file.writelines(header)
+
+        self.file.writelines(
+            GifImagePlugin.getdata(image,
+                                   duration=self.duration,
+                                   include_color_table=True))
+        self.num_frames += 1
+
+    def _finalize(self):
+        self.file.write(b";")  # GIF trailer
+
+
+class APNGHistoryWriter(HistoryWriter):
+    """ Streams frames into a lossless animated PNG (APNG).
+
+    The frame count in the `acTL` chunk is unknown while streaming and is patched in
+    when the animation is closed
+    """
+
+    extension = ".apng"
+
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+    def __init__(self, path, duration, loop=True, compress_level=6):
+        super().__init__(path, duration, loop)
+        self.compress_level = compress_level
+        self.sequence_number = 0
+        self.shape = None
+
+    def _write_chunk(self, chunk_type, data):
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(chunk_type + data)
+        self.file.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+    def _actl_data(self):
+        num_plays = 0 if self.loop else 1
+        return struct.pack(">II", self.num_frames, num_plays)
+
+    def append(self, frame):
+        height, width, _ = frame.shape
+
+        if self.num_frames == 0:
+            self.shape = frame.shape
+            self.file.write(self.SIGNATURE)
+            self._write_chunk(
+                b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            self.actl_offset = self.file.tell()
+            self._write_chunk(b"acTL", self._actl_data())
+        elif frame.shape != self.shape:
+            raise ValueError(
+                f"All frames must have the same shape, expected {self.shape}, got {frame.shape}")
+
+        # Delay as a fraction of a second: duration / 1000
+        self._write_chunk(
+            b"fcTL",
+            struct.pack(">IIIIIHHBB", self.sequence_number, width, height, 0,
+                        0, self.duration, 1000, 0, 0))
+        self.sequence_number += 1
+
+        # Every scanline is prefixed with filter type 0 (None)
+        scanlines = np.zeros((height, 1 + width * 3), dtype=np.uint8)
+        scanlines[:, 1:] = frame.reshape(height, -1)
+        data = zlib.compress(scanlines.tobytes(), self.compress_level)
+
+        if self.num_frames == 0:
+            self._write_chunk(b"IDAT", data)
+        else:
+            self._write_chunk(
+                b"fdAT", struct.pack(">I", self.sequence_number) + data)
+            self.sequence_number += 1
+
+        self.num_frames += 1
+
+    def _finalize(self):
+        self._write_chunk(b"IEND", b"")
+
+        self.file.seek(self.actl_offset)
+        self._write_chunk(b"acTL", self._actl_data())
+
+
+HISTORY_WRITERS = {
+    "gif": GIFHistoryWriter,
+    "png": APNGHistoryWriter,
+}
@@ -0,0 +1,90 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import numpy as np
+import os
+
+
+class LatentHistory:
+    """ Generation history kept as a stack of latents instead of decoded images.
+
+    A 4x64x64 float16 latent takes 32 KB while the decoded 512x512x3 image takes 768 KB.
+    The stack is preallocated in memory or, if `path` is specified, backed by a
+    memory-mapped file. Frames are only decoded on demand, in batches
+    """
+
+    def __init__(self, shape, capacity=64, dtype=np.float16, path=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        self.num_frames = 0
+
+        self.latents = self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        shape = (capacity, ) + self.shape
+        if self.path is None:
+            return np.empty(shape, dtype=self.dtype)
+        return np.lib.format.open_memmap(self.path, mode="w+", dtype=self.dtype, shape=shape)
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, index):
+        return self.latents[:self.num_frames][index]
+
+    @property
+    def nbytes(self):
+        return self.latents.nbytes
+
+    def append(self, latents):
+        """ Appends the latents of a single step
+        """
+        latents = latents.reshape(self.shape)
+
+        if self.num_frames == len(self.latents):
+            # Grow geometrically so that appends stay amortized O(1)
+            previous = self.latents[:self.num_frames]
+            if self.path is not None:
+                previous = np.array(previous)
+                self.latents.flush()
+                del self.latents
+
+            self.latents = self._allocate(2 * max(self.num_frames, 1))
+            self.latents[:self.num_frames] = previous
+
+        self.latents[self.num_frames] = latents
+        self.num_frames += 1
+
+    def clear(self):
+        self.num_frames = 0
+
+    def close(self):
+        """ Releases the stack, the memory-mapped file (if any) is removed
+        """
+        self.num_frames = 0
+        self.latents = None
+
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def decode(self, decode_fn, indices=None, batch_size=8, sample=None):
+        """ Yields decoded HxWx3 uint8 frames.
+
+        `decode_fn` maps a NxCxHxW batch of latents to NxHxWx3 images in range [0, 1],
+        e.g. `CoreMLStableDiffusionPipeline.decode_latents`. At most `batch_size` frames
+        are decoded (and held in memory) at once. If the history holds batched latents
+        (BxCxHxW per step), `sample` selects the sample to decode
+        """
+        if indices is None:
+            indices = range(self.num_frames)
+        indices = list(indices)
+
+        for start in range(0, len(indices), batch_size):
+            batch = self.latents[indices[start:start + batch_size]]
+            if sample is not None:
+                batch = batch[:, sample]
+            images = decode_fn(batch.astype(np.float32))
+            yield from (np.clip(images * 255, 0, 255)).astype(np.uint8)
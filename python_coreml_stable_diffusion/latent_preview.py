@@ -0,0 +1,47 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import numpy as np
+
+# Linear projections from the 4 latent channels to RGB in range [-1, 1].
+# Fitted on latents of the Stable Diffusion VAE (shared by v1.x and v2.x)
+SD_LATENT_RGB_FACTORS = np.array([
+    #    R       G       B
+    [ 0.3512,  0.2297,  0.3227],
+    [ 0.3250,  0.4974,  0.2350],
+    [-0.2829,  0.1762,  0.2721],
+    [-0.2120, -0.2616, -0.7177],
+], dtype=np.float32)
+
+LATENT_RGB_FACTORS = {
+    "CompVis/stable-diffusion-v1-4": SD_LATENT_RGB_FACTORS,
+    "runwayml/stable-diffusion-v1-5": SD_LATENT_RGB_FACTORS,
+    "stabilityai/stable-diffusion-2-base": SD_LATENT_RGB_FACTORS,
+    "stabilityai/stable-diffusion-2": SD_LATENT_RGB_FACTORS,
+}
+
+
+def get_latent_rgb_factors(model_version):
+    """ Returns the latent-to-RGB projection for `model_version`, defaulting to the Stable Diffusion VAE one
+    """
+    return LATENT_RGB_FACTORS.get(model_version, SD_LATENT_RGB_FACTORS)
+
+
+def latents_to_rgb(latents, factors=SD_LATENT_RGB_FACTORS, upsample=1):
+    """ Approximates the decoded image of the first sample in `latents` (BCHW or CHW)
+    with a per-pixel linear projection. Returns an HxWx3 uint8 array, optionally
+    upsampled by an integer factor with nearest neighbour interpolation
+    """
+    if latents.ndim == 4:
+        latents = latents[0]
+
+    rgb = np.einsum("chw,cr->hwr", latents.astype(np.float32), factors)
+    image = ((rgb + 1) * 127.5).clip(0, 255).astype(np.uint8)
+
+    if upsample > 1:
+        # Repeating columns first keeps both copies contiguous
+        image = image.repeat(upsample, axis=1).repeat(upsample, axis=0)
+
+    return image
@@ -0,0 +1,201 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import logging
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+import hashlib
+import json
+import os
+import shutil
+from threading import Lock
+import time
+import uuid
+
+MANIFEST_FILENAME = "manifest.json"
+COMPILED_MODEL_DIRNAME = "model.mlmodelc"
+HASHES_FILENAME = "hashes.json"
+
+
+def _directory_files(path):
+    if os.path.isfile(path):
+        return [path]
+    return sorted(
+        os.path.join(root, f)
+        for root, _, files in os.walk(path)
+        for f in files
+    )
+
+
+def _directory_size(path):
+    return sum(os.path.getsize(f) for f in _directory_files(path))
+
+
+class ModelCache:
+    """ Caches compiled Core ML models on disk, keyed by a content hash of the source
+    .mlpackage and the compute unit.
+
+    Every entry is a directory holding the compiled model and a manifest with the input
+    and output specs of the model, so cached loads neither compile nor parse the model
+    spec. Entries are evicted in least recently used order once they take more than
+    `max_bytes` of disk.
+
+    `compile_fn(mlpackage_path, compiled_path)` compiles a model to `compiled_path` and
+    returns its specs (`coreml_model.compile_mlpackage` by default)
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 2**30, compile_fn=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if compile_fn is None:
+            from python_coreml_stable_diffusion.coreml_model import compile_mlpackage as compile_fn
+        self.compile_fn = compile_fn
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Hashing an mlpackage reads all of its weights, so digests are kept by file
+        # sizes and modification times
+        self.hashes_path = os.path.join(cache_dir, HASHES_FILENAME)
+        self.hashes = {}
+        if os.path.exists(self.hashes_path):
+            try:
+                with open(self.hashes_path) as f:
+                    self.hashes = json.load(f)
+            except ValueError:
+                logger.warning(f"Ignoring corrupted {self.hashes_path}")
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def content_hash(self, mlpackage_path):
+        """ Returns the sha256 digest of the files of `mlpackage_path`
+        """
+        files = _directory_files(mlpackage_path)
+        fingerprint = [[os.path.relpath(f, mlpackage_path), os.stat(f).st_size, os.stat(f).st_mtime_ns]
+                       for f in files]
+        abs_path = os.path.abspath(mlpackage_path)
+
+        with self.lock:
+            memo = self.hashes.get(abs_path)
+            if memo is not None and memo["fingerprint"] == fingerprint:
+                return memo["digest"]
+
+        digest = hashlib.sha256()
+        for f in files:
+            digest.update(os.path.relpath(f, mlpackage_path).encode("utf-8"))
+            with open(f, "rb") as fh:
+                for chunk in iter(lambda: fh.read(2**20), b""):
+                    digest.update(chunk)
+        digest = digest.hexdigest()
+
+        with self.lock:
+            self.hashes[abs_path] = {"fingerprint": fingerprint, "digest": digest}
+            tmp_path = f"{self.hashes_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.hashes, f)
+            os.replace(tmp_path, self.hashes_path)
+
+        return digest
+
+    def key(self, mlpackage_path, compute_unit):
+        return hashlib.sha256(
+            f"{self.content_hash(mlpackage_path)}:{compute_unit}".encode("utf-8")).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, mlpackage_path, compute_unit):
+        """ Returns the path of the compiled model of `mlpackage_path` for `compute_unit`
+        and its manifest, compiling it first if it is not cached
+        """
+        key = self.key(mlpackage_path, compute_unit)
+        entry_dir = self._entry_dir(key)
+        manifest_path = os.path.join(entry_dir, MANIFEST_FILENAME)
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            # The manifest's modification time orders entries for eviction
+            os.utime(manifest_path)
+            self.hits += 1
+            logger.info(f"Loading compiled {mlpackage_path} from {entry_dir}")
+            return os.path.join(entry_dir, COMPILED_MODEL_DIRNAME), manifest
+
+        self.misses += 1
+        logger.info(f"Compiling {mlpackage_path} into {entry_dir}")
+        start = time.time()
+
+        # Compiled into a temporary directory first so that concurrent loads (e.g. from
+        # several worker processes) never see partial entries
+        tmp_dir = os.path.join(self.cache_dir, f"{key}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+        os.makedirs(tmp_dir)
+        try:
+            specs = self.compile_fn(mlpackage_path, os.path.join(tmp_dir, COMPILED_MODEL_DIRNAME))
+            manifest = dict(
+                specs,
+                source=os.path.abspath(mlpackage_path),
+                compute_unit=compute_unit,
+                compile_seconds=time.time() - start,
+                size=_directory_size(tmp_dir),
+            )
+            with open(os.path.join(tmp_dir, MANIFEST_FILENAME), "w") as f:
+                json.dump(manifest, f, indent=2)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                if not os.path.exists(manifest_path):
+                    raise
+                # Another process cached the same model first
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+        logger.info(f"Done. Took {manifest['compile_seconds']:.1f} seconds.")
+        self.evict(keep=key)
+        return os.path.join(entry_dir, COMPILED_MODEL_DIRNAME), manifest
+
+    def entries(self):
+        """ Returns (last used time, size, key) of every entry, least recently used first
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            if key.endswith(".tmp"):
+                continue
+            manifest_path = os.path.join(self._entry_dir(key), MANIFEST_FILENAME)
+            try:
+                with open(manifest_path) as f:
+                    size = json.load(f)["size"]
+                entries.append((os.path.getmtime(manifest_path), size, key))
+            except (OSError, ValueError, KeyError):
+                # Not an entry (or one that is being evicted)
+                continue
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """ Removes least recently used entries (except `keep`) until all entries fit in
+        `max_bytes`
+        """
+        entries = self.entries()
+        nbytes = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if nbytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            logger.info(f"Evicting {key} ({size / 2**20:.1f} MB) from the model cache")
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            nbytes -= size
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+        }
@@ -0,0 +1,746 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+""" NumPy implementations of the diffusers schedulers supported by the pipeline.
+
+The diffusers schedulers operate on torch tensors, so every denoising step of the
+Core ML pipeline used to convert its numpy arrays to torch and back. The schedulers
+below follow the diffusers (v0.11) update rules but operate on numpy arrays directly
+and precompute all per-step coefficients in `set_timesteps`, so that `step` only does
+the elementwise math.
+
+They are constructed from the config of the corresponding diffusers scheduler with
+`from_config`.
+"""
+
+from collections import namedtuple
+import inspect
+import math
+import numpy as np
+
+NumpySchedulerOutput = namedtuple("NumpySchedulerOutput", ["prev_sample", "pred_original_sample"])
+
+
+def betas_for_alpha_bar(num_diffusion_timesteps, max_beta=0.999):
+    """ Betas of the "squaredcos_cap_v2" schedule
+    """
+
+    def alpha_bar(time_step):
+        return math.cos((time_step + 0.008) / 1.008 * math.pi / 2)**2
+
+    betas = []
+    for i in range(num_diffusion_timesteps):
+        t1 = i / num_diffusion_timesteps
+        t2 = (i + 1) / num_diffusion_timesteps
+        betas.append(min(1 - alpha_bar(t2) / alpha_bar(t1), max_beta))
+    return np.array(betas, dtype=np.float64)
+
+
+def _randn(generator, shape):
+    """ Standard normal noise from `generator` (`np.random.RandomState`, `np.random.Generator`)
+    or from the global numpy random state
+    """
+    if generator is None:
+        generator = np.random
+    return generator.standard_normal(shape).astype(np.float32)
+
+
+class NumpyScheduler:
+    """ Base class of the NumPy schedulers, holds the config and the noise schedule.
+
+    `step` never keeps references to its inputs, so callers may reuse their buffers
+    """
+
+    order = 1
+    supports_cosine_schedule = True
+
+    def __init__(self,
+                 num_train_timesteps=1000,
+                 beta_start=0.0001,
+                 beta_end=0.02,
+                 beta_schedule="linear",
+                 trained_betas=None,
+                 prediction_type="epsilon",
+                 **kwargs):
+        if trained_betas is not None:
+            self.betas = np.asarray(trained_betas, dtype=np.float64)
+        elif beta_schedule == "linear":
+            self.betas = np.linspace(beta_start, beta_end, num_train_timesteps, dtype=np.float64)
+        elif beta_schedule == "scaled_linear":
+            self.betas = np.linspace(beta_start**0.5, beta_end**0.5, num_train_timesteps, dtype=np.float64)**2
+        elif beta_schedule == "squaredcos_cap_v2" and self.supports_cosine_schedule:
+            self.betas = betas_for_alpha_bar(num_train_timesteps)
+        else:
+            raise NotImplementedError(f"{beta_schedule} does is not implemented for {self.__class__}")
+
+        self.alphas = 1.0 - self.betas
+        self.alphas_cumprod = np.cumprod(self.alphas)
+
+        self.config = dict(num_train_timesteps=num_train_timesteps,
+                           beta_start=beta_start,
+                           beta_end=beta_end,
+                           beta_schedule=beta_schedule,
+                           trained_betas=trained_betas,
+                           prediction_type=prediction_type,
+                           **kwargs)
+        self.num_train_timesteps = num_train_timesteps
+        self.prediction_type = prediction_type
+
+        self.num_inference_steps = None
+        self.timesteps = None
+        self.step_indices = {}
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        """ Creates the scheduler from the config of a (diffusers) scheduler. Options that do
+        not exist for this scheduler are ignored
+        """
+        config = dict(config, **kwargs)
+        parameters = inspect.signature(cls.__init__).parameters
+        return cls(**{k: v for k, v in config.items() if k in parameters and k != "self"})
+
+    def _set_timesteps(self, num_inference_steps, timesteps):
+        self.num_inference_steps = num_inference_steps
+        self.timesteps = timesteps
+        self.step_indices = {float(t): i for i, t in enumerate(timesteps)}
+
+    def _step_index(self, timestep):
+        if self.num_inference_steps is None:
+            raise ValueError(
+                "Number of inference steps is 'None', you need to run 'set_timesteps' after creating the scheduler"
+            )
+        return self.step_indices[float(timestep)]
+
+    def _check_prediction_type(self, supported):
+        if self.prediction_type not in supported:
+            raise ValueError(
+                f"prediction_type given as {self.prediction_type} must be one of {', '.join(supported)}")
+
+    def scale_model_input(self, sample, *args, **kwargs):
+        return sample
+
+    def __len__(self):
+        return self.num_train_timesteps
+
+
+class NumpyDDIMScheduler(NumpyScheduler):
+    """ NumPy version of `diffusers.DDIMScheduler`
+    """
+
+    def __init__(self,
+                 num_train_timesteps=1000,
+                 beta_start=0.0001,
+                 beta_end=0.02,
+                 beta_schedule="linear",
+                 trained_betas=None,
+                 clip_sample=True,
+                 set_alpha_to_one=True,
+                 steps_offset=0,
+                 prediction_type="epsilon"):
+        super().__init__(num_train_timesteps, beta_start, beta_end, beta_schedule, trained_betas,
+                         prediction_type,
+                         clip_sample=clip_sample,
+                         set_alpha_to_one=set_alpha_to_one,
+                         steps_offset=steps_offset)
+        self._check_prediction_type(("epsilon", "sample", "v_prediction"))
+
+        self.clip_sample = clip_sample
+        self.steps_offset = steps_offset
+        self.final_alpha_cumprod = 1.0 if set_alpha_to_one else self.alphas_cumprod[0]
+        self.init_noise_sigma = 1.0
+
+    def set_timesteps(self, num_inference_steps, device=None):
+        step_ratio = self.num_train_timesteps // num_inference_steps
+        timesteps = (np.arange(0, num_inference_steps) * step_ratio).round()[::-1].astype(np.int64)
+        timesteps += self.steps_offset
+        self._set_timesteps(num_inference_steps, timesteps)
+
+        prev_timesteps = timesteps - step_ratio
+        alpha_prod_t = self.alphas_cumprod[timesteps]
+        alpha_prod_t_prev = np.where(prev_timesteps >= 0,
+                                     self.alphas_cumprod[np.maximum(prev_timesteps, 0)],
+                                     self.final_alpha_cumprod)
+        beta_prod_t = 1 - alpha_prod_t
+        beta_prod_t_prev = 1 - alpha_prod_t_prev
+
+        self.coefficients = [
+            dict(
+                alpha_prod_t_prev=float(a_prev),
+                sqrt_alpha_prod_t=float(np.sqrt(a_t)),
+                sqrt_beta_prod_t=float(np.sqrt(b_t)),
+                sqrt_alpha_prod_t_prev=float(np.sqrt(a_prev)),
+                variance=float((b_prev / b_t) * (1 - a_t / a_prev)),
+            ) for a_t, a_prev, b_t, b_prev in zip(alpha_prod_t, alpha_prod_t_prev, beta_prod_t,
+                                                  beta_prod_t_prev)
+        ]
+
+    def step(self,
+             model_output,
+             timestep,
+             sample,
+             eta=0.0,
+             use_clipped_model_output=False,
+             generator=None,
+             variance_noise=None,
+             return_dict=True):
+        c = self.coefficients[self._step_index(timestep)]
+        model_output = np.asarray(model_output, dtype=np.float32)
+        sample = np.asarray(sample, dtype=np.float32)
+
+        if self.prediction_type == "epsilon":
+            pred_original_sample = (sample - c["sqrt_beta_prod_t"] * model_output) / c["sqrt_alpha_prod_t"]
+        elif self.prediction_type == "sample":
+            pred_original_sample = model_output
+        else:
+            pred_original_sample = c["sqrt_alpha_prod_t"] * sample - c["sqrt_beta_prod_t"] * model_output
+            model_output = c["sqrt_alpha_prod_t"] * model_output + c["sqrt_beta_prod_t"] * sample
+
+        if self.clip_sample:
+            pred_original_sample = np.clip(pred_original_sample, -1, 1)
+
+        std_dev_t = eta * c["variance"]**0.5
+
+        if use_clipped_model_output:
+            model_output = (sample - c["sqrt_alpha_prod_t"] * pred_original_sample) / c["sqrt_beta_prod_t"]
+
+        pred_sample_direction = (1 - c["alpha_prod_t_prev"] - std_dev_t**2)**0.5 * model_output
+        prev_sample = c["sqrt_alpha_prod_t_prev"] * pred_original_sample + pred_sample_direction
+
+        if eta > 0:
+            if variance_noise is not None and generator is not None:
+                raise ValueError(
+                    "Cannot pass both generator and variance_noise. Please make sure that either `generator` or"
+                    " `variance_noise` stays `None`.")
+            if variance_noise is None:
+                variance_noise = _randn(generator, model_output.shape)
+            prev_sample = prev_sample + std_dev_t * variance_noise
+
+        if not return_dict:
+            return (prev_sample, )
+
+        return NumpySchedulerOutput(prev_sample, pred_original_sample)
+
+
+class NumpyDPMSolverMultistepScheduler(NumpyScheduler):
+    """ NumPy version of `diffusers.DPMSolverMultistepScheduler`
+    """
+
+    def __init__(self,
+                 num_train_timesteps=1000,
+                 beta_start=0.0001,
+                 beta_end=0.02,
+                 beta_schedule="linear",
+                 trained_betas=None,
+                 solver_order=2,
+                 prediction_type="epsilon",
+                 thresholding=False,
+                 dynamic_thresholding_ratio=0.995,
+                 sample_max_value=1.0,
+                 algorithm_type="dpmsolver++",
+                 solver_type="midpoint",
+                 lower_order_final=True):
+        super().__init__(num_train_timesteps, beta_start, beta_end, beta_schedule, trained_betas,
+                         prediction_type,
+                         solver_order=solver_order,
+                         thresholding=thresholding,
+                         dynamic_thresholding_ratio=dynamic_thresholding_ratio,
+                         sample_max_value=sample_max_value,
+                         algorithm_type=algorithm_type,
+                         solver_type=solver_type,
+                         lower_order_final=lower_order_final)
+        self._check_prediction_type(("epsilon", "sample", "v_prediction"))
+
+        if algorithm_type not in ["dpmsolver", "dpmsolver++"]:
+            raise NotImplementedError(f"{algorithm_type} does is not implemented for {self.__class__}")
+        if solver_type not in ["midpoint", "heun"]:
+            raise NotImplementedError(f"{solver_type} does is not implemented for {self.__class__}")
+
+        self.solver_order = solver_order
+        self.thresholding = thresholding
+        self.dynamic_thresholding_ratio = dynamic_thresholding_ratio
+        self.sample_max_value = sample_max_value
+        self.algorithm_type = algorithm_type
+        self.solver_type = solver_type
+        self.lower_order_final = lower_order_final
+
+        self.alpha_t = np.sqrt(self.alphas_cumprod)
+        self.sigma_t = np.sqrt(1 - self.alphas_cumprod)
+        self.lambda_t = np.log(self.alpha_t) - np.log(self.sigma_t)
+
+        self.init_noise_sigma = 1.0
+
+        self.model_outputs = [None] * solver_order
+        self.lower_order_nums = 0
+
+    def set_timesteps(self, num_inference_steps, device=None):
+        timesteps = (np.linspace(0, self.num_train_timesteps - 1,
+                                 num_inference_steps + 1).round()[::-1][:-1].astype(np.int64))
+        self._set_timesteps(num_inference_steps, timesteps)
+
+        self.model_outputs = [None] * self.solver_order
+        self.lower_order_nums = 0
+
+        # Coefficients of the first, second and third order updates for every step. The
+        # update from `s0 = timesteps[i]` to `t = prev_timesteps[i]` uses the model outputs of
+        # `s1 = timesteps[i - 1]` and `s2 = timesteps[i - 2]` for the higher orders
+        prev_timesteps = np.append(timesteps[1:], 0)
+        self.coefficients = []
+        for i, (s0, t) in enumerate(zip(timesteps, prev_timesteps)):
+            alpha_t, sigma_t = self.alpha_t[t], self.sigma_t[t]
+            alpha_s0, sigma_s0 = self.alpha_t[s0], self.sigma_t[s0]
+            h = self.lambda_t[t] - self.lambda_t[s0]
+
+            if self.algorithm_type == "dpmsolver++":
+                sample_coeff = sigma_t / sigma_s0
+                d0_coeff = -alpha_t * (np.exp(-h) - 1.0)
+                heun_d1_coeff = alpha_t * ((np.exp(-h) - 1.0) / h + 1.0)
+                d2_coeff = -alpha_t * ((np.exp(-h) - 1.0 + h) / h**2 - 0.5)
+            else:
+                sample_coeff = alpha_t / alpha_s0
+                d0_coeff = -sigma_t * (np.exp(h) - 1.0)
+                heun_d1_coeff = -sigma_t * ((np.exp(h) - 1.0) / h - 1.0)
+                d2_coeff = -sigma_t * ((np.exp(h) - 1.0 - h) / h**2 - 0.5)
+
+            coefficients = dict(
+                alpha_s0=float(alpha_s0),
+                sigma_s0=float(sigma_s0),
+                sample=float(sample_coeff),
+                d0=float(d0_coeff),
+            )
+
+            if i >= 1:
+                h_0 = self.lambda_t[s0] - self.lambda_t[timesteps[i - 1]]
+                coefficients["r0"] = float(h_0 / h)
+                if self.solver_type == "midpoint":
+                    coefficients["d1"] = float(0.5 * d0_coeff)
+                else:
+                    coefficients["d1"] = float(heun_d1_coeff)
+
+            if i >= 2:
+                h_1 = self.lambda_t[timesteps[i - 1]] - self.lambda_t[timesteps[i - 2]]
+                coefficients["r1"] = float(h_1 / h)
+                coefficients["third_order_d1"] = float(heun_d1_coeff)
+                coefficients["d2"] = float(d2_coeff)
+
+            self.coefficients.append(coefficients)
+
+    def _step_index(self, timestep):
+        if self.num_inference_steps is None:
+            raise ValueError(
+                "Number of inference steps is 'None', you need to run 'set_timesteps' after creating the scheduler"
+            )
+        return self.step_indices.get(float(timestep), len(self.timesteps) - 1)
+
+    def convert_model_output(self, model_output, c, sample):
+        if self.algorithm_type == "dpmsolver++":
+            if self.prediction_type == "epsilon":
+                x0_pred = (sample - c["sigma_s0"] * model_output) / c["alpha_s0"]
+            elif self.prediction_type == "sample":
+                x0_pred = model_output.copy()
+            else:
+                x0_pred = c["alpha_s0"] * sample - c["sigma_s0"] * model_output
+
+            if self.thresholding:
+                dynamic_max_val = np.quantile(np.abs(x0_pred).reshape((x0_pred.shape[0], -1)),
+                                              self.dynamic_thresholding_ratio,
+                                              axis=1)
+                dynamic_max_val = np.maximum(dynamic_max_val, self.sample_max_value)
+                dynamic_max_val = dynamic_max_val.reshape((-1, ) + (1, ) * (x0_pred.ndim - 1))
+                x0_pred = (np.clip(x0_pred, -dynamic_max_val, dynamic_max_val) /
+                           dynamic_max_val).astype(np.float32)
+
+            return x0_pred
+        else:
+            if self.prediction_type == "epsilon":
+                return model_output.copy()
+            elif self.prediction_type == "sample":
+                return (sample - c["alpha_s0"] * model_output) / c["sigma_s0"]
+            else:
+                return c["alpha_s0"] * model_output + c["sigma_s0"] * sample
+
+    def step(self, model_output, timestep, sample, return_dict=True):
+        step_index = self._step_index(timestep)
+        c = self.coefficients[step_index]
+        model_output = np.asarray(model_output, dtype=np.float32)
+        sample = np.asarray(sample, dtype=np.float32)
+
+        num_steps = len(self.timesteps)
+        lower_order_final = (step_index == num_steps - 1) and self.lower_order_final and num_steps < 15
+        lower_order_second = (step_index == num_steps - 2) and self.lower_order_final and num_steps < 15
+
+        model_output = self.convert_model_output(model_output, c, sample)
+        for i in range(self.solver_order - 1):
+            self.model_outputs[i] = self.model_outputs[i + 1]
+        self.model_outputs[-1] = model_output
+
+        if self.solver_order == 1 or self.lower_order_nums < 1 or lower_order_final:
+            prev_sample = c["sample"] * sample + c["d0"] * model_output
+        elif self.solver_order == 2 or self.lower_order_nums < 2 or lower_order_second:
+            m0, m1 = self.model_outputs[-1], self.model_outputs[-2]
+            d1 = (1.0 / c["r0"]) * (m0 - m1)
+            prev_sample = c["sample"] * sample + c["d0"] * m0 + c["d1"] * d1
+        else:
+            m0, m1, m2 = self.model_outputs[-1], self.model_outputs[-2], self.model_outputs[-3]
+            r0, r1 = c["r0"], c["r1"]
+            d1_0, d1_1 = (1.0 / r0) * (m0 - m1), (1.0 / r1) * (m1 - m2)
+            d1 = d1_0 + (r0 / (r0 + r1)) * (d1_0 - d1_1)
+            d2 = (1.0 / (r0 + r1)) * (d1_0 - d1_1)
+            prev_sample = (c["sample"] * sample + c["d0"] * m0 + c["third_order_d1"] * d1 +
+                           c["d2"] * d2)
+
+        if self.lower_order_nums < self.solver_order:
+            self.lower_order_nums += 1
+
+        if not return_dict:
+            return (prev_sample, )
+
+        return NumpySchedulerOutput(prev_sample, None)
+
+
+class _NumpyKarrasScheduler(NumpyScheduler):
+    """ Shared noise schedule of the sigma-parameterized (Euler, LMS) schedulers
+    """
+
+    supports_cosine_schedule = False
+
+    def __init__(self,
+                 num_train_timesteps=1000,
+                 beta_start=0.0001,
+                 beta_end=0.02,
+                 beta_schedule="linear",
+                 trained_betas=None,
+                 prediction_type="epsilon"):
+        super().__init__(num_train_timesteps, beta_start, beta_end, beta_schedule, trained_betas,
+                         prediction_type)
+        self._check_prediction_type(("epsilon", "v_prediction"))
+
+        self.train_sigmas = ((1 - self.alphas_cumprod) / self.alphas_cumprod)**0.5
+        self.init_noise_sigma = float(self.train_sigmas.max())
+
+    def set_timesteps(self, num_inference_steps, device=None):
+        timesteps = np.linspace(0, self.num_train_timesteps - 1, num_inference_steps, dtype=float)[::-1].copy()
+        self._set_timesteps(num_inference_steps, timesteps)
+
+        sigmas = np.interp(timesteps, np.arange(0, len(self.train_sigmas)), self.train_sigmas)
+        self.sigmas = np.concatenate([sigmas, [0.0]]).astype(np.float32).astype(np.float64)
+        self.input_scales = [float(1 / (sigma**2 + 1)**0.5) for sigma in self.sigmas[:-1]]
+
+    def scale_model_input(self, sample, timestep):
+        return sample * self.input_scales[self._step_index(timestep)]
+
+    def _pred_original_sample(self, model_output, sample, sigma):
+        if self.prediction_type == "epsilon":
+            return sample - sigma * model_output
+        return model_output * (-sigma / (sigma**2 + 1)**0.5) + (sample / (sigma**2 + 1))
+
+
+class NumpyEulerDiscreteScheduler(_NumpyKarrasScheduler):
+    """ NumPy version of `diffusers.EulerDiscreteScheduler`
+    """
+
+    def step(self,
+             model_output,
+             timestep,
+             sample,
+             s_churn=0.0,
+             s_tmin=0.0,
+             s_tmax=float("inf"),
+             s_noise=1.0,
+             generator=None,
+             return_dict=True):
+        step_index = self._step_index(timestep)
+        model_output = np.asarray(model_output, dtype=np.float32)
+        sample = np.asarray(sample, dtype=np.float32)
+
+        sigma = float(self.sigmas[step_index])
+        gamma = min(s_churn / (len(self.sigmas) - 1), 2**0.5 - 1) if s_tmin <= sigma <= s_tmax else 0.0
+        sigma_hat = sigma * (gamma + 1)
+
+        if gamma > 0:
+            eps = _randn(generator, model_output.shape) * s_noise
+            sample = sample + eps * (sigma_hat**2 - sigma**2)**0.5
+
+        pred_original_sample = self._pred_original_sample(model_output, sample, sigma_hat
+                                                          if self.prediction_type == "epsilon" else sigma)
+
+        derivative = (sample - pred_original_sample) / sigma_hat
+        dt = float(self.sigmas[step_index + 1]) - sigma_hat
+        prev_sample = sample + derivative * dt
+
+        if not return_dict:
+            return (prev_sample, )
+
+        return NumpySchedulerOutput(prev_sample, pred_original_sample)
+
+
+class NumpyEulerAncestralDiscreteScheduler(_NumpyKarrasScheduler):
+    """ NumPy version of `diffusers.EulerAncestralDiscreteScheduler`. The noise is drawn
+    from `generator` or from the global numpy random state
+    """
+
+    def set_timesteps(self, num_inference_steps, device=None):
+        super().set_timesteps(num_inference_steps, device)
+
+        sigma_from, sigma_to = self.sigmas[:-1], self.sigmas[1:]
+        sigma_up = (sigma_to**2 * (sigma_from**2 - sigma_to**2) / sigma_from**2)**0.5
+        sigma_down = (sigma_to**2 - sigma_up**2)**0.5
+
+        self.sigmas_up = [float(s) for s in sigma_up]
+        self.dts = [float(s) for s in sigma_down - sigma_from]
+
+    def step(self, model_output, timestep, sample, generator=None, return_dict=True):
+        step_index = self._step_index(timestep)
+        model_output = np.asarray(model_output, dtype=np.float32)
+        sample = np.asarray(sample, dtype=np.float32)
+
+        sigma = float(self.sigmas[step_index])
+        pred_original_sample = self._pred_original_sample(model_output, sample, sigma)
+
+        derivative = (sample - pred_original_sample) / sigma
+        prev_sample = sample + derivative * self.dts[step_index]
+
+        noise = _randn(generator, model_output.shape)
+        prev_sample = prev_sample + noise * self.sigmas_up[step_index]
+
+        if not return_dict:
+            return (prev_sample, )
+
+        return NumpySchedulerOutput(prev_sample, pred_original_sample)
+
+
+class NumpyLMSDiscreteScheduler(_NumpyKarrasScheduler):
+    """ NumPy version of `diffusers.LMSDiscreteScheduler`.
+
+    The linear multistep coefficients are integrals of Lagrange basis polynomials, which
+    are integrated exactly instead of numerically
+    """
+
+    def set_timesteps(self, num_inference_steps, device=None, order=4):
+        super().set_timesteps(num_inference_steps, device)
+        self.derivatives = []
+        self.lms_coefficients = {
+            order: [self.get_lms_coefficients(order, i) for i in range(num_inference_steps)]
+        }
+
+    def get_lms_coefficients(self, order, t):
+        order = min(t + 1, order)
+        sigmas = self.sigmas
+
+        coefficients = []
+        for current_order in range(order):
+            basis = np.poly1d([1.0])
+            for k in range(order):
+                if current_order == k:
+                    continue
+                basis *= np.poly1d([1.0, -sigmas[t - k]]) / (sigmas[t - current_order] - sigmas[t - k])
+
+            integral = basis.integ()
+            coefficients.append(float(integral(sigmas[t + 1]) - integral(sigmas[t])))
+
+        return coefficients
+
+    def step(self, model_output, timestep, sample, order=4, return_dict=True):
+        step_index = self._step_index(timestep)
+        model_output = np.asarray(model_output, dtype=np.float32)
+        sample = np.asarray(sample, dtype=np.float32)
+
+        sigma = float(self.sigmas[step_index])
+        pred_original_sample = self._pred_original_sample(model_output, sample, sigma)
+
+        derivative = (sample - pred_original_sample) / sigma
+        self.derivatives.append(derivative)
+        if len(self.derivatives) > order:
+            self.derivatives.pop(0)
+
+        if order not in self.lms_coefficients:
+            self.lms_coefficients[order] = [
+                self.get_lms_coefficients(order, i) for i in range(self.num_inference_steps)
+            ]
+        lms_coeffs = self.lms_coefficients[order][step_index]
+
+        prev_sample = sample + sum(
+            coeff * derivative for coeff, derivative in zip(lms_coeffs, reversed(self.derivatives)))
+
+        if not return_dict:
+            return (prev_sample, )
+
+        return NumpySchedulerOutput(prev_sample, pred_original_sample)
+
+
+class NumpyPNDMScheduler(NumpyScheduler):
+    """ NumPy version of `diffusers.PNDMScheduler`
+    """
+
+    def __init__(self,
+                 num_train_timesteps=1000,
+                 beta_start=0.0001,
+                 beta_end=0.02,
+                 beta_schedule="linear",
+                 trained_betas=None,
+                 skip_prk_steps=False,
+                 set_alpha_to_one=False,
+                 prediction_type="epsilon",
+                 steps_offset=0):
+        super().__init__(num_train_timesteps, beta_start, beta_end, beta_schedule, trained_betas,
+                         prediction_type,
+                         skip_prk_steps=skip_prk_steps,
+                         set_alpha_to_one=set_alpha_to_one,
+                         steps_offset=steps_offset)
+        self._check_prediction_type(("epsilon", "v_prediction"))
+
+        self.skip_prk_steps = skip_prk_steps
+        self.steps_offset = steps_offset
+        self.final_alpha_cumprod = 1.0 if set_alpha_to_one else self.alphas_cumprod[0]
+        self.init_noise_sigma = 1.0
+
+        self.pndm_order = 4
+        self.cur_model_output = 0
+        self.counter = 0
+        self.cur_sample = None
+        self.ets = []
+        self.prk_timesteps = None
+        self.plms_timesteps = None
+
+    def set_timesteps(self, num_inference_steps, device=None):
+        self.num_inference_steps = num_inference_steps
+        step_ratio = self.num_train_timesteps // num_inference_steps
+        _timesteps = (np.arange(0, num_inference_steps) * step_ratio).round()
+        _timesteps += self.steps_offset
+
+        if self.skip_prk_steps:
+            self.prk_timesteps = np.array([])
+            self.plms_timesteps = np.concatenate([_timesteps[:-1], _timesteps[-2:-1], _timesteps[-1:]])[::-1].copy()
+        else:
+            prk_timesteps = np.array(_timesteps[-self.pndm_order:]).repeat(2) + np.tile(
+                np.array([0, self.num_train_timesteps // num_inference_steps // 2]), self.pndm_order)
+            self.prk_timesteps = (prk_timesteps[:-1].repeat(2)[1:-1])[::-1].copy()
+            self.plms_timesteps = _timesteps[:-3][::-1].copy()
+
+        # Timesteps repeat, steps are counted instead of looked up
+        self.timesteps = np.concatenate([self.prk_timesteps, self.plms_timesteps]).astype(np.int64)
+
+        self.ets = []
+        self.counter = 0
+        self.cur_model_output = 0
+        self.cur_sample = None
+
+        # (sample, model output) coefficients of `_get_prev_sample` per (timestep, prev_timestep)
+        self.prev_sample_coefficients = {}
+
+    def step(self, model_output, timestep, sample, return_dict=True):
+        if self.num_inference_steps is None:
+            raise ValueError(
+                "Number of inference steps is 'None', you need to run 'set_timesteps' after creating the scheduler"
+            )
+
+        # Copied since previous model outputs are kept in `ets`
+        model_output = np.array(model_output, dtype=np.float32)
+        sample = np.asarray(sample, dtype=np.float32)
+
+        if self.counter < len(self.prk_timesteps) and not self.skip_prk_steps:
+            prev_sample = self.step_prk(model_output, int(timestep), sample)
+        else:
+            prev_sample = self.step_plms(model_output, int(timestep), sample)
+
+        if not return_dict:
+            return (prev_sample, )
+
+        return NumpySchedulerOutput(prev_sample, None)
+
+    def step_prk(self, model_output, timestep, sample):
+        diff_to_prev = 0 if self.counter % 2 else self.num_train_timesteps // self.num_inference_steps // 2
+        prev_timestep = timestep - diff_to_prev
+        timestep = int(self.prk_timesteps[self.counter // 4 * 4])
+
+        if self.counter % 4 == 0:
+            self.cur_model_output += 1 / 6 * model_output
+            self.ets.append(model_output)
+            self.cur_sample = sample
+        elif (self.counter - 1) % 4 == 0:
+            self.cur_model_output += 1 / 3 * model_output
+        elif (self.counter - 2) % 4 == 0:
+            self.cur_model_output += 1 / 3 * model_output
+        elif (self.counter - 3) % 4 == 0:
+            model_output = self.cur_model_output + 1 / 6 * model_output
+            self.cur_model_output = 0
+
+        cur_sample = self.cur_sample if self.cur_sample is not None else sample
+
+        prev_sample = self._get_prev_sample(cur_sample, timestep, prev_timestep, model_output)
+        self.counter += 1
+
+        return prev_sample
+
+    def step_plms(self, model_output, timestep, sample):
+        if not self.skip_prk_steps and len(self.ets) < 3:
+            raise ValueError(
+                f"{self.__class__} can only be run AFTER scheduler has been run "
+                "in 'prk' mode for at least 12 iterations ")
+
+        prev_timestep = timestep - self.num_train_timesteps // self.num_inference_steps
+
+        if self.counter != 1:
+            self.ets = self.ets[-3:]
+            self.ets.append(model_output)
+        else:
+            prev_timestep = timestep
+            timestep = timestep + self.num_train_timesteps // self.num_inference_steps
+
+        if len(self.ets) == 1 and self.counter == 0:
+            self.cur_sample = sample
+        elif len(self.ets) == 1 and self.counter == 1:
+            model_output = (model_output + self.ets[-1]) / 2
+            sample = self.cur_sample
+            self.cur_sample = None
+        elif len(self.ets) == 2:
+            model_output = (3 * self.ets[-1] - self.ets[-2]) / 2
+        elif len(self.ets) == 3:
+            model_output = (23 * self.ets[-1] - 16 * self.ets[-2] + 5 * self.ets[-3]) / 12
+        else:
+            model_output = (1 / 24) * (55 * self.ets[-1] - 59 * self.ets[-2] + 37 * self.ets[-3] -
+                                       9 * self.ets[-4])
+
+        prev_sample = self._get_prev_sample(sample, timestep, prev_timestep, model_output)
+        self.counter += 1
+
+        return prev_sample
+
+    def _get_prev_sample(self, sample, timestep, prev_timestep, model_output):
+        key = (timestep, prev_timestep)
+        if key not in self.prev_sample_coefficients:
+            alpha_prod_t = self.alphas_cumprod[timestep]
+            alpha_prod_t_prev = self.alphas_cumprod[
+                prev_timestep] if prev_timestep >= 0 else self.final_alpha_cumprod
+            beta_prod_t = 1 - alpha_prod_t
+            beta_prod_t_prev = 1 - alpha_prod_t_prev
+
+            sample_coeff = (alpha_prod_t_prev / alpha_prod_t)**(0.5)
+            model_output_denom_coeff = alpha_prod_t * beta_prod_t_prev**(0.5) + (
+                alpha_prod_t * beta_prod_t * alpha_prod_t_prev)**(0.5)
+
+            self.prev_sample_coefficients[key] = (
+                float(sample_coeff),
+                float((alpha_prod_t_prev - alpha_prod_t) / model_output_denom_coeff),
+                float(alpha_prod_t**0.5),
+                float(beta_prod_t**0.5),
+            )
+
+        sample_coeff, model_output_coeff, sqrt_alpha_prod_t, sqrt_beta_prod_t = \
+            self.prev_sample_coefficients[key]
+
+        if self.prediction_type == "v_prediction":
+            model_output = sqrt_alpha_prod_t * model_output + sqrt_beta_prod_t * sample
+
+        return sample_coeff * sample - model_output_coeff * model_output
+
+
+NUMPY_SCHEDULER_MAP = {
+    "DDIM": NumpyDDIMScheduler,
+    "DPMSolverMultistep": NumpyDPMSolverMultistepScheduler,
+    "EulerAncestralDiscrete": NumpyEulerAncestralDiscreteScheduler,
+    "EulerDiscrete": NumpyEulerDiscreteScheduler,
+    "LMSDiscrete": NumpyLMSDiscreteScheduler,
+    "PNDM": NumpyPNDMScheduler,
+}
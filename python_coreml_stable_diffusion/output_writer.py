@@ -0,0 +1,87 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import logging
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+from PIL import Image
+from queue import Queue
+from threading import Thread
+import time
+
+
+class OutputWriter:
+    """ Encodes and writes generation outputs (images, history animations) on a
+    background thread, off the critical path of the next generation.
+
+    Jobs are queued in a bounded queue: if the writer falls behind by more than
+    `max_pending` jobs, `submit` blocks until a slot frees up instead of letting
+    pending outputs pile up in memory. `close` flushes all pending jobs
+    """
+
+    def __init__(self, max_pending=4, compress_level=6):
+        self.compress_level = compress_level
+
+        self.queue = Queue(maxsize=max_pending)
+        # (path, seconds) of every written file
+        self.latencies = []
+        self.closed = False
+
+        self.thread = Thread(target=self._run, name="OutputWriter", daemon=True)
+        self.thread.start()
+
+    def submit(self, job, description):
+        """ Queues `job`, a callable which writes an output and returns its path (or None)
+        """
+        if self.closed:
+            raise RuntimeError("OutputWriter is closed")
+        self.queue.put((job, description))
+
+    def write_image(self, path, image):
+        """ Queues an HxWx3 uint8 image to be saved as PNG
+        """
+        def job():
+            Image.fromarray(image).save(path, compress_level=self.compress_level)
+            return path
+
+        self.submit(job, path)
+
+    def close(self):
+        """ Waits until all pending jobs are written and stops the thread
+        """
+        if self.closed:
+            return
+        self.closed = True
+
+        self.queue.put(None)
+        self.thread.join()
+
+        if len(self.latencies) > 0:
+            total = sum(seconds for _, seconds in self.latencies)
+            logger.info(
+                f"Wrote {len(self.latencies)} files, "
+                f"average latency {total / len(self.latencies) * 1e3:.1f} ms")
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            job, description = item
+            start = time.perf_counter()
+            try:
+                path = job()
+            except Exception:
+                logger.exception(f"Failed to write {description}")
+                continue
+            latency = time.perf_counter() - start
+
+            if path is not None:
+                self.latencies.append((path, latency))
+                logger.info(f"{path} written in {latency * 1e3:.1f} ms")
@@ -31,16 +31,56 @@ import os
 
 from python_coreml_stable_diffusion.coreml_model import (
     CoreMLModel,
-    _load_mlpackage,
+    _get_mlpackage_path,
+    _load_mlpackages,
     get_available_compute_units,
 )
+from python_coreml_stable_diffusion.denoising_buffers import DenoisingBuffers
+from python_coreml_stable_diffusion.embedding_cache import EmbeddingCache
+from python_coreml_stable_diffusion.model_cache import ModelCache
+from python_coreml_stable_diffusion.numpy_schedulers import NUMPY_SCHEDULER_MAP, NumpyScheduler
+from python_coreml_stable_diffusion.pipeline_resources import PipelineResources, get_resources_path
+from python_coreml_stable_diffusion.preview_cadence import AdaptivePreviewCadence
+from python_coreml_stable_diffusion.preview_worker import PreviewWorker
 
 import time
-import torch  # Only used for `torch.from_tensor` in `pipe.scheduler.step()`
 from transformers import CLIPFeatureExtractor, CLIPTokenizer
 from typing import List, Optional, Union
 
 
+def _pad_batch(array, batch_size):
+    """ Zero pads the first (batch) dimension of `array` to `batch_size`
+    """
+    if len(array) == batch_size:
+        return array
+
+    padding = np.zeros((batch_size - len(array), ) + array.shape[1:], dtype=array.dtype)
+    return np.concatenate([array, padding])
+
+
+def _predict_in_batches(model, batch_inputs, **inputs):
+    """ Runs `model` on `batch_inputs` of any batch size.
+
+    Core ML models have a fixed batch size, so `batch_inputs` are split into batches of
+    that size (the last one is zero padded) and the outputs are concatenated. `inputs`
+    are passed as is to every call
+    """
+    model_batch_size = model.expected_inputs[next(iter(batch_inputs))]["shape"][0]
+    num_samples = len(next(iter(batch_inputs.values())))
+
+    outputs = {}
+    for start in range(0, num_samples, model_batch_size):
+        end = min(start + model_batch_size, num_samples)
+        batch = {
+            k: _pad_batch(v[start:end], model_batch_size)
+            for k, v in batch_inputs.items()
+        }
+        for k, v in model(**batch, **inputs).items():
+            outputs.setdefault(k, []).append(v[:end - start])
+
+    return {k: np.concatenate(v) for k, v in outputs.items()}
+
+
 class CoreMLStableDiffusionPipeline(DiffusionPipeline):
     """ Core ML version of
     `diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline`
@@ -58,8 +98,10 @@ class CoreMLStableDiffusionPipeline(DiffusionPipeline):
                          EulerAncestralDiscreteScheduler,
                          EulerDiscreteScheduler,
                          LMSDiscreteScheduler,
-                         PNDMScheduler],
+                         PNDMScheduler,
+                         NumpyScheduler],
         tokenizer: CLIPTokenizer,
+        preview_decoder: Optional[CoreMLModel] = None,
     ):
         super().__init__()
 
@@ -90,6 +132,9 @@ class CoreMLStableDiffusionPipeline(DiffusionPipeline):
 
         self.vae_decoder = vae_decoder
 
+        # Optional lightweight approximation of `vae_decoder` for intermediate previews
+        self.preview_decoder = preview_decoder
+
         VAE_DECODER_UPSAMPLE_FACTOR = 8
 
         # In PyTorch, users can determine the tensor shapes dynamically by default
@@ -99,10 +144,49 @@ class CoreMLStableDiffusionPipeline(DiffusionPipeline):
         self.height = latent_h * VAE_DECODER_UPSAMPLE_FACTOR
         self.width = latent_w * VAE_DECODER_UPSAMPLE_FACTOR
 
+        # Number of images denoised per unet call (its batch holds 2 samples per image
+        # for classifier-free guidance). Larger batches are split into multiple calls
+        self.batch_size = max(self.unet.expected_inputs["sample"]["shape"][0] // 2, 1)
+
         logger.info(
-            f"Stable Diffusion configured to generate {self.height}x{self.width} images"
+            f"Stable Diffusion configured to generate {self.height}x{self.width} images, "
+            f"{self.batch_size} at a time"
         )
 
+        # Text encoder outputs are cached by model version and token ids
+        self.model_version = None
+        self.embedding_cache = EmbeddingCache()
+
+        # Seconds spent in each stage of the last call
+        self.stage_timings = {}
+
+    def _run_text_encoder(self, input_ids):
+        """ Encodes every row of `input_ids`, only rows missing from `embedding_cache`
+        are passed to the text encoder
+        """
+        if self.embedding_cache is None:
+            return _predict_in_batches(
+                self.text_encoder,
+                {"input_ids": input_ids.astype(np.float32)})["last_hidden_state"]
+
+        keys = [EmbeddingCache.key(self.model_version, row) for row in input_ids]
+
+        # Repeated rows (e.g. the empty negative prompt of every image) are looked up once
+        embeddings = {key: self.embedding_cache.get(key) for key in dict.fromkeys(keys)}
+        missing = [key for key, value in embeddings.items() if value is None]
+
+        if len(missing) > 0:
+            missing_input_ids = np.stack([input_ids[keys.index(key)] for key in missing])
+            missing_embeddings = _predict_in_batches(
+                self.text_encoder,
+                {"input_ids": missing_input_ids.astype(np.float32)})["last_hidden_state"]
+
+            for key, value in zip(missing, missing_embeddings):
+                self.embedding_cache.put(key, value)
+                embeddings[key] = value
+
+        return np.stack([embeddings[key] for key in keys])
+
     def _encode_prompt(self, prompt, num_images_per_prompt,
                        do_classifier_free_guidance, negative_prompt):
         batch_size = len(prompt) if isinstance(prompt, list) else 1
@@ -124,8 +208,8 @@ class CoreMLStableDiffusionPipeline(DiffusionPipeline):
             text_input_ids = text_input_ids[:, :self.tokenizer.
                                             model_max_length]
 
-        text_embeddings = self.text_encoder(
-            input_ids=text_input_ids.astype(np.float32))["last_hidden_state"]
+        text_embeddings = self._run_text_encoder(text_input_ids)
+        text_embeddings = np.repeat(text_embeddings, num_images_per_prompt, axis=0)
 
         if do_classifier_free_guidance:
             uncond_tokens: List[str]
@@ -154,9 +238,8 @@ class CoreMLStableDiffusionPipeline(DiffusionPipeline):
                 return_tensors="np",
             )
 
-            uncond_embeddings = self.text_encoder(
-                input_ids=uncond_input.input_ids.astype(
-                    np.float32))["last_hidden_state"]
+            uncond_embeddings = self._run_text_encoder(uncond_input.input_ids)
+            uncond_embeddings = np.repeat(uncond_embeddings, num_images_per_prompt, axis=0)
 
             # For classifier free guidance, we need to do two forward passes.
             # Here we concatenate the unconditional and text embeddings into a single batch
@@ -175,10 +258,12 @@ class CoreMLStableDiffusionPipeline(DiffusionPipeline):
                 return_tensors="np",
             )
 
-            safety_checker_outputs = self.safety_checker(
-                clip_input=safety_checker_input.pixel_values.astype(
-                    np.float16),
-                images=image.astype(np.float16),
+            safety_checker_outputs = _predict_in_batches(
+                self.safety_checker,
+                {
+                    "clip_input": safety_checker_input.pixel_values.astype(np.float16),
+                    "images": image.astype(np.float16),
+                },
                 adjustment=np.array([0.]).astype(
                     np.float16),  # defaults to 0 in original pipeline
             )
@@ -195,30 +280,52 @@ class CoreMLStableDiffusionPipeline(DiffusionPipeline):
 
         return image, has_nsfw_concept
 
-    def decode_latents(self, latents):
+    def decode_latents(self, latents, decoder=None):
+        if decoder is None:
+            decoder = self.vae_decoder
+
         latents = 1 / 0.18215 * latents
-        image = self.vae_decoder(z=latents.astype(np.float16))["image"]
+        image = _predict_in_batches(decoder, {"z": latents.astype(np.float16)})["image"]
         image = np.clip(image / 2 + 0.5, 0, 1)
         image = image.transpose((0, 2, 3, 1))
 
         return image
 
+    def decode_preview_latents(self, latents):
+        """ Decodes intermediate latents with `preview_decoder` if available, falls back to `vae_decoder`
+        """
+        return self.decode_latents(latents, decoder=self.preview_decoder)
+
     def prepare_latents(self,
                         batch_size,
                         num_channels_latents,
                         height,
                         width,
-                        latents=None):
+                        latents=None,
+                        seeds=None,
+                        init_noise_sigma=None):
+        """ Returns the initial latents scaled by `init_noise_sigma`, which defaults to
+        that of the current scheduler
+        """
         latents_shape = (batch_size, num_channels_latents, self.height // 8,
                          self.width // 8)
-        if latents is None:
+        if latents is None and seeds is not None:
+            # Every sample is drawn from its own seed, so an image does not depend on the
+            # batch it is generated in
+            latents = np.stack([
+                np.random.RandomState(seed).randn(*latents_shape[1:])
+                for seed in seeds
+            ]).astype(np.float16)
+        elif latents is None:
             latents = np.random.randn(*latents_shape).astype(np.float16)
         elif latents.shape != latents_shape:
             raise ValueError(
                 f"Unexpected latents shape, got {latents.shape}, expected {latents_shape}"
             )
 
-        latents = latents * self.scheduler.init_noise_sigma
+        if init_noise_sigma is None:
+            init_noise_sigma = self.scheduler.init_noise_sigma
+        latents = latents * init_noise_sigma
 
         return latents
 
@@ -240,11 +347,14 @@ class CoreMLStableDiffusionPipeline(DiffusionPipeline):
                 f"`height` and `width` have to be divisible by 8 but are {height} and {width}."
             )
 
+        if callback_steps == "adaptive":
+            return
+
         if (callback_steps is None) or (callback_steps is not None and
                                         (not isinstance(callback_steps, int)
                                          or callback_steps <= 0)):
             raise ValueError(
-                f"`callback_steps` has to be a positive integer but is {callback_steps} of type"
+                f"`callback_steps` has to be a positive integer or \"adaptive\" but is {callback_steps} of type"
                 f" {type(callback_steps)}.")
 
     def prepare_extra_step_kwargs(self, eta):
@@ -261,6 +371,99 @@ class CoreMLStableDiffusionPipeline(DiffusionPipeline):
 
         return extra_step_kwargs
 
+    def denoise(self,
+                latents,
+                text_embeddings,
+                num_inference_steps,
+                guidance_scale,
+                eta=0.0,
+                callback=None,
+                callback_steps=1,
+                callback_async=False,
+                preview_budget=0.1):
+        """ Runs the denoising loop from the initial `latents` (see `prepare_latents`)
+        conditioned on `text_embeddings` (see `_encode_prompt`) and returns the final
+        latents. The callback arguments are documented in `__call__`
+        """
+        do_classifier_free_guidance = guidance_scale > 1.0
+
+        # 1. Prepare timesteps
+        self.scheduler.set_timesteps(num_inference_steps)
+        timesteps = self.scheduler.timesteps
+
+        # 2. Prepare extra step kwargs
+        extra_step_kwargs = self.prepare_extra_step_kwargs(eta)
+
+        # diffusers schedulers operate on torch tensors, NumPy schedulers on the arrays as is
+        torch_scheduler = not isinstance(self.scheduler, NumpyScheduler)
+        if torch_scheduler:
+            import torch
+
+        # 3. Denoising loop
+        buffers = DenoisingBuffers(self.unet, text_embeddings, latents.shape,
+                                   do_classifier_free_guidance)
+
+        cadence = None
+        if callback_steps == "adaptive":
+            cadence = AdaptivePreviewCadence(preview_budget)
+
+        preview_worker = None
+        if callback is not None and callback_async:
+            preview_worker = PreviewWorker(callback, cadence)
+
+        try:
+            step_start = time.perf_counter()
+            for i, t in enumerate(self.progress_bar(timesteps)):
+                latent_model_input = self.scheduler.scale_model_input(latents, t)
+
+                # predict the noise residual, the latents are expanded in place if we are
+                # doing classifier free guidance
+                noise_pred = buffers.predict_noise(latent_model_input, t)
+
+                # perform guidance
+                if do_classifier_free_guidance:
+                    noise_pred = buffers.guide(guidance_scale)
+
+                # compute the previous noisy sample x_t -> x_t-1
+                if torch_scheduler:
+                    # diffusers schedulers keep references to previous model outputs
+                    latents = self.scheduler.step(torch.from_numpy(noise_pred.copy()),
+                                                  t,
+                                                  torch.from_numpy(latents),
+                                                  **extra_step_kwargs,
+                    ).prev_sample.numpy()
+                else:
+                    latents = self.scheduler.step(noise_pred, t, latents,
+                                                  **extra_step_kwargs).prev_sample
+
+                if cadence is not None:
+                    cadence.record_step(time.perf_counter() - step_start)
+                    to_callback = cadence.should_preview(i, len(timesteps))
+                else:
+                    to_callback = i % callback_steps == 0
+
+                # call the callback, if provided
+                if callback is not None and to_callback:
+                    if preview_worker is not None:
+                        if preview_worker.cancelled:
+                            break
+                        preview_worker.submit(i, t, latents)
+                    else:
+                        callback_start = time.perf_counter()
+                        to_continue = callback(i, t, latents) is not False
+                        if cadence is not None:
+                            cadence.record_preview(time.perf_counter() - callback_start)
+
+                        if not to_continue:
+                            break
+
+                step_start = time.perf_counter()
+        finally:
+            if preview_worker is not None:
+                preview_worker.close()
+
+        return latents
+
     def __call__(
         self,
         prompt,
@@ -276,10 +479,25 @@ class CoreMLStableDiffusionPipeline(DiffusionPipeline):
         return_dict=True,
         callback=None,
         callback_steps=1,
+        callback_async=False,
+        preview_budget=0.1,
         seed=None,
         **kwargs,
     ):
-        if seed:
+        """ If `callback_async` is True, `callback` runs on a preview worker thread so that
+        the denoising loop does not wait for it. Intermediate steps are dropped while the
+        callback is busy, and returning False from it cancels the generation.
+
+        If `callback_steps` is "adaptive", the steps passed to `callback` are chosen so that
+        the callback takes at most `preview_budget` of the generation time. The final step
+        is always passed.
+
+        `seed` is either a single seed for the whole batch or a list with a seed per image.
+        """
+        seeds = None
+        if isinstance(seed, (list, tuple)):
+            seeds = seed
+        elif seed:
             logger.info(f"Setting random seed to {seed}")
             np.random.seed(seed)
 
@@ -288,16 +506,19 @@ class CoreMLStableDiffusionPipeline(DiffusionPipeline):
 
         # 2. Define call parameters
         batch_size = 1 if isinstance(prompt, str) else len(prompt)
-        if batch_size > 1 or num_images_per_prompt > 1:
-            raise NotImplementedError(
-                "For batched generation of multiple images and/or multiple prompts, please refer to the Swift package."
-            )
+        if seeds is not None and len(seeds) != batch_size * num_images_per_prompt:
+            raise ValueError(
+                f"`seed` has {len(seeds)} seeds but {batch_size * num_images_per_prompt} images "
+                "are generated. Please pass a single seed or one seed per image.")
 
         # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
         # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
         # corresponds to doing no classifier free guidance.
         do_classifier_free_guidance = guidance_scale > 1.0
 
+        stage_timings = {}
+        stage_start = time.perf_counter()
+
         # 3. Encode input prompt
         text_embeddings = self._encode_prompt(
             prompt,
@@ -306,11 +527,10 @@ class CoreMLStableDiffusionPipeline(DiffusionPipeline):
             negative_prompt,
         )
 
-        # 4. Prepare timesteps
-        self.scheduler.set_timesteps(num_inference_steps)
-        timesteps = self.scheduler.timesteps
+        stage_timings["text_encoder"] = time.perf_counter() - stage_start
+        stage_start = time.perf_counter()
 
-        # 5. Prepare latent variables
+        # 4. Prepare latent variables
         num_channels_latents = self.unet.in_channels
         latents = self.prepare_latents(
             batch_size * num_images_per_prompt,
@@ -318,51 +538,38 @@ class CoreMLStableDiffusionPipeline(DiffusionPipeline):
             height,
             width,
             latents,
+            seeds,
         )
 
-        # 6. Prepare extra step kwargs
-        extra_step_kwargs = self.prepare_extra_step_kwargs(eta)
+        # 5. Denoising loop
+        latents = self.denoise(
+            latents,
+            text_embeddings,
+            num_inference_steps,
+            guidance_scale,
+            eta=eta,
+            callback=callback,
+            callback_steps=callback_steps,
+            callback_async=callback_async,
+            preview_budget=preview_budget,
+        )
 
-        # 7. Denoising loop
-        for i, t in enumerate(self.progress_bar(timesteps)):
-            # expand the latents if we are doing classifier free guidance
-            latent_model_input = np.concatenate(
-                [latents] * 2) if do_classifier_free_guidance else latents
-            latent_model_input = self.scheduler.scale_model_input(
-                latent_model_input, t)
-
-            # predict the noise residual
-            noise_pred = self.unet(
-                sample=latent_model_input.astype(np.float16),
-                timestep=np.array([t, t], np.float16),
-                encoder_hidden_states=text_embeddings.astype(np.float16),
-            )["noise_pred"]
-
-            # perform guidance
-            if do_classifier_free_guidance:
-                noise_pred_uncond, noise_pred_text = np.split(noise_pred, 2)
-                noise_pred = noise_pred_uncond + guidance_scale * (
-                    noise_pred_text - noise_pred_uncond)
-
-            # compute the previous noisy sample x_t -> x_t-1
-            latents = self.scheduler.step(torch.from_numpy(noise_pred),
-                                          t,
-                                          torch.from_numpy(latents),
-                                          **extra_step_kwargs,
-            ).prev_sample.numpy()
-
-            # call the callback, if provided
-            if callback is not None and i % callback_steps == 0:
-                if callback(i, t, latents) is False:
-                    break
+        stage_timings["denoise"] = time.perf_counter() - stage_start
+        stage_start = time.perf_counter()
 
-        # 8. Post-processing
+        # 6. Post-processing
         image = self.decode_latents(latents)
 
-        # 9. Run safety checker
+        stage_timings["vae_decoder"] = time.perf_counter() - stage_start
+        stage_start = time.perf_counter()
+
+        # 7. Run safety checker
         image, has_nsfw_concept = self.run_safety_checker(image)
 
-        # 10. Convert to PIL
+        stage_timings["safety_checker"] = time.perf_counter() - stage_start
+        self.stage_timings = stage_timings
+
+        # 8. Convert to PIL
         if output_type == "pil":
             image = self.numpy_to_pil(image)
 
@@ -386,31 +593,93 @@ def get_available_schedulers():
 
 SCHEDULER_MAP = get_available_schedulers()
 
+# Optional models that may be loaded in the background (see `get_coreml_pipe_from_resources`)
+LAZY_MODEL_NAMES = ("safety_checker", "preview_decoder")
+
+
+def get_scheduler(default_scheduler, scheduler_name=None, backend="numpy"):
+    """ Returns the scheduler `scheduler_name` (the default diffusers scheduler if None)
+    configured like `default_scheduler`. With the "numpy" backend its NumPy version is
+    returned, with the "torch" backend None is returned to keep the default scheduler
+    """
+    if scheduler_name is None:
+        if backend == "torch":
+            return None
+        scheduler_name = default_scheduler.__class__.__name__.replace("Scheduler", "")
+
+    if backend == "numpy":
+        if scheduler_name in NUMPY_SCHEDULER_MAP:
+            return NUMPY_SCHEDULER_MAP[scheduler_name].from_config(default_scheduler.config)
+        logger.warning(f"{scheduler_name} has no NumPy implementation, using the diffusers scheduler")
+
+    return SCHEDULER_MAP[scheduler_name].from_config(default_scheduler.config)
+
 def get_coreml_pipe(pytorch_pipe,
                     mlpackages_dir,
                     model_version,
                     compute_unit,
                     delete_original_pipe=True,
-                    scheduler_override=None):
+                    scheduler_override=None,
+                    max_load_workers=None,
+                    lazy_models=(),
+                    model_cache=None):
     """ Initializes and returns a `CoreMLStableDiffusionPipeline` from an original
     diffusers PyTorch pipeline
     """
+    resources = PipelineResources.from_pipe(pytorch_pipe)
+
+    if delete_original_pipe:
+        del pytorch_pipe
+        gc.collect()
+        logger.info("Removed PyTorch pipe to reduce peak memory consumption")
+
+    return get_coreml_pipe_from_resources(resources,
+                                          mlpackages_dir,
+                                          model_version,
+                                          compute_unit,
+                                          scheduler_override=scheduler_override,
+                                          max_load_workers=max_load_workers,
+                                          lazy_models=lazy_models,
+                                          model_cache=model_cache)
+
+
+def get_coreml_pipe_from_resources(resources,
+                                   mlpackages_dir,
+                                   model_version,
+                                   compute_unit,
+                                   scheduler_override=None,
+                                   max_load_workers=None,
+                                   lazy_models=(),
+                                   model_cache=None):
+    """ Initializes and returns a `CoreMLStableDiffusionPipeline` from the
+    `PipelineResources` of the original diffusers pipeline.
+
+    The Core ML models are loaded concurrently on `max_load_workers` threads. The
+    optional models in `lazy_models` (see `LAZY_MODEL_NAMES`) are loaded in the
+    background and only waited for when first used. With a `model_cache`, compiled
+    models are reused across loads
+    """
+    unsupported = set(lazy_models) - set(LAZY_MODEL_NAMES)
+    if unsupported:
+        raise ValueError(f"{sorted(unsupported)} can not be loaded lazily, "
+                         f"options: {LAZY_MODEL_NAMES}")
+
     # Ensure `scheduler_override` object is of correct type if specified
     if scheduler_override is not None:
-        assert isinstance(scheduler_override, SchedulerMixin)
+        assert isinstance(scheduler_override, (SchedulerMixin, NumpyScheduler))
         logger.warning(
             "Overriding scheduler in pipeline: "
-            f"Default={pytorch_pipe.scheduler}, Override={scheduler_override}")
+            f"Default={resources.scheduler}, Override={scheduler_override}")
 
     # Gather configured tokenizer and scheduler attributes from the original pipe
     coreml_pipe_kwargs = {
-        "tokenizer": pytorch_pipe.tokenizer,
-        "scheduler": pytorch_pipe.scheduler if scheduler_override is None else scheduler_override,
-        "feature_extractor": pytorch_pipe.feature_extractor,
+        "tokenizer": resources.tokenizer,
+        "scheduler": resources.scheduler if scheduler_override is None else scheduler_override,
+        "feature_extractor": resources.feature_extractor,
     }
 
     model_names_to_load = ["text_encoder", "unet", "vae_decoder"]
-    if getattr(pytorch_pipe, "safety_checker", None) is not None:
+    if resources.requires_safety_checker:
         model_names_to_load.append("safety_checker")
     else:
         # logger.warning(
@@ -418,31 +687,73 @@ def get_coreml_pipe(pytorch_pipe,
         #     "Core ML pipeline will mirror this behavior.")
         coreml_pipe_kwargs["safety_checker"] = None
 
-    if delete_original_pipe:
-        del pytorch_pipe
-        gc.collect()
-        logger.info("Removed PyTorch pipe to reduce peak memory consumption")
+    # The preview decoder is optional and only loaded if it was exported
+    if os.path.exists(_get_mlpackage_path("preview_decoder", mlpackages_dir, model_version)):
+        model_names_to_load.append("preview_decoder")
 
     # Load Core ML models
     logger.info(f"Loading Core ML models in memory from {mlpackages_dir}")
-    coreml_pipe_kwargs.update({
-        model_name: _load_mlpackage(
-            model_name,
+    load_timings = {}
+    start = time.time()
+    coreml_pipe_kwargs.update(
+        _load_mlpackages(
+            model_names_to_load,
             mlpackages_dir,
             model_version,
             compute_unit,
-        )
-        for model_name in model_names_to_load
-    })
+            max_workers=max_load_workers,
+            lazy_submodule_names=lazy_models,
+            load_timings=load_timings,
+            model_cache=model_cache,
+        ))
     logger.info("Done.")
 
     logger.info("Initializing Core ML pipe for image generation")
     coreml_pipe = CoreMLStableDiffusionPipeline(**coreml_pipe_kwargs)
+    coreml_pipe.model_version = model_version
+    # Seconds every model took to load, lazy models are added once loaded
+    coreml_pipe.load_timings = load_timings
+    coreml_pipe.load_seconds = time.time() - start
     logger.info("Done.")
 
     return coreml_pipe
 
 
+def get_model_cache(args):
+    """ Returns the `ModelCache` in `args.model_cache_dir`, or None if not specified
+    """
+    cache_dir = getattr(args, "model_cache_dir", None)
+    if cache_dir is None:
+        return None
+    return ModelCache(cache_dir, max_bytes=int(getattr(args, "model_cache_size", 10) * 2**30))
+
+
+def load_pipeline_resources(args):
+    """ Loads the `PipelineResources` saved next to the mlpackages of `args.i`. Falls back
+    to instantiating the PyTorch pipeline (which downloads and loads all of its weights)
+    if they were not saved
+    """
+    resources_dir = get_resources_path(args.i, args.model_version)
+    if os.path.exists(resources_dir):
+        logger.info(f"Loading pipeline resources from {resources_dir}")
+        return PipelineResources.load(resources_dir)
+
+    logger.warning(
+        f"No pipeline resources found at {resources_dir}, initializing the PyTorch pipe "
+        "instead. Run `python -m python_coreml_stable_diffusion.pipeline_resources -i "
+        f"{args.i} --model-version {args.model_version}` once to load the models offline")
+    from diffusers import StableDiffusionPipeline
+    pytorch_pipe = StableDiffusionPipeline.from_pretrained(args.model_version,
+                                                           use_auth_token=True)
+    resources = PipelineResources.from_pipe(pytorch_pipe)
+
+    del pytorch_pipe
+    gc.collect()
+    logger.info("Removed PyTorch pipe to reduce peak memory consumption")
+
+    return resources
+
+
 def get_image_path(args, **override_kwargs):
     """ mkdir output folder and encode metadata in the filename
     """
@@ -464,21 +775,20 @@ def main(args):
     logger.info(f"Setting random seed to {args.seed}")
     np.random.seed(args.seed)
 
-    logger.info("Initializing PyTorch pipe for reference configuration")
-    from diffusers import StableDiffusionPipeline
-    pytorch_pipe = StableDiffusionPipeline.from_pretrained(args.model_version,
-                                                           use_auth_token=True)
+    resources = load_pipeline_resources(args)
 
-    user_specified_scheduler = None
-    if args.scheduler is not None:
-        user_specified_scheduler = SCHEDULER_MAP[
-            args.scheduler].from_config(pytorch_pipe.scheduler.config)
+    user_specified_scheduler = get_scheduler(resources.scheduler,
+                                             args.scheduler,
+                                             getattr(args, "scheduler_backend", "numpy"))
 
-    coreml_pipe = get_coreml_pipe(pytorch_pipe=pytorch_pipe,
-                                  mlpackages_dir=args.i,
-                                  model_version=args.model_version,
-                                  compute_unit=args.compute_unit,
-                                  scheduler_override=user_specified_scheduler)
+    coreml_pipe = get_coreml_pipe_from_resources(resources=resources,
+                                                 mlpackages_dir=args.i,
+                                                 model_version=args.model_version,
+                                                 compute_unit=args.compute_unit,
+                                                 scheduler_override=user_specified_scheduler,
+                                                 max_load_workers=getattr(args, "load_workers", None),
+                                                 lazy_models=getattr(args, "lazy_models", ()),
+                                                 model_cache=get_model_cache(args))
 
     logger.info("Beginning image generation.")
     image = coreml_pipe(
@@ -536,6 +846,12 @@ def parse_args():
         default=None,
         help=("The scheduler to use for running the reverse diffusion process. "
              "If not specified, the default scheduler from the diffusers pipeline is utilized"))
+    parser.add_argument(
+        "--scheduler-backend",
+        choices=("numpy", "torch"),
+        default="numpy",
+        help=("Whether the scheduler step runs on NumPy arrays directly or converts to and from "
+              "torch tensors using the diffusers scheduler on every step"))
     parser.add_argument(
         "--num-inference-steps",
         default=50,
@@ -546,6 +862,65 @@ def parse_args():
         default=7.5,
         type=float,
         help="Controls the influence of the text prompt on sampling process (0=random images)")
+    parser.add_argument(
+        "--preview",
+        choices=("latent", "decoder"),
+        default="latent",
+        help=("How intermediate steps are previewed. `latent` projects the latents to RGB (cheap, approximate), "
+              "`decoder` runs the preview decoder (if exported, the VAE decoder otherwise) on every step"))
+    parser.add_argument(
+        "--preview-budget",
+        default=None,
+        type=float,
+        help=("If specified, previews are scheduled adaptively to take at most this fraction (0-1) "
+              "of the generation time. Otherwise every step is previewed"))
+    parser.add_argument(
+        "--history-format",
+        choices=("gif", "png"),
+        default="gif",
+        help="The animation format generation history is saved in. `png` saves a lossless animated PNG")
+    parser.add_argument(
+        "--history-dir",
+        default=None,
+        help=("If specified, the latents of the generation history are kept in a memory-mapped file "
+              "in this directory instead of in memory"))
+    parser.add_argument(
+        "--embedding-cache-size",
+        type=int,
+        default=64,
+        help="Size (MB) of the in-memory cache of prompt embeddings")
+    parser.add_argument(
+        "--embedding-cache-dir",
+        default=None,
+        help="If specified, prompt embeddings are also cached in this directory and reused across runs")
+    parser.add_argument(
+        "--png-compress-level",
+        type=int,
+        choices=range(10),
+        default=6,
+        help="zlib compression level (0-9) of saved PNG images. Lower levels save faster but produce larger files")
+    parser.add_argument(
+        "--load-workers",
+        type=int,
+        default=None,
+        help="Number of Core ML models loaded concurrently. Defaults to loading all of them at once")
+    parser.add_argument(
+        "--lazy-models",
+        nargs="*",
+        choices=LAZY_MODEL_NAMES,
+        default=[],
+        help=("Models loaded in the background and only waited for when first used, which "
+              "shortens the time to the first image"))
+    parser.add_argument(
+        "--model-cache-dir",
+        default=None,
+        help=("If specified, compiled Core ML models are cached in this directory so that only "
+              "the first load compiles them"))
+    parser.add_argument(
+        "--model-cache-size",
+        type=float,
+        default=10,
+        help="Size (GB) of the compiled model cache, least recently used models are evicted beyond it")
     parser.add_argument(
         "--mock",
         default=False,
@@ -567,22 +942,25 @@ if __name__ == "__main__":
 
 
 def load_model(args):
-    logger.info("Initializing PyTorch pipe for reference configuration")
-    from diffusers import StableDiffusionPipeline
-    pytorch_pipe = StableDiffusionPipeline.from_pretrained(args.model_version,
-                                                           use_auth_token=True)
+    resources = load_pipeline_resources(args)
 
-    user_specified_scheduler = None
-    if args.scheduler is not None:
-        user_specified_scheduler = SCHEDULER_MAP[
-            args.scheduler].from_config(pytorch_pipe.scheduler.config)
+    user_specified_scheduler = get_scheduler(resources.scheduler,
+                                             args.scheduler,
+                                             getattr(args, "scheduler_backend", "numpy"))
 
     logger.info("Loading Core ML pipe")
-    coreml_pipe = get_coreml_pipe(pytorch_pipe=pytorch_pipe,
-                                  mlpackages_dir=args.i,
-                                  model_version=args.model_version,
-                                  compute_unit=args.compute_unit,
-                                  scheduler_override=user_specified_scheduler)
+    coreml_pipe = get_coreml_pipe_from_resources(resources=resources,
+                                                 mlpackages_dir=args.i,
+                                                 model_version=args.model_version,
+                                                 compute_unit=args.compute_unit,
+                                                 scheduler_override=user_specified_scheduler,
+                                                 max_load_workers=getattr(args, "load_workers", None),
+                                                 lazy_models=getattr(args, "lazy_models", ()),
+                                                 model_cache=get_model_cache(args))
+
+    coreml_pipe.embedding_cache = EmbeddingCache(
+        max_bytes=getattr(args, "embedding_cache_size", 64) * 2**20,
+        cache_dir=getattr(args, "embedding_cache_dir", None))
 
     return coreml_pipe
 
@@ -591,6 +969,8 @@ class ModelMock(CoreMLStableDiffusionPipeline):
     def __init__(self) -> None:
         self.height = 512
         self.width = 512
+        self.preview_decoder = None
+        self.batch_size = 1
 
     def __call__(self,
         prompt,
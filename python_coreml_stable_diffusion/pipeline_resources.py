@@ -0,0 +1,129 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import argparse
+import logging
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+import json
+import os
+import shutil
+
+# The small components of a diffusers pipeline needed next to the Core ML models, saved
+# in the diffusers layout (one subfolder per component and a `model_index.json`)
+RESOURCE_SUBFOLDERS = ("tokenizer", "scheduler", "feature_extractor")
+MODEL_INDEX_FILENAME = "model_index.json"
+
+
+def get_resources_path(mlpackages_dir, model_version):
+    """ Returns the resources directory of `model_version` next to its mlpackages
+    """
+    fname = f"Stable_Diffusion_version_{model_version}_resources".replace("/", "_")
+    return os.path.join(mlpackages_dir, fname)
+
+
+class PipelineResources:
+    """ The tokenizer, scheduler and feature extractor of a diffusers pipeline and
+    whether it has a safety checker, without any of its PyTorch models
+    """
+
+    def __init__(self, tokenizer, scheduler, feature_extractor, requires_safety_checker):
+        self.tokenizer = tokenizer
+        self.scheduler = scheduler
+        self.feature_extractor = feature_extractor
+        self.requires_safety_checker = requires_safety_checker
+
+    @classmethod
+    def from_pipe(cls, pytorch_pipe):
+        return cls(
+            tokenizer=pytorch_pipe.tokenizer,
+            scheduler=pytorch_pipe.scheduler,
+            feature_extractor=pytorch_pipe.feature_extractor,
+            requires_safety_checker=getattr(pytorch_pipe, "safety_checker", None) is not None,
+        )
+
+    @classmethod
+    def load(cls, resources_dir):
+        """ Loads the resources saved by `save` or `download_pipeline_resources`
+        """
+        import diffusers
+        from transformers import CLIPFeatureExtractor, CLIPTokenizer
+
+        with open(os.path.join(resources_dir, MODEL_INDEX_FILENAME)) as f:
+            model_index = json.load(f)
+
+        scheduler_dir = os.path.join(resources_dir, "scheduler")
+        with open(os.path.join(scheduler_dir, "scheduler_config.json")) as f:
+            scheduler_class = getattr(diffusers, json.load(f)["_class_name"])
+
+        safety_checker = model_index.get("safety_checker") or [None, None]
+        return cls(
+            tokenizer=CLIPTokenizer.from_pretrained(os.path.join(resources_dir, "tokenizer")),
+            scheduler=scheduler_class.from_pretrained(scheduler_dir),
+            feature_extractor=CLIPFeatureExtractor.from_pretrained(
+                os.path.join(resources_dir, "feature_extractor")),
+            requires_safety_checker=safety_checker[0] is not None,
+        )
+
+    def save(self, resources_dir):
+        os.makedirs(resources_dir, exist_ok=True)
+        self.tokenizer.save_pretrained(os.path.join(resources_dir, "tokenizer"))
+        self.scheduler.save_pretrained(os.path.join(resources_dir, "scheduler"))
+        self.feature_extractor.save_pretrained(os.path.join(resources_dir, "feature_extractor"))
+
+        # Only the entries read by `load`
+        model_index = {
+            "safety_checker": ["stable_diffusion", "StableDiffusionSafetyChecker"]
+            if self.requires_safety_checker else [None, None],
+        }
+        with open(os.path.join(resources_dir, MODEL_INDEX_FILENAME), "w") as f:
+            json.dump(model_index, f, indent=2)
+
+
+def download_pipeline_resources(model_version, resources_dir):
+    """ Downloads the resources of `model_version` from the Hugging Face Hub without
+    its model weights
+    """
+    from huggingface_hub import snapshot_download
+
+    snapshot_dir = snapshot_download(
+        model_version,
+        allow_patterns=[MODEL_INDEX_FILENAME] + [f"{name}/*" for name in RESOURCE_SUBFOLDERS],
+        use_auth_token=True,
+    )
+
+    os.makedirs(resources_dir, exist_ok=True)
+    shutil.copy(os.path.join(snapshot_dir, MODEL_INDEX_FILENAME), resources_dir)
+    for name in RESOURCE_SUBFOLDERS:
+        shutil.copytree(os.path.join(snapshot_dir, name),
+                        os.path.join(resources_dir, name),
+                        dirs_exist_ok=True)
+    return resources_dir
+
+
+def main(args):
+    resources_dir = get_resources_path(args.i, args.model_version)
+    logger.info(f"Downloading the {args.model_version} resources to {resources_dir}")
+    download_pipeline_resources(args.model_version, resources_dir)
+    logger.info("Done.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        required=True,
+        help=("Path to the directory with the .mlpackage files, the resources are saved next "
+              "to them"))
+    parser.add_argument(
+        "--model-version",
+        default="stabilityai/stable-diffusion-2-base",
+        help="The pre-trained model checkpoint the .mlpackage files were converted from")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,58 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+from threading import Lock
+
+
+class AdaptivePreviewCadence:
+    """ Schedules step previews so that they take at most `budget` (a fraction in (0, 1))
+    of the total generation time.
+
+    UNet step time and preview cost are tracked with exponentially weighted moving
+    averages. Every denoising step earns preview time in proportion to its duration and
+    a preview is scheduled once enough time was earned to pay for its expected cost.
+    The final step is always previewed.
+    """
+
+    def __init__(self, budget=0.1, smoothing=0.3):
+        if not 0 < budget < 1:
+            raise ValueError(f"`budget` has to be in range (0, 1) but is {budget}")
+
+        self.budget = budget
+        self.smoothing = smoothing
+
+        self.step_time = None
+        self.preview_time = None
+
+        # Preview time earned but not spent yet (seconds)
+        self.credit = 0.0
+        self.lock = Lock()
+
+    def _ewma(self, average, value):
+        if average is None:
+            return value
+        return self.smoothing * value + (1 - self.smoothing) * average
+
+    def record_step(self, seconds):
+        with self.lock:
+            self.step_time = self._ewma(self.step_time, seconds)
+            # previews / (steps + previews) <= budget
+            self.credit += seconds * self.budget / (1 - self.budget)
+
+    def record_preview(self, seconds):
+        with self.lock:
+            self.preview_time = self._ewma(self.preview_time, seconds)
+            self.credit -= seconds
+
+    def should_preview(self, step, num_steps):
+        if step == num_steps - 1:
+            return True
+
+        with self.lock:
+            # The first preview is needed to measure its cost
+            if self.preview_time is None:
+                return True
+
+            return self.credit >= self.preview_time
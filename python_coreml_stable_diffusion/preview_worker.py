@@ -0,0 +1,98 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+from threading import Condition, Thread
+import time
+
+
+class PreviewWorker:
+    """ Runs the step callback of the denoising loop on a separate thread.
+
+    The loop hands off its latents through a single slot and moves on immediately.
+    If the callback is still busy with a previous step, the latents waiting in the
+    slot are replaced, i.e. intermediate frames are dropped. The latents of the last
+    submitted step are always delivered unless the worker is cancelled.
+    """
+
+    def __init__(self, callback, cadence=None):
+        self.callback = callback
+        # Optional `AdaptivePreviewCadence` which is told about the cost of every callback
+        self.cadence = cadence
+
+        self.condition = Condition()
+        self.pending = None
+        self.cancelled = False
+        self.closed = False
+
+        self.delivered_frames = 0
+        self.dropped_frames = 0
+
+        self.thread = Thread(target=self._run, name="PreviewWorker", daemon=True)
+        self.thread.start()
+
+    def submit(self, step, timestep, latents):
+        """ Non-blocking hand-off of the latents of a denoising step
+        """
+        with self.condition:
+            if self.cancelled:
+                return
+
+            if self.pending is not None:
+                self.dropped_frames += 1
+
+            # The loop may reuse its buffers, so the worker gets its own copy
+            self.pending = (step, timestep, latents.copy())
+            self.condition.notify()
+
+    def cancel(self):
+        """ Drops the pending frame and ignores all frames submitted afterwards
+        """
+        with self.condition:
+            self.cancelled = True
+
+            if self.pending is not None:
+                self.dropped_frames += 1
+                self.pending = None
+
+            self.condition.notify()
+
+    def close(self):
+        """ Waits until the pending frame (if any) is delivered and stops the thread
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+        self.thread.join()
+
+        logger.debug(
+            f"Preview worker delivered {self.delivered_frames} frames, dropped {self.dropped_frames}")
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+
+                if self.pending is None:
+                    return
+
+                step, timestep, latents = self.pending
+                self.pending = None
+
+            self.delivered_frames += 1
+
+            start = time.perf_counter()
+            result = self.callback(step, timestep, latents)
+            if self.cadence is not None:
+                self.cadence.record_preview(time.perf_counter() - start)
+
+            if result is False:
+                self.cancel()
@@ -0,0 +1,493 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import argparse
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import logging
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+from queue import Full, Queue
+from threading import Condition, Lock, Thread
+import time
+import uuid
+
+from python_coreml_stable_diffusion import pipeline
+from python_coreml_stable_diffusion.batch import percentiles
+from python_coreml_stable_diffusion.continuous_batching import ContinuousBatcher, DenoisingRequest
+from python_coreml_stable_diffusion.coreml_model import get_available_compute_units
+
+# Request keys passed to the pipeline and their defaults
+JOB_PARAMETERS = {
+    "negative_prompt": None,
+    "seed": None,
+    "num_inference_steps": 50,
+    "guidance_scale": 7.5,
+}
+
+TERMINAL_STATUSES = ("done", "failed", "cancelled")
+
+
+class Job:
+    """ A generation request and its progress events.
+
+    Events are kept for the lifetime of the job, so clients that connect late replay
+    them from the start
+    """
+
+    def __init__(self, prompt, **parameters):
+        self.id = uuid.uuid4().hex
+        self.prompt = prompt
+        self.parameters = parameters
+
+        self.status = "queued"
+        self.step = 0
+        self.error = None
+        self.image = None
+        self.cancel_requested = False
+
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        self.events = []
+        self.condition = Condition()
+
+    def publish(self, event, status=None, **data):
+        """ Appends an event, and changes the status along with it if `status` is specified
+        """
+        with self.condition:
+            if status is not None:
+                self.status = status
+            self.events.append(dict(data, event=event))
+            self.condition.notify_all()
+
+    def wait_for_events(self, start, timeout=None):
+        """ Returns the events from index `start` on, blocking until there is at least one
+        or the job is finished
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: len(self.events) > start or self.status in TERMINAL_STATUSES, timeout)
+            return self.events[start:]
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "prompt": self.prompt,
+            "parameters": self.parameters,
+            "step": self.step,
+            "error": self.error,
+            "has_image": self.image is not None,
+            "queue_wait": None if self.started_at is None else self.started_at - self.submitted_at,
+            "latency": None if self.finished_at is None or self.started_at is None
+            else self.finished_at - self.started_at,
+        }
+
+
+class GenerationService:
+    """ Runs jobs one at a time on a single loaded pipeline.
+
+    Jobs wait in a queue of at most `max_queue` jobs, `submit` raises `queue.Full` instead
+    of admitting more. Finished jobs are kept for result retrieval up to `max_finished`.
+
+    With `continuous_batching`, the denoising steps of up to `coreml_pipe.batch_size`
+    running jobs share unet calls (see `ContinuousBatcher`)
+    """
+
+    def __init__(self,
+                 coreml_pipe,
+                 max_queue=8,
+                 max_finished=256,
+                 compress_level=6,
+                 continuous_batching=False):
+        self.coreml_pipe = coreml_pipe
+        self.batcher = ContinuousBatcher(coreml_pipe) if continuous_batching else None
+        self.compress_level = compress_level
+        self.max_finished = max_finished
+
+        self.queue = Queue(maxsize=max_queue)
+        self.jobs = OrderedDict()
+        self.lock = Lock()
+
+        self.queue_waits = []
+        self.latencies = []
+        self.counts = {status: 0 for status in TERMINAL_STATUSES}
+
+        self.thread = Thread(target=self._run, name="GenerationService", daemon=True)
+        self.thread.start()
+
+    def submit(self, prompt, **parameters):
+        job = Job(prompt, **dict(JOB_PARAMETERS, **parameters))
+        with self.lock:
+            job.publish("queued", position=self.queue.qsize() + 1)
+            self.queue.put_nowait(job)
+            self.jobs[job.id] = job
+            self._evict_finished()
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """ Cancels a queued job, or a running job at its next step
+        """
+        job = self.get(job_id)
+        if job is not None and job.status not in TERMINAL_STATUSES:
+            job.cancel_requested = True
+        return job
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.batcher is not None:
+            self.batcher.close()
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "queue_capacity": self.queue.maxsize,
+                "jobs": dict(self.counts),
+                "queue_wait": percentiles(self.queue_waits) if self.queue_waits else None,
+                "latency": percentiles(self.latencies) if self.latencies else None,
+                "batching": None if self.batcher is None else self.batcher.stats(),
+            }
+
+    def _evict_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in TERMINAL_STATUSES]
+        for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self.jobs[job_id]
+
+    def _finish(self, job, status, **data):
+        job.finished_at = time.time()
+        with self.lock:
+            self.counts[status] += 1
+            if status == "done":
+                self.latencies.append(job.finished_at - job.started_at)
+        job.publish(status, status=status, **data)
+
+    def _start(self, job):
+        job.started_at = time.time()
+        with self.lock:
+            self.queue_waits.append(job.started_at - job.submitted_at)
+        job.publish("running", status="running", queue_wait=job.started_at - job.submitted_at)
+
+    def _callback(self, job):
+        """ Returns the pipeline callback publishing the progress of `job`
+        """
+        num_inference_steps = job.parameters["num_inference_steps"]
+
+        def callback(i, t, latents):
+            job.step = i + 1
+            job.publish("progress", step=i + 1, total=num_inference_steps)
+            return not job.cancel_requested
+
+        return callback
+
+    def _complete(self, job, image, error=None):
+        if error is not None:
+            job.error = str(error)
+            self._finish(job, "failed", error=job.error)
+            return
+
+        if job.cancel_requested:
+            self._finish(job, "cancelled")
+            return
+
+        # `ModelMock` returns no images
+        if image is not None:
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG", compress_level=self.compress_level)
+            job.image = buffer.getvalue()
+        self._finish(job, "done")
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+
+            if job.cancel_requested:
+                self._finish(job, "cancelled")
+                continue
+
+            if self.batcher is not None:
+                # Blocks while the batcher has enough requests waiting to join
+                self.batcher.submit(DenoisingRequest(
+                    job.prompt,
+                    callback=self._callback(job),
+                    on_start=lambda request, job=job: self._start(job),
+                    on_done=lambda request, job=job: self._complete(job, request.image, request.error),
+                    **job.parameters))
+                continue
+
+            self._start(job)
+            try:
+                output = self.coreml_pipe(
+                    prompt=job.prompt,
+                    height=self.coreml_pipe.height,
+                    width=self.coreml_pipe.width,
+                    callback=self._callback(job),
+                    callback_steps=1,
+                    **job.parameters,
+                )
+            except Exception as e:
+                logger.exception(f"Job {job.id} failed")
+                self._complete(job, None, e)
+                continue
+
+            self._complete(job, None if output is None else output.images[0])
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """ JSON API of a `GenerationService`:
+
+    - POST /jobs: submits {"prompt": ..., "negative_prompt", "seed", "num_inference_steps",
+      "guidance_scale"}, 429 if the queue is full
+    - GET /jobs/<id>: job status
+    - DELETE /jobs/<id>: cancels the job
+    - GET /jobs/<id>/events: progress as server-sent events until the job finishes
+    - GET /jobs/<id>/result: the generated PNG image
+    - GET /metrics: queue depth, queue wait and generation latency
+    """
+
+    service = None
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status, message):
+        self._send_json(status, {"error": message})
+
+    def _route(self):
+        """ Returns the job and the sub-resource of /jobs/<id>[/<resource>] paths, or
+        sends 404 and returns None for other paths and unknown jobs
+        """
+        parts = self.path.strip("/").split("/")
+        if len(parts) not in (2, 3) or parts[0] != "jobs":
+            self._send_error(HTTPStatus.NOT_FOUND, f"Unknown path: {self.path}")
+            return None, None
+
+        job = self.service.get(parts[1])
+        if job is None:
+            self._send_error(HTTPStatus.NOT_FOUND, f"Unknown job: {parts[1]}")
+            return None, None
+        return job, parts[2] if len(parts) == 3 else ""
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self._send_error(HTTPStatus.NOT_FOUND, f"Unknown path: {self.path}")
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            prompt = request.pop("prompt")
+        except (ValueError, KeyError):
+            return self._send_error(HTTPStatus.BAD_REQUEST, "Expected a JSON object with a prompt")
+
+        unknown = set(request) - set(JOB_PARAMETERS)
+        if unknown:
+            return self._send_error(HTTPStatus.BAD_REQUEST, f"Unknown parameters: {sorted(unknown)}")
+
+        try:
+            job = self.service.submit(prompt, **request)
+        except Full:
+            return self._send_error(HTTPStatus.TOO_MANY_REQUESTS, "The job queue is full")
+
+        self._send_json(HTTPStatus.ACCEPTED, job.to_dict())
+
+    def do_DELETE(self):
+        job, resource = self._route()
+        if job is None:
+            return
+        if resource != "":
+            return self._send_error(HTTPStatus.METHOD_NOT_ALLOWED, f"Cannot delete {self.path}")
+
+        self.service.cancel(job.id)
+        self._send_json(HTTPStatus.OK, job.to_dict())
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/metrics":
+            return self._send_json(HTTPStatus.OK, self.service.metrics())
+
+        job, resource = self._route()
+        if job is None:
+            return
+
+        if resource == "":
+            self._send_json(HTTPStatus.OK, job.to_dict())
+        elif resource == "events":
+            self._stream_events(job)
+        elif resource == "result":
+            if job.image is None:
+                return self._send_error(HTTPStatus.NOT_FOUND, f"Job {job.id} has no image ({job.status})")
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(job.image)))
+            self.end_headers()
+            self.wfile.write(job.image)
+        else:
+            self._send_error(HTTPStatus.NOT_FOUND, f"Unknown path: {self.path}")
+
+    def _stream_events(self, job):
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        sent = 0
+        while True:
+            events = job.wait_for_events(sent, timeout=15)
+            try:
+                if len(events) == 0:
+                    # Keeps the connection alive while the job waits in the queue
+                    self.wfile.write(b": keep-alive\n\n")
+                for event in events:
+                    self.wfile.write(
+                        f"event: {event['event']}\ndata: {json.dumps(event)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            sent += len(events)
+
+            if job.status in TERMINAL_STATUSES and sent == len(job.events):
+                return
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def make_server(service, host="127.0.0.1", port=8000):
+    """ Returns an HTTP server for `service`, start it with `serve_forever`
+    """
+    handler = type("BoundRequestHandler", (RequestHandler, ), {"service": service})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(args):
+    if args.mock and args.continuous_batching:
+        raise ValueError("`--continuous-batching` requires an actual model, it can not be mocked")
+
+    if args.mock:
+        logger.info("Using mock model")
+        coreml_pipe = pipeline.ModelMock()
+    else:
+        coreml_pipe = pipeline.load_model(args)
+
+    service = GenerationService(coreml_pipe,
+                                max_queue=args.max_queue,
+                                compress_level=args.png_compress_level,
+                                continuous_batching=args.continuous_batching)
+    server = make_server(service, args.host, args.port)
+    logger.info(f"Serving on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument(
+        "--max-queue",
+        default=8,
+        type=int,
+        help="Maximum number of queued jobs, further submissions are rejected with 429")
+    parser.add_argument(
+        "--continuous-batching",
+        default=False,
+        action="store_true",
+        help=("If true, the denoising steps of concurrent jobs share batched unet calls. "
+              "Works best with models exported with `torch2coreml --batch-size` > 1"))
+    parser.add_argument(
+        "-i",
+        default="models/coreml-stable-diffusion-2-base_original_packages",
+        help=("Path to input directory with the .mlpackage files generated by "
+              "python_coreml_stable_diffusion.torch2coreml"))
+    parser.add_argument(
+        "--model-version",
+        default="stabilityai/stable-diffusion-2-base",
+        help="The pre-trained model checkpoint and configuration to restore")
+    parser.add_argument(
+        "--compute-unit",
+        choices=get_available_compute_units(),
+        default="ALL",
+        help="The compute units to be used when executing Core ML models")
+    parser.add_argument(
+        "--scheduler",
+        choices=tuple(pipeline.SCHEDULER_MAP.keys()),
+        default=None,
+        help="If not specified, the default scheduler from the diffusers pipeline is utilized")
+    parser.add_argument(
+        "--scheduler-backend",
+        choices=("numpy", "torch"),
+        default="numpy")
+    parser.add_argument(
+        "--embedding-cache-size",
+        default=64,
+        type=int,
+        help="Size (MB) of the in-memory cache of prompt embeddings")
+    parser.add_argument(
+        "--embedding-cache-dir",
+        default=None,
+        help="Directory where prompt embeddings are also cached across restarts")
+    parser.add_argument(
+        "--load-workers",
+        type=int,
+        default=None,
+        help="Number of Core ML models loaded concurrently. Defaults to loading all of them at once")
+    parser.add_argument(
+        "--lazy-models",
+        nargs="*",
+        choices=pipeline.LAZY_MODEL_NAMES,
+        default=[],
+        help="Models loaded in the background and only waited for when first used")
+    parser.add_argument(
+        "--model-cache-dir",
+        default=None,
+        help="If specified, compiled Core ML models are cached in this directory")
+    parser.add_argument(
+        "--model-cache-size",
+        type=float,
+        default=10,
+        help="Size (GB) of the compiled model cache")
+    parser.add_argument(
+        "--png-compress-level",
+        type=int,
+        choices=range(10),
+        default=6,
+        help="zlib compression level (0-9) of generated PNG images")
+    parser.add_argument(
+        "--mock",
+        default=False,
+        action="store_true",
+        help="If true, the model will be mocked and the service will run without an actual model.")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,221 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import logging
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+import numpy as np
+from queue import Queue
+from threading import Event, Thread
+import time
+
+STAGES = ("encode", "denoise", "decode", "save")
+
+
+class StagedJob:
+    """ The arguments of one `CoreMLStableDiffusionPipeline.__call__` and its outputs.
+
+    `scheduler` overrides the pipe's scheduler for this job. `images` holds the PIL
+    images once decoded and `result` what `save_fn` returned for them
+    """
+
+    def __init__(self,
+                 prompt,
+                 negative_prompt=None,
+                 num_images_per_prompt=1,
+                 seed=None,
+                 num_inference_steps=50,
+                 guidance_scale=7.5,
+                 eta=0.0,
+                 scheduler=None,
+                 callback=None,
+                 callback_steps=1,
+                 context=None):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.num_images_per_prompt = num_images_per_prompt
+        self.seed = seed
+        self.num_inference_steps = num_inference_steps
+        self.guidance_scale = guidance_scale
+        self.eta = eta
+        self.scheduler = scheduler
+        self.callback = callback
+        self.callback_steps = callback_steps
+        # Anything the caller wants to find back in `save_fn`
+        self.context = context
+
+        self.text_embeddings = None
+        self.latents = None
+        self.images = None
+        self.has_nsfw_concept = None
+        self.result = None
+        self.error = None
+        # Seconds spent in every stage
+        self.stage_timings = {}
+        self.done = Event()
+
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError("Job did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _Stage:
+
+    def __init__(self, name, fn, inbox, outbox):
+        self.name = name
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.busy_seconds = 0.
+        self.num_jobs = 0
+
+        self.thread = Thread(target=self._run, name=f"Stage-{name}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.inbox.get()
+            if job is None:
+                if self.outbox is not None:
+                    self.outbox.put(None)
+                return
+
+            if job.error is None:
+                start = time.perf_counter()
+                try:
+                    self.fn(job)
+                except Exception as e:
+                    logger.exception(f"Stage {self.name} failed")
+                    job.error = e
+                seconds = time.perf_counter() - start
+                job.stage_timings[self.name] = seconds
+                self.busy_seconds += seconds
+                self.num_jobs += 1
+
+            if self.outbox is not None:
+                self.outbox.put(job)
+            else:
+                job.done.set()
+
+
+class StagedPipeline:
+    """ Runs jobs through the stages of `CoreMLStableDiffusionPipeline.__call__` on
+    separate threads connected by queues of `queue_size` jobs:
+
+    - encode: tokenization, text encoding and the initial latents
+    - denoise: the unet loop
+    - decode: vae decoding, the safety checker and PIL conversion
+    - save: `save_fn(job)`, whose return value becomes `job.result`
+
+    While a job is in the unet loop, the next job is encoded and the previous one is
+    decoded and saved, so for multi-image workloads the throughput is bound by the
+    slowest stage instead of the sum of all stages. `utilization` reports how busy every
+    stage was to find that bottleneck.
+
+    Only the denoise stage uses the pipe's scheduler, which it sets to `job.scheduler`
+    (if specified) for every job
+    """
+
+    def __init__(self, coreml_pipe, save_fn=None, queue_size=1):
+        self.coreml_pipe = coreml_pipe
+        self.default_scheduler = coreml_pipe.scheduler
+        self.save_fn = save_fn
+
+        self.queues = [Queue(maxsize=queue_size) for _ in STAGES]
+        stage_fns = (self._encode, self._denoise, self._decode, self._save)
+        self.stages = [
+            _Stage(name, fn, self.queues[i], self.queues[i + 1] if i + 1 < len(STAGES) else None)
+            for i, (name, fn) in enumerate(zip(STAGES, stage_fns))
+        ]
+
+        self.start_time = time.perf_counter()
+        self.end_time = None
+
+    def submit(self, job):
+        """ Queues `job`, blocks while the encode stage has `queue_size` jobs waiting
+        """
+        self.queues[0].put(job)
+        return job
+
+    def close(self):
+        """ Waits until all submitted jobs went through every stage
+        """
+        self.queues[0].put(None)
+        for stage in self.stages:
+            stage.thread.join()
+        self.end_time = time.perf_counter()
+
+    def utilization(self):
+        """ Returns the busy seconds, the fraction of the wall time spent busy and the
+        number of processed jobs of every stage
+        """
+        wall_seconds = (self.end_time or time.perf_counter()) - self.start_time
+        return {
+            stage.name: {
+                "busy_seconds": stage.busy_seconds,
+                "utilization": stage.busy_seconds / wall_seconds if wall_seconds > 0 else 0.,
+                "num_jobs": stage.num_jobs,
+            }
+            for stage in self.stages
+        }
+
+    def _scheduler(self, job):
+        return self.default_scheduler if job.scheduler is None else job.scheduler
+
+    def _encode(self, job):
+        pipe = self.coreml_pipe
+        pipe.check_inputs(job.prompt, pipe.height, pipe.width, job.callback_steps)
+
+        seeds = None
+        if isinstance(job.seed, (list, tuple)):
+            seeds = job.seed
+        elif job.seed:
+            # Only this stage draws the initial latents
+            np.random.seed(job.seed)
+
+        batch_size = 1 if isinstance(job.prompt, str) else len(job.prompt)
+        job.text_embeddings = pipe._encode_prompt(
+            job.prompt,
+            job.num_images_per_prompt,
+            job.guidance_scale > 1.0,
+            job.negative_prompt,
+        )
+        job.latents = pipe.prepare_latents(
+            batch_size * job.num_images_per_prompt,
+            pipe.unet.in_channels,
+            pipe.height,
+            pipe.width,
+            seeds=seeds,
+            init_noise_sigma=self._scheduler(job).init_noise_sigma,
+        )
+
+    def _denoise(self, job):
+        pipe = self.coreml_pipe
+        pipe.scheduler = self._scheduler(job)
+        job.latents = pipe.denoise(
+            job.latents,
+            job.text_embeddings,
+            job.num_inference_steps,
+            job.guidance_scale,
+            eta=job.eta,
+            callback=job.callback,
+            callback_steps=job.callback_steps,
+        )
+
+    def _decode(self, job):
+        pipe = self.coreml_pipe
+        images = pipe.decode_latents(job.latents)
+        images, job.has_nsfw_concept = pipe.run_safety_checker(images)
+        job.images = pipe.numpy_to_pil(images)
+
+    def _save(self, job):
+        if self.save_fn is not None:
+            job.result = self.save_fn(job)
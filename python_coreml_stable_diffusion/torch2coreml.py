@@ -21,6 +21,7 @@ logger.setLevel(logging.INFO)
 import numpy as np
 import os
 from python_coreml_stable_diffusion import chunk_mlprogram
+from python_coreml_stable_diffusion.pipeline_resources import PipelineResources, get_resources_path
 import requests
 import shutil
 import time
@@ -140,8 +141,8 @@ def _convert_to_coreml(submodule_name, torchscript_module, sample_inputs,
 
 def quantize_weights_to_8bits(args):
     for model_name in [
-            "text_encoder", "vae_decoder", "unet", "unet_chunk1",
-            "unet_chunk2", "safety_checker"
+            "text_encoder", "vae_decoder", "preview_decoder", "unet",
+            "unet_chunk1", "unet_chunk2", "safety_checker"
     ]:
         out_path = _get_out_path(args, model_name)
         if os.path.exists(out_path):
@@ -385,7 +386,7 @@ def convert_vae_decoder(pipe, args):
             "Please use convert_vae_decoder() before convert_unet()")
 
     z_shape = (
-        1,  # B
+        args.batch_size,  # B
         pipe.vae.latent_channels,  # C
         args.latent_h or pipe.unet.config.sample_size,  # H
         args.latent_w or pipe.unet.config.sample_size,  # w
@@ -453,6 +454,142 @@ def convert_vae_decoder(pipe, args):
     gc.collect()
 
 
+class TinyVAEDecoder(nn.Module):
+    """ Lightweight approximation of the Stable Diffusion VAE decoder with a much
+    smaller channel count. The layout follows the distilled TAESD decoder
+    (https://github.com/madebyollin/taesd) so that its weights can be loaded as is
+    """
+
+    class Clamp(nn.Module):
+
+        def forward(self, x):
+            return torch.tanh(x / 3) * 3
+
+    class Block(nn.Module):
+
+        def __init__(self, n_in, n_out):
+            super().__init__()
+            self.conv = nn.Sequential(
+                nn.Conv2d(n_in, n_out, 3, padding=1), nn.ReLU(),
+                nn.Conv2d(n_out, n_out, 3, padding=1), nn.ReLU(),
+                nn.Conv2d(n_out, n_out, 3, padding=1))
+            self.skip = nn.Conv2d(
+                n_in, n_out, 1, bias=False) if n_in != n_out else nn.Identity()
+            self.fuse = nn.ReLU()
+
+        def forward(self, x):
+            return self.fuse(self.conv(x) + self.skip(x))
+
+    def __init__(self, latent_channels=4, channels=64, scaling_factor=0.18215):
+        super().__init__()
+        self.scaling_factor = scaling_factor
+
+        layers = [
+            self.Clamp(),
+            nn.Conv2d(latent_channels, channels, 3, padding=1),
+            nn.ReLU(),
+        ]
+        for _ in range(3):
+            layers += [self.Block(channels, channels) for _ in range(3)]
+            layers += [
+                nn.Upsample(scale_factor=2),
+                nn.Conv2d(channels, channels, 3, padding=1, bias=False),
+            ]
+        layers += [
+            self.Block(channels, channels),
+            nn.Conv2d(channels, 3, 3, padding=1),
+        ]
+        self.decoder = nn.Sequential(*layers)
+
+    def forward(self, z):
+        # Same contract as the `vae_decoder` model: `z` is the unscaled latent
+        # and the image is returned in range [-1, 1]
+        return self.decoder(z * self.scaling_factor) * 2 - 1
+
+
+def convert_preview_decoder(pipe, args):
+    """ Converts a lightweight approximate VAE decoder used for intermediate previews
+    """
+    out_path = _get_out_path(args, "preview_decoder")
+    if os.path.exists(out_path):
+        logger.info(
+            f"`preview_decoder` already exists at {out_path}, skipping conversion."
+        )
+        return
+
+    if args.preview_decoder_weights is None:
+        logger.warning(
+            "`--preview-decoder-weights` was not specified, skipping preview_decoder conversion. "
+            "Weights of a distilled decoder (e.g. TAESD's taesd_decoder.pth) are required.")
+        return
+
+    if not hasattr(pipe, "unet"):
+        raise RuntimeError(
+            "convert_unet() deletes pipe.unet to save RAM. "
+            "Please use convert_preview_decoder() before convert_unet()")
+
+    z_shape = (
+        1,  # B
+        pipe.vae.latent_channels,  # C
+        args.latent_h or pipe.unet.config.sample_size,  # H
+        args.latent_w or pipe.unet.config.sample_size,  # w
+    )
+
+    sample_preview_decoder_inputs = {
+        "z": torch.rand(*z_shape, dtype=torch.float16)
+    }
+
+    baseline_decoder = TinyVAEDecoder(
+        latent_channels=pipe.vae.latent_channels,
+        channels=args.preview_decoder_channels,
+    ).eval()
+    baseline_decoder.decoder.load_state_dict(
+        torch.load(args.preview_decoder_weights, map_location="cpu"))
+
+    traced_preview_decoder = torch.jit.trace(
+        baseline_decoder,
+        (sample_preview_decoder_inputs["z"].to(torch.float32), ))
+
+    coreml_preview_decoder, out_path = _convert_to_coreml(
+        "preview_decoder", traced_preview_decoder,
+        sample_preview_decoder_inputs, ["image"], args)
+
+    # Set model metadata
+    coreml_preview_decoder.author = f"Please refer to the Model Card available at huggingface.co/{args.model_version}"
+    coreml_preview_decoder.license = "OpenRAIL (https://huggingface.co/spaces/CompVis/stable-diffusion-license)"
+    coreml_preview_decoder.version = args.model_version
+    coreml_preview_decoder.short_description = \
+        "Approximate lightweight VAE decoder for previewing intermediate steps of the diffusion process. " \
+        "Not intended for the final image."
+
+    # Set the input descriptions
+    coreml_preview_decoder.input_description["z"] = \
+        "The latent embeddings from the unet model at an intermediate step of reverse diffusion"
+
+    # Set the output descriptions
+    coreml_preview_decoder.output_description[
+        "image"] = "Approximate generated image normalized to range [-1, 1]"
+
+    _save_mlpackage(coreml_preview_decoder, out_path)
+
+    logger.info(f"Saved preview_decoder into {out_path}")
+
+    # Parity check PyTorch vs CoreML
+    if args.check_output_correctness:
+        baseline_out = baseline_decoder(
+            z=sample_preview_decoder_inputs["z"].to(torch.float32)).numpy()
+        coreml_out = list(
+            coreml_preview_decoder.predict(
+                {k: v.numpy()
+                 for k, v in sample_preview_decoder_inputs.items()}).values())[0]
+        report_correctness(
+            baseline_out, coreml_out,
+            "preview_decoder baseline PyTorch to baseline CoreML")
+
+    del traced_preview_decoder, baseline_decoder, coreml_preview_decoder
+    gc.collect()
+
+
 def convert_unet(pipe, args):
     """ Converts the UNet component of Stable Diffusion
     """
@@ -480,7 +617,7 @@ def convert_unet(pipe, args):
         )
 
         # Prepare sample input shapes and values
-        batch_size = 2  # for classifier-free guidance
+        batch_size = 2 * args.batch_size  # for classifier-free guidance
         sample_shape = (
             batch_size,                    # B
             pipe.unet.config.in_channels,  # C
@@ -796,12 +933,23 @@ def main(args):
                                                    use_auth_token=True)
     logger.info("Done.")
 
+    # Save the tokenizer, scheduler and feature extractor so that the Core ML pipeline
+    # loads without instantiating the PyTorch pipeline (before conversion deletes modules)
+    resources_dir = get_resources_path(args.o, args.model_version)
+    logger.info(f"Saving pipeline resources to {resources_dir}")
+    PipelineResources.from_pipe(pipe).save(resources_dir)
+
     # Convert models
     if args.convert_vae_decoder:
         logger.info("Converting vae_decoder")
         convert_vae_decoder(pipe, args)
         logger.info("Converted vae_decoder")
 
+    if args.convert_preview_decoder:
+        logger.info("Converting preview_decoder")
+        convert_preview_decoder(pipe, args)
+        logger.info("Converted preview_decoder")
+
     if args.convert_unet:
         logger.info("Converting unet")
         convert_unet(pipe, args)
@@ -837,6 +985,23 @@ def parser_spec():
     parser.add_argument("--convert-vae-decoder", action="store_true")
     parser.add_argument("--convert-unet", action="store_true")
     parser.add_argument("--convert-safety-checker", action="store_true")
+    parser.add_argument(
+        "--convert-preview-decoder",
+        action="store_true",
+        help=
+        ("If specified, exports a lightweight approximate VAE decoder which is used for intermediate "
+         "previews and generation history. Requires `--preview-decoder-weights`"))
+    parser.add_argument(
+        "--preview-decoder-weights",
+        default=None,
+        help=
+        ("Path to the PyTorch state dict of a distilled decoder with the TAESD layout "
+         "(e.g. taesd_decoder.pth from https://github.com/madebyollin/taesd)"))
+    parser.add_argument(
+        "--preview-decoder-channels",
+        type=int,
+        default=64,
+        help="The channel count of the preview decoder, must match `--preview-decoder-weights`")
     parser.add_argument(
         "--model-version",
         default="CompVis/stable-diffusion-v1-4",
@@ -863,6 +1028,14 @@ def parser_spec():
         help=
         "The spatial resolution (number of cols) of the latent space. `Defaults to pipe.unet.config.sample_size`",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help=
+        ("The number of images generated in parallel. The unet is exported with batch size 2 * batch_size "
+         "(for classifier-free guidance) and the vae_decoder with batch_size"),
+    )
     parser.add_argument(
         "--attention-implementation",
         choices=tuple(ai
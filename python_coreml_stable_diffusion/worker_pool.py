@@ -0,0 +1,310 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+from collections import deque
+import logging
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+import multiprocessing
+import os
+from queue import Empty
+import traceback
+
+# Workers are spawned as fresh interpreters and import the pipeline (and with it torch)
+# only after pinning their thread counts, so this module keeps its imports light
+
+# Thread pool sizes read by numpy, torch and their BLAS/OpenMP runtimes at import time
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+# Loaded models take more memory than their weights on disk (compiled models, activations)
+WORKER_MEMORY_FACTOR = 1.5
+
+SUBMODULE_NAMES = ("text_encoder", "unet", "vae_decoder", "safety_checker")
+
+
+def _directory_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+def estimate_worker_memory(args):
+    """ Estimates the bytes of memory a worker takes to load the Core ML models of
+    `args.i` and `args.model_version`
+    """
+    from python_coreml_stable_diffusion.coreml_model import _get_mlpackage_path
+
+    size = 0
+    for submodule_name in SUBMODULE_NAMES:
+        path = _get_mlpackage_path(submodule_name, args.i, args.model_version)
+        if os.path.exists(path):
+            size += _directory_size(path)
+    return int(size * WORKER_MEMORY_FACTOR)
+
+
+def get_physical_memory():
+    """ Returns the bytes of physical memory, or None if it can not be determined
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def fit_workers_to_memory(num_workers, worker_memory, memory_budget):
+    """ Returns the number of workers (at least 1) whose models fit in `memory_budget`
+    """
+    if not worker_memory or not memory_budget:
+        return num_workers
+
+    max_workers = max(int(memory_budget // worker_memory), 1)
+    if num_workers > max_workers:
+        logger.warning(
+            f"{num_workers} workers need ~{num_workers * worker_memory / 2**30:.1f} GB but the "
+            f"memory budget is {memory_budget / 2**30:.1f} GB, using {max_workers} workers")
+        return max_workers
+    return num_workers
+
+
+def _worker_main(worker_id, args, load_fn, num_threads, tasks, results):
+    """ Loads a pipeline and generates the batches of jobs it receives on `tasks`
+    """
+    if num_threads is not None:
+        for var in THREAD_ENV_VARS:
+            os.environ[var] = str(num_threads)
+
+    try:
+        from python_coreml_stable_diffusion.batch import BatchRunner, image_path, manifest_entry
+
+        if load_fn is None:
+            from python_coreml_stable_diffusion.pipeline import load_model as load_fn
+        coreml_pipe = load_fn(args)
+
+        if num_threads is not None:
+            try:
+                import torch
+                torch.set_num_threads(num_threads)
+            except ImportError:
+                pass
+
+        runner = BatchRunner(coreml_pipe,
+                             args.o,
+                             scheduler_backend=getattr(args, "scheduler_backend", "numpy"),
+                             compress_level=getattr(args, "png_compress_level", 6))
+    except Exception:
+        results.put(("load_failed", worker_id, None, traceback.format_exc()))
+        return
+
+    results.put(("ready", worker_id, None, coreml_pipe.batch_size))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+
+        task_id, batch = task
+        try:
+            images, has_nsfw_concept, timings = runner.generate(batch)
+
+            entries = []
+            for job, image, nsfw in zip(batch, images, has_nsfw_concept or [None] * len(batch)):
+                path = image_path(args.o, job)
+                image.save(path, compress_level=runner.compress_level)
+                entries.append(manifest_entry(job, path, nsfw, timings))
+        except Exception:
+            results.put(("failed", worker_id, task_id, traceback.format_exc()))
+            continue
+
+        results.put(("done", worker_id, task_id, entries))
+
+
+class _Worker:
+
+    def __init__(self, worker_id, process, tasks):
+        self.id = worker_id
+        self.process = process
+        self.tasks = tasks
+        self.ready = False
+        self.task_id = None
+
+
+class WorkerPool:
+    """ Generates batch jobs on `num_workers` processes, each with its own pipeline.
+
+    Workers load their pipeline with `load_fn(args)` (`pipeline.load_model` by default)
+    and use `num_threads` threads each (the CPU count split evenly by default). The
+    number of workers is reduced so that their estimated model memory fits in
+    `memory_budget` (80% of the physical memory by default).
+
+    The coordinator hands one batch of jobs at a time to every idle worker, so when a
+    worker crashes its batch is reassigned to the others (up to `max_retries` times) and
+    the worker is restarted (up to `max_retries` times per worker)
+    """
+
+    def __init__(self,
+                 args,
+                 num_workers,
+                 load_fn=None,
+                 num_threads=None,
+                 memory_budget=None,
+                 worker_memory=None,
+                 max_retries=2):
+        if memory_budget is None:
+            physical_memory = get_physical_memory()
+            memory_budget = None if physical_memory is None else int(0.8 * physical_memory)
+        if worker_memory is None:
+            worker_memory = estimate_worker_memory(args)
+
+        self.args = args
+        self.num_workers = fit_workers_to_memory(num_workers, worker_memory, memory_budget)
+        self.load_fn = load_fn
+        self.num_threads = num_threads or max((os.cpu_count() or 1) // self.num_workers, 1)
+        self.max_retries = max_retries
+
+        self.context = multiprocessing.get_context("spawn")
+        self.results = self.context.Queue()
+        self.workers = {}
+        self.next_worker_id = 0
+        self.num_restarts = 0
+
+    def _start_worker(self):
+        worker_id = self.next_worker_id
+        self.next_worker_id += 1
+
+        tasks = self.context.Queue()
+        process = self.context.Process(
+            target=_worker_main,
+            args=(worker_id, self.args, self.load_fn, self.num_threads, tasks, self.results),
+            name=f"Worker-{worker_id}",
+            daemon=True)
+        process.start()
+        self.workers[worker_id] = _Worker(worker_id, process, tasks)
+
+    def _wait_for_batch_size(self):
+        """ Waits until a worker has loaded its pipeline and returns its batch size
+        """
+        while True:
+            try:
+                kind, worker_id, _, payload = self.results.get(timeout=1)
+            except Empty:
+                if not any(worker.process.is_alive() for worker in self.workers.values()):
+                    raise RuntimeError("All workers exited while loading the pipeline")
+                continue
+
+            if kind == "ready":
+                self.workers[worker_id].ready = True
+                return payload
+            if kind == "load_failed":
+                raise RuntimeError(f"Worker {worker_id} failed to load the pipeline:\n{payload}")
+
+    def run(self, jobs, on_result=None):
+        """ Generates `jobs` and returns their manifest entries in job order (None for
+        jobs that failed). `on_result(entry)` is called as soon as a job is done
+        """
+        from python_coreml_stable_diffusion.batch import group_jobs
+
+        if len(jobs) == 0:
+            return []
+
+        for _ in range(self.num_workers):
+            self._start_worker()
+        logger.info(f"Started {self.num_workers} workers with {self.num_threads} threads each")
+
+        try:
+            return self._run(jobs, group_jobs(jobs, self._wait_for_batch_size()), on_result)
+        finally:
+            self.close()
+
+    def _run(self, jobs, batches, on_result):
+        indices = {job["id"]: i for i, job in enumerate(jobs)}
+        entries = [None] * len(jobs)
+
+        pending = deque(range(len(batches)))
+        attempts = [0] * len(batches)
+        remaining = len(batches)
+
+        def retry(task_id, reason):
+            nonlocal remaining
+            attempts[task_id] += 1
+            if attempts[task_id] > self.max_retries:
+                logger.error(f"Giving up on jobs {[job['id'] for job in batches[task_id]]}: {reason}")
+                remaining -= 1
+            else:
+                pending.appendleft(task_id)
+
+        while remaining > 0:
+            for worker in self.workers.values():
+                if worker.ready and worker.task_id is None and len(pending) > 0:
+                    worker.task_id = pending.popleft()
+                    worker.tasks.put((worker.task_id, batches[worker.task_id]))
+
+            try:
+                kind, worker_id, task_id, payload = self.results.get(timeout=0.5)
+            except Empty:
+                self._replace_crashed_workers(retry)
+                continue
+
+            worker = self.workers.get(worker_id)
+            if kind == "ready":
+                worker.ready = True
+            elif kind == "load_failed":
+                raise RuntimeError(f"Worker {worker_id} failed to load the pipeline:\n{payload}")
+            elif kind == "failed":
+                if worker is not None:
+                    worker.task_id = None
+                logger.error(f"Worker {worker_id} failed a batch:\n{payload}")
+                retry(task_id, "generation failed")
+            elif kind == "done":
+                if worker is not None:
+                    worker.task_id = None
+                if entries[indices[payload[0]["id"]]] is not None:
+                    # Done by a worker that was presumed crashed
+                    continue
+                remaining -= 1
+                for entry in payload:
+                    entries[indices[entry["id"]]] = entry
+                    if on_result is not None:
+                        on_result(entry)
+
+        return entries
+
+    def _replace_crashed_workers(self, retry):
+        for worker in list(self.workers.values()):
+            if worker.process.is_alive():
+                continue
+
+            logger.warning(f"Worker {worker.id} exited with code {worker.process.exitcode}")
+            del self.workers[worker.id]
+            if worker.task_id is not None:
+                retry(worker.task_id, f"worker {worker.id} crashed")
+
+            self.num_restarts += 1
+            if self.num_restarts > self.max_retries * self.num_workers:
+                raise RuntimeError(f"Workers crashed {self.num_restarts} times, giving up")
+            self._start_worker()
+
+    def close(self):
+        for worker in self.workers.values():
+            if worker.process.is_alive():
+                worker.tasks.put(None)
+        for worker in self.workers.values():
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        self.workers = {}
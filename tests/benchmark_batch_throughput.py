@@ -0,0 +1,89 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import argparse
+import json
+import logging
+import os
+import time
+
+from python_coreml_stable_diffusion import pipeline
+from python_coreml_stable_diffusion.coreml_model import get_available_compute_units
+
+logger = logging.getLogger(__name__)
+logger.setLevel("INFO")
+
+TEST_PROMPT = "a high quality photo of an astronaut riding a horse in space"
+
+
+def benchmark_throughput(coreml_pipe, args):
+    """ Generates `args.num_images` images in batches of `coreml_pipe.batch_size`
+    and returns the throughput in images per minute
+    """
+    batch_size = coreml_pipe.batch_size
+    seeds = list(range(args.seed, args.seed + args.num_images))
+
+    # Warm up
+    coreml_pipe(TEST_PROMPT,
+                num_inference_steps=2,
+                num_images_per_prompt=batch_size,
+                seed=seeds[:batch_size])
+
+    start = time.perf_counter()
+    for i in range(0, args.num_images, batch_size):
+        batch_seeds = seeds[i:i + batch_size]
+        coreml_pipe(TEST_PROMPT,
+                    num_inference_steps=args.num_inference_steps,
+                    num_images_per_prompt=len(batch_seeds),
+                    seed=batch_seeds)
+    elapsed = time.perf_counter() - start
+
+    results = {
+        "batch_size": batch_size,
+        "num_images": args.num_images,
+        "seconds": elapsed,
+        "images_per_minute": args.num_images / elapsed * 60,
+    }
+    logger.info(
+        f"batch size {batch_size}: {results['images_per_minute']:.2f} images/min "
+        f"({args.num_images} images in {elapsed:.1f} s)")
+
+    return results
+
+
+def main(args):
+    results = []
+    for mlpackages_dir in args.i:
+        args.i = mlpackages_dir
+        coreml_pipe = pipeline.load_model(args)
+        results.append(benchmark_throughput(coreml_pipe, args))
+        del coreml_pipe
+
+    json_path = os.path.join(args.o, "benchmark_batch_throughput.json")
+    logger.info(f"Saving benchmark results to {json_path}")
+    with open(json_path, "w") as f:
+        json.dump(results, f)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        required=True,
+        nargs="+",
+        help=("Paths to directories with .mlpackage files, each exported with a different "
+              "`torch2coreml --batch-size`, e.g. 1, 2 and 4"))
+    parser.add_argument("-o", default=".", help="Path to output directory")
+    parser.add_argument("--model-version", default="stabilityai/stable-diffusion-2-base")
+    parser.add_argument("--compute-unit", choices=get_available_compute_units(), default="ALL")
+    parser.add_argument("--scheduler", choices=tuple(pipeline.SCHEDULER_MAP.keys()), default=None)
+    parser.add_argument("--num-inference-steps", type=int, default=25)
+    parser.add_argument("--num-images", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=93)
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,104 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import argparse
+import json
+import logging
+import os
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np
+
+from PyQt6.QtGui import QColor, QGuiApplication, QImage, QPainter, QPixmap
+
+from frame_presenter import FramePresenter
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _ndarray_to_image_per_pixel(image):
+    """ The original conversion: one `QImage.setPixel` call per pixel
+    """
+    qt_image = QImage(image.shape[1], image.shape[0], QImage.Format.Format_RGB888)
+    for x in range(image.shape[1]):
+        for y in range(image.shape[0]):
+            qt_image.setPixel(x, y, QColor(image[y, x, 0], image[y, x, 1], image[y, x, 2]).rgb())
+
+    return qt_image
+
+
+def _paint(canvas, qt_image):
+    painter = QPainter(canvas)
+    painter.drawImage(0, 0, qt_image)
+    painter.end()
+
+
+def benchmark_per_pixel(frames, canvas):
+    start = time.perf_counter()
+    for frame in frames:
+        _paint(canvas, _ndarray_to_image_per_pixel(frame))
+    return len(frames) / (time.perf_counter() - start)
+
+
+def benchmark_presenter(frames, canvas):
+    presenter = FramePresenter(shape=frames[0].shape)
+
+    start = time.perf_counter()
+    for frame in frames:
+        presenter.submit(frame)
+        _paint(canvas, presenter.take())
+        presenter.release()
+    return len(frames) / (time.perf_counter() - start)
+
+
+def main(args):
+    app = QGuiApplication([])
+
+    canvas = QPixmap(args.size, args.size)
+    frames = [
+        (np.random.random((args.size, args.size, 3)) * 255).astype(np.uint8)
+        for _ in range(args.frames)
+    ]
+
+    logger.info(f"Presenting {args.per_pixel_frames} frames through the per-pixel conversion")
+    before = benchmark_per_pixel(frames[:args.per_pixel_frames], canvas)
+    logger.info(f"Per-pixel conversion: {before:.2f} frames per second")
+
+    logger.info(f"Presenting {args.frames} frames through FramePresenter")
+    after = benchmark_presenter(frames, canvas)
+    logger.info(f"FramePresenter: {after:.2f} frames per second ({after / before:.0f}x)")
+
+    results = {
+        "size": args.size,
+        "per_pixel_fps": before,
+        "frame_presenter_fps": after,
+    }
+
+    if args.o is not None:
+        json_path = os.path.join(args.o, "benchmark_frame_presenter.json")
+        logger.info(f"Saving benchmark results to {json_path}")
+        with open(json_path, "w") as f:
+            json.dump(results, f)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=512, help="Width and height of the preview frames")
+    parser.add_argument("--frames", type=int, default=200, help="Number of frames presented through FramePresenter")
+    parser.add_argument(
+        "--per-pixel-frames",
+        type=int,
+        default=3,
+        help="Number of frames presented through the original per-pixel conversion (slow)")
+    parser.add_argument("-o", default=None, help="If specified, results are saved as JSON into this directory")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,118 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import argparse
+import json
+import logging
+import numpy as np
+import os
+from statistics import median
+import time
+
+from python_coreml_stable_diffusion import latent_preview, pipeline, torch2coreml
+from python_coreml_stable_diffusion.coreml_model import get_available_compute_units
+
+logger = logging.getLogger(__name__)
+logger.setLevel("INFO")
+
+TEST_PROMPT = "a high quality photo of an astronaut riding a horse in space"
+
+
+def collect_latents(coreml_pipe, args):
+    """ Runs one generation and keeps the latents of every step
+    """
+    all_latents = []
+
+    def callback(i, t, latents):
+        all_latents.append(latents.copy())
+
+    np.random.seed(args.seed)
+    coreml_pipe(TEST_PROMPT,
+                num_inference_steps=args.num_inference_steps,
+                callback=callback)
+
+    return all_latents
+
+
+def benchmark_preview(name, preview_fn, reference_images, all_latents):
+    latencies = []
+    psnrs = []
+    for latents, reference in zip(all_latents, reference_images):
+        start = time.perf_counter()
+        image = preview_fn(latents)
+        latencies.append(time.perf_counter() - start)
+
+        psnrs.append(torch2coreml.compute_psnr(image.astype(np.float32), reference))
+
+    results = {
+        "median_latency_ms": median(latencies) * 1e3,
+        "median_psnr": float(median(psnrs)),
+        "final_step_psnr": float(psnrs[-1]),
+    }
+    logger.info(
+        f"{name}: median latency {results['median_latency_ms']:.2f} ms, "
+        f"median PSNR {results['median_psnr']:.1f} dB, final step PSNR {results['final_step_psnr']:.1f} dB")
+
+    return results
+
+
+def main(args):
+    coreml_pipe = pipeline.load_model(args)
+    if coreml_pipe.preview_decoder is None:
+        raise FileNotFoundError(
+            f"preview_decoder mlpackage not found in {args.i}. "
+            "Export it with `torch2coreml --convert-preview-decoder`")
+
+    all_latents = collect_latents(coreml_pipe, args)
+    logger.info(f"Collected latents of {len(all_latents)} steps")
+
+    # `decode_latents` output (BHWC, [0, 1]) is the reference for every preview
+    reference_images = []
+    full_latencies = []
+    for latents in all_latents:
+        start = time.perf_counter()
+        reference_images.append(coreml_pipe.decode_latents(latents)[0] * 255)
+        full_latencies.append(time.perf_counter() - start)
+
+    results = {
+        "vae_decoder": {"median_latency_ms": median(full_latencies) * 1e3},
+    }
+    logger.info(f"vae_decoder: median latency {results['vae_decoder']['median_latency_ms']:.2f} ms")
+
+    results["preview_decoder"] = benchmark_preview(
+        "preview_decoder",
+        lambda latents: coreml_pipe.decode_preview_latents(latents)[0] * 255,
+        reference_images, all_latents)
+
+    factors = latent_preview.get_latent_rgb_factors(args.model_version)
+    results["latent_rgb"] = benchmark_preview(
+        "latent_rgb",
+        lambda latents: latent_preview.latents_to_rgb(
+            latents, factors, upsample=coreml_pipe.height // latents.shape[2]),
+        reference_images, all_latents)
+
+    json_path = os.path.join(args.o, "benchmark_preview_decoder.json")
+    logger.info(f"Saving benchmark results to {json_path}")
+    with open(json_path, "w") as f:
+        json.dump(results, f)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i",
+        required=True,
+        help="Path to the directory with the .mlpackage files, including the preview_decoder")
+    parser.add_argument("-o", default=".", help="Path to output directory")
+    parser.add_argument("--model-version", default="stabilityai/stable-diffusion-2-base")
+    parser.add_argument("--compute-unit", choices=get_available_compute_units(), default="ALL")
+    parser.add_argument("--scheduler", choices=tuple(pipeline.SCHEDULER_MAP.keys()), default=None)
+    parser.add_argument("--num-inference-steps", type=int, default=25)
+    parser.add_argument("--seed", type=int, default=93)
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,96 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import argparse
+import json
+import logging
+import numpy as np
+import os
+import time
+import torch
+
+from python_coreml_stable_diffusion.numpy_schedulers import NUMPY_SCHEDULER_MAP
+from python_coreml_stable_diffusion.pipeline import SCHEDULER_MAP
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("INFO")
+
+STABLE_DIFFUSION_CONFIG = dict(beta_start=0.00085,
+                               beta_end=0.012,
+                               beta_schedule="scaled_linear",
+                               num_train_timesteps=1000)
+
+
+def run_denoising_loop(scheduler, latents, num_inference_steps, torch_round_trip):
+    """ Runs the scheduler part of the denoising loop of `pipeline.py` with a trivial
+    stand-in for the unet and returns the seconds spent in it
+    """
+    scheduler.set_timesteps(num_inference_steps)
+
+    start = time.perf_counter()
+    for t in scheduler.timesteps:
+        model_input = scheduler.scale_model_input(latents, t)
+        noise_pred = model_input * np.float32(0.1)
+        if torch_round_trip:
+            latents = scheduler.step(torch.from_numpy(noise_pred), t,
+                                     torch.from_numpy(latents)).prev_sample.numpy()
+        else:
+            latents = scheduler.step(noise_pred, t, latents).prev_sample
+    return time.perf_counter() - start
+
+
+def benchmark_scheduler(name, args):
+    reference = SCHEDULER_MAP[name](**STABLE_DIFFUSION_CONFIG)
+    latents_shape = (args.batch_size, 4, args.latent_size, args.latent_size)
+    latents = np.random.RandomState(0).randn(*latents_shape).astype(np.float32)
+
+    results = {"scheduler": name}
+    for backend in ("torch", "numpy"):
+        if backend == "torch":
+            scheduler = SCHEDULER_MAP[name].from_config(reference.config)
+            if not isinstance(scheduler.init_noise_sigma, float):
+                # Sigma based diffusers schedulers can not scale NumPy inputs
+                continue
+        else:
+            scheduler = NUMPY_SCHEDULER_MAP[name].from_config(reference.config)
+
+        timings = [
+            run_denoising_loop(scheduler, latents.copy(), args.num_inference_steps,
+                               torch_round_trip=backend == "torch")
+            for _ in range(args.repeats)
+        ]
+        ms_per_step = 1000 * min(timings) / args.num_inference_steps
+        results[f"{backend}_ms_per_step"] = ms_per_step
+        logger.info(f"{name} ({backend}): {ms_per_step:.3f} ms/step")
+
+    return results
+
+
+def main(args):
+    results = [benchmark_scheduler(name, args) for name in args.schedulers]
+
+    json_path = os.path.join(args.o, "benchmark_schedulers.json")
+    logger.info(f"Saving benchmark results to {json_path}")
+    with open(json_path, "w") as f:
+        json.dump(results, f)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", default=".", help="Path to output directory")
+    parser.add_argument("--schedulers",
+                        nargs="+",
+                        choices=tuple(NUMPY_SCHEDULER_MAP.keys()),
+                        default=tuple(NUMPY_SCHEDULER_MAP.keys()))
+    parser.add_argument("--num-inference-steps", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--latent-size", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=5)
+
+    args = parser.parse_args()
+    main(args)
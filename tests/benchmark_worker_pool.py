@@ -0,0 +1,94 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+from python_coreml_stable_diffusion import pipeline
+from python_coreml_stable_diffusion.coreml_model import get_available_compute_units
+from python_coreml_stable_diffusion.worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+logger.setLevel("INFO")
+
+TEST_PROMPT = "a high quality photo of an astronaut riding a horse in space"
+
+
+def benchmark_workers(num_workers, args):
+    """ Generates `args.num_images` images with `num_workers` worker processes and returns
+    the throughput in images per minute, excluding model loading
+    """
+    jobs = [
+        dict(id=str(i), prompt=TEST_PROMPT, negative_prompt=None, seed=args.seed + i,
+             num_inference_steps=args.num_inference_steps, guidance_scale=7.5,
+             scheduler=args.scheduler)
+        for i in range(args.num_images)
+    ]
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        worker_args = argparse.Namespace(**vars(args))
+        worker_args.o = out_dir
+        pool = WorkerPool(worker_args, num_workers)
+
+        first_result = None
+
+        def on_result(entry):
+            nonlocal first_result
+            if first_result is None:
+                first_result = time.perf_counter()
+
+        start = time.perf_counter()
+        entries = pool.run(jobs, on_result=on_result)
+        elapsed = time.perf_counter() - start
+
+    num_generated = sum(entry is not None for entry in entries)
+    # Workers load their models concurrently, the first result marks the end of loading
+    generation_seconds = time.perf_counter() - first_result if num_generated > 1 else elapsed
+    results = {
+        "num_workers": pool.num_workers,
+        "requested_workers": num_workers,
+        "num_threads": pool.num_threads,
+        "num_images": num_generated,
+        "seconds": elapsed,
+        "images_per_minute": num_generated / elapsed * 60,
+        "steady_state_images_per_minute": (num_generated - 1) / generation_seconds * 60
+        if num_generated > 1 else None,
+    }
+    logger.info(
+        f"{pool.num_workers} workers: {results['images_per_minute']:.2f} images/min "
+        f"({num_generated} images in {elapsed:.1f} s)")
+
+    return results
+
+
+def main(args):
+    results = [benchmark_workers(num_workers, args) for num_workers in args.num_workers]
+
+    json_path = os.path.join(args.o, "benchmark_worker_pool.json")
+    logger.info(f"Saving benchmark results to {json_path}")
+    with open(json_path, "w") as f:
+        json.dump(results, f)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", required=True, help="Path to input directory with the .mlpackage files")
+    parser.add_argument("-o", default=".", help="Path to output directory")
+    parser.add_argument("--model-version", default="stabilityai/stable-diffusion-2-base")
+    parser.add_argument("--compute-unit", choices=get_available_compute_units(), default="ALL")
+    parser.add_argument("--scheduler", choices=tuple(pipeline.SCHEDULER_MAP.keys()), default=None)
+    parser.add_argument("--num-workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--num-inference-steps", type=int, default=25)
+    parser.add_argument("--num-images", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=93)
+
+    args = parser.parse_args()
+    main(args)
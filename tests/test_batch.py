@@ -0,0 +1,124 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+from argparse import Namespace
+from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
+import json
+import os
+from PIL import Image
+import tempfile
+import unittest
+
+from python_coreml_stable_diffusion.batch import (
+    BatchRunner,
+    MANIFEST_FILENAME,
+    group_jobs,
+    load_jobs,
+    load_manifest,
+)
+
+ARGS = Namespace(seed=100, num_inference_steps=25, guidance_scale=7.5, scheduler=None)
+
+
+class _Pipe:
+    """ Stands in for `CoreMLStableDiffusionPipeline`, records its calls and fails on
+    the call number `fail_at`
+    """
+
+    def __init__(self, batch_size=2, fail_at=None):
+        self.batch_size = batch_size
+        self.height = self.width = 8
+        self.scheduler = None
+        self.stage_timings = {}
+        self.calls = []
+        self.fail_at = fail_at
+
+    def __call__(self, prompt, num_images_per_prompt, seed, **kwargs):
+        if len(self.calls) == self.fail_at:
+            raise RuntimeError("Interrupted")
+        self.calls.append(dict(kwargs, prompt=prompt, seed=seed))
+        self.stage_timings = {"denoise": 0.1}
+
+        images = [Image.new("RGB", (self.width, self.height)) for _ in range(num_images_per_prompt)]
+        return StableDiffusionPipelineOutput(images=images, nsfw_content_detected=None)
+
+
+class TestBatch(unittest.TestCase):
+    """ Test the JSONL batch runner for:
+
+    - Job defaults and validation
+    - Grouping jobs with shared prompts and options into batched calls
+    - Writing images and a manifest, and resuming from it
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.jobs_path = os.path.join(self.tmp_dir.name, "jobs.jsonl")
+        self.out_dir = os.path.join(self.tmp_dir.name, "output")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _write_jobs(self, jobs):
+        with open(self.jobs_path, "w") as f:
+            f.write("\n".join(json.dumps(job) for job in jobs) + "\n")
+        return load_jobs(self.jobs_path, ARGS)
+
+    def test_load_jobs(self):
+        jobs = self._write_jobs([
+            {"prompt": "a"},
+            {"id": 7, "prompt": "b", "seed": 1, "num_inference_steps": 10},
+        ])
+
+        self.assertEqual(jobs[0]["id"], "000000")
+        self.assertEqual(jobs[0]["seed"], 100)
+        self.assertEqual(jobs[0]["num_inference_steps"], 25)
+        self.assertEqual(jobs[1]["id"], "7")
+        self.assertEqual(jobs[1]["seed"], 1)
+        self.assertEqual(jobs[1]["num_inference_steps"], 10)
+
+        with self.assertRaises(ValueError):
+            self._write_jobs([{"prompt": "a", "scheduler": "Unknown"}])
+        with self.assertRaises(ValueError):
+            self._write_jobs([{"id": 1, "prompt": "a"}, {"id": 1, "prompt": "b"}])
+
+    def test_group_jobs(self):
+        jobs = self._write_jobs([
+            {"prompt": "a"},
+            {"prompt": "b"},
+            {"prompt": "a"},
+            {"prompt": "a"},
+            {"prompt": "a", "guidance_scale": 5.0},
+        ])
+
+        batches = group_jobs(jobs, batch_size=2)
+        self.assertEqual([[job["id"] for job in batch] for batch in batches],
+                         [["000000", "000002"], ["000003"], ["000001"], ["000004"]])
+
+    def test_run_and_resume(self):
+        jobs = self._write_jobs([{"prompt": "a"}, {"prompt": "b"}, {"prompt": "a"}])
+
+        with self.assertRaises(RuntimeError):
+            BatchRunner(_Pipe(fail_at=1), self.out_dir).run(jobs)
+
+        manifest_path = os.path.join(self.out_dir, MANIFEST_FILENAME)
+        self.assertEqual(set(load_manifest(manifest_path)), {"000000", "000002"})
+
+        pipe = _Pipe()
+        report = BatchRunner(pipe, self.out_dir).run(jobs)
+
+        self.assertEqual(len(pipe.calls), 1)
+        self.assertEqual(pipe.calls[0]["prompt"], "b")
+        self.assertEqual(report["num_skipped"], 2)
+        self.assertIn("p50", report["stage_latency"]["denoise"])
+
+        results = load_manifest(manifest_path)
+        self.assertEqual(set(results), {"000000", "000001", "000002"})
+        for result in results.values():
+            self.assertTrue(os.path.exists(result["path"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import numpy as np
+import os
+from transformers import CLIPFeatureExtractor, CLIPTokenizer
+import unittest
+
+from python_coreml_stable_diffusion.continuous_batching import ContinuousBatcher, DenoisingRequest
+from python_coreml_stable_diffusion.numpy_schedulers import NumpyPNDMScheduler
+from python_coreml_stable_diffusion.pipeline import CoreMLStableDiffusionPipeline
+
+TOKENIZER_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "swift", "StableDiffusionTests",
+                             "Resources")
+
+LATENT_SIZE = 8
+HIDDEN_SIZE = 8
+
+
+class _Model:
+    """ Stands in for `CoreMLModel`: checks the inputs against `expected_inputs` and
+    computes every output row from the same input row only
+    """
+
+    def __init__(self, expected_inputs, predict):
+        self.expected_inputs = {
+            name: {"shape": shape, "dtype": dtype}
+            for name, (shape, dtype) in expected_inputs.items()
+        }
+        self.predict = predict
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        for k, v in kwargs.items():
+            assert v.shape == self.expected_inputs[k]["shape"], (k, v.shape)
+            assert v.dtype == self.expected_inputs[k]["dtype"], (k, v.dtype)
+        self.calls.append(kwargs)
+        return self.predict(**kwargs)
+
+
+def _text_encoder(input_ids):
+    scales = np.arange(1, HIDDEN_SIZE + 1, dtype=np.float32) / 1000
+    return {"last_hidden_state": np.sin(input_ids[:, :, None] * scales)}
+
+
+def _unet(sample, timestep, encoder_hidden_states):
+    conditioning = encoder_hidden_states.astype(np.float32).mean(axis=(1, 2, 3))
+    noise_pred = 0.1 * sample.astype(np.float32) * (timestep[:, None, None, None] / 1000) + \
+        conditioning[:, None, None, None]
+    return {"noise_pred": noise_pred.astype(np.float32)}
+
+
+def _vae_decoder(z):
+    return {"image": np.tanh(z[:, :3].astype(np.float32)).repeat(8, axis=2).repeat(8, axis=3)}
+
+
+def _make_pipe(unet_batch_size):
+    latents_shape = (4, LATENT_SIZE, LATENT_SIZE)
+    return CoreMLStableDiffusionPipeline(
+        text_encoder=_Model({"input_ids": ((1, 77), np.float32)}, _text_encoder),
+        unet=_Model(
+            {
+                "sample": ((unet_batch_size, ) + latents_shape, np.float16),
+                "timestep": ((unet_batch_size, ), np.float16),
+                "encoder_hidden_states": ((unet_batch_size, HIDDEN_SIZE, 1, 77), np.float16),
+            }, _unet),
+        vae_decoder=_Model({"z": ((1, ) + latents_shape, np.float16)}, _vae_decoder),
+        feature_extractor=CLIPFeatureExtractor(),
+        safety_checker=None,
+        scheduler=NumpyPNDMScheduler(beta_start=0.00085,
+                                     beta_end=0.012,
+                                     beta_schedule="scaled_linear",
+                                     skip_prk_steps=True,
+                                     steps_offset=1,
+                                     set_alpha_to_one=False),
+        tokenizer=CLIPTokenizer(os.path.join(TOKENIZER_DIR, "vocab.json"),
+                                os.path.join(TOKENIZER_DIR, "merges.txt"),
+                                model_max_length=77,
+                                pad_token="<|endoftext|>"),
+    )
+
+
+REQUESTS = [
+    dict(prompt="a photo of a cat", seed=1, num_inference_steps=6, guidance_scale=7.5),
+    dict(prompt="a dog", seed=2, num_inference_steps=3, guidance_scale=4.0),
+    dict(prompt="a dog", negative_prompt="blurry", seed=3, num_inference_steps=5, guidance_scale=1.0),
+    dict(prompt="a horse", seed=4, num_inference_steps=4, guidance_scale=7.5),
+]
+
+
+class TestContinuousBatching(unittest.TestCase):
+    """ Test step-level batching of concurrent requests for:
+
+    - Images identical to generating each request on its own
+    - Requests at different timesteps sharing unet calls
+    - Cancellation from the step callback
+    """
+
+    def _sequential_images(self):
+        pipe = _make_pipe(unet_batch_size=2)
+        return [
+            np.asarray(pipe(seed=[request.pop("seed")], **request).images[0])
+            for request in [dict(request) for request in REQUESTS]
+        ]
+
+    def test_matches_sequential(self):
+        expected = self._sequential_images()
+
+        pipe = _make_pipe(unet_batch_size=4)
+        batcher = ContinuousBatcher(pipe, max_active=3)
+        requests = [batcher.submit(DenoisingRequest(**request)) for request in REQUESTS]
+        batcher.close()
+
+        for request, image in zip(requests, expected):
+            np.testing.assert_array_equal(np.asarray(request.result(timeout=10)), image)
+
+        # Some unet calls mix requests at different timesteps
+        self.assertTrue(any(len(set(call["timestep"])) > 1 for call in pipe.unet.calls))
+        self.assertGreater(batcher.stats()["mean_active"], 1)
+
+    def test_cancel(self):
+        pipe = _make_pipe(unet_batch_size=2)
+        batcher = ContinuousBatcher(pipe)
+
+        steps = []
+
+        def callback(i, t, latents):
+            steps.append(i)
+            return i < 1
+
+        cancelled = batcher.submit(DenoisingRequest(callback=callback, **REQUESTS[0]))
+        completed = batcher.submit(DenoisingRequest(**REQUESTS[1]))
+        batcher.close()
+
+        self.assertIsNone(cancelled.result(timeout=10))
+        self.assertTrue(cancelled.cancelled)
+        self.assertEqual(steps, [0, 1])
+        self.assertIsNotNone(completed.result(timeout=10))
+
+    def test_requires_numpy_scheduler(self):
+        pipe = _make_pipe(unet_batch_size=2)
+        pipe.scheduler = object()
+
+        with self.assertRaises(ValueError):
+            ContinuousBatcher(pipe)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import numpy as np
+import unittest
+
+from python_coreml_stable_diffusion.denoising_buffers import DenoisingBuffers
+
+LATENTS_SHAPE = (3, 4, 8, 8)
+EMBEDDINGS_SHAPE = (16, 1, 77)
+
+
+class _UNet:
+    """ Checks its inputs like `CoreMLModel` and predicts the sample scaled by the
+    timestep plus the mean of the embeddings
+    """
+
+    def __init__(self, batch_size):
+        self.expected_inputs = {
+            "sample": {"shape": (batch_size, ) + LATENTS_SHAPE[1:], "dtype": np.float16},
+            "timestep": {"shape": (batch_size, ), "dtype": np.float16},
+            "encoder_hidden_states": {"shape": (batch_size, ) + EMBEDDINGS_SHAPE, "dtype": np.float16},
+        }
+        self.inputs = []
+
+    def __call__(self, **kwargs):
+        for k, v in kwargs.items():
+            assert v.shape == self.expected_inputs[k]["shape"], (k, v.shape)
+            assert v.dtype == self.expected_inputs[k]["dtype"], (k, v.dtype)
+        self.inputs.append(kwargs)
+
+        embeddings_mean = kwargs["encoder_hidden_states"].mean(axis=(1, 2, 3))
+        noise_pred = kwargs["sample"] * kwargs["timestep"][:, None, None, None] + \
+            embeddings_mean[:, None, None, None]
+        return {"noise_pred": noise_pred.astype(np.float32)}
+
+
+class TestDenoisingBuffers(unittest.TestCase):
+    """ Test the preallocated denoising loop buffers for:
+
+    - Noise predictions matching unbuffered unet calls with any unet batch size
+    - Classifier free guidance computed in place
+    - Reusing the same buffers across steps
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.latents = rng.randn(*LATENTS_SHAPE).astype(np.float32)
+        self.text_embeddings = rng.randn(2 * LATENTS_SHAPE[0], *EMBEDDINGS_SHAPE).astype(np.float32)
+
+    def _reference(self, unet, t, guidance_scale):
+        noise_pred = []
+        for latents, embeddings in zip(np.concatenate([self.latents] * 2), self.text_embeddings):
+            noise_pred.append(unet.__class__(1)(
+                sample=latents[None].astype(np.float16),
+                timestep=np.array([t], dtype=np.float16),
+                encoder_hidden_states=embeddings[None].astype(np.float16),
+            )["noise_pred"][0])
+        noise_pred_uncond, noise_pred_text = np.split(np.stack(noise_pred), 2)
+        return noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+    def test_matches_unbuffered(self):
+        for batch_size in (1, 2, 4):
+            with self.subTest(batch_size=batch_size):
+                unet = _UNet(batch_size)
+                buffers = DenoisingBuffers(unet, self.text_embeddings, LATENTS_SHAPE, True)
+
+                buffers.predict_noise(self.latents, 901)
+                noise_pred = buffers.guide(7.5)
+
+                self.assertEqual(len(unet.inputs), -(-6 // batch_size))
+                np.testing.assert_allclose(noise_pred, self._reference(unet, 901, 7.5), rtol=1e-6)
+
+    def test_buffers_reused(self):
+        unet = _UNet(2)
+        buffers = DenoisingBuffers(unet, self.text_embeddings, LATENTS_SHAPE, True)
+
+        first = buffers.predict_noise(self.latents, 1)
+        guided = buffers.guide(2.0)
+        self.assertIs(buffers.predict_noise(self.latents, 2), first)
+        self.assertIs(buffers.guide(2.0), guided)
+        self.assertIs(unet.inputs[0]["sample"].base, unet.inputs[-1]["sample"].base)
+
+    def test_without_guidance(self):
+        unet = _UNet(2)
+        buffers = DenoisingBuffers(unet, self.text_embeddings[:3], LATENTS_SHAPE, False)
+
+        noise_pred = buffers.predict_noise(self.latents, 1)
+        self.assertEqual(noise_pred.shape, LATENTS_SHAPE)
+        self.assertIsNone(buffers.guided_noise_pred)
+
+        with self.assertRaises(ValueError):
+            DenoisingBuffers(unet, self.text_embeddings, LATENTS_SHAPE, False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import numpy as np
+import tempfile
+import unittest
+
+from python_coreml_stable_diffusion.embedding_cache import EmbeddingCache
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    """ Test the prompt embedding cache for:
+
+    - Keys depending on model version and token ids
+    - Least recently used eviction within the byte budget
+    - Persistence of the disk tier across instances
+    - Hit and miss counters
+    """
+
+    def _embeddings(self, value):
+        return np.full((77, 16), value, dtype=np.float32)
+
+    def test_key(self):
+        input_ids = np.arange(77)
+
+        self.assertEqual(
+            EmbeddingCache.key("v1", input_ids),
+            EmbeddingCache.key("v1", input_ids.astype(np.float32)))
+        self.assertNotEqual(
+            EmbeddingCache.key("v1", input_ids),
+            EmbeddingCache.key("v2", input_ids))
+        self.assertNotEqual(
+            EmbeddingCache.key("v1", input_ids),
+            EmbeddingCache.key("v1", input_ids[::-1]))
+
+    def test_lru_eviction(self):
+        entry_bytes = self._embeddings(0).nbytes
+        cache = EmbeddingCache(max_bytes=2 * entry_bytes)
+
+        cache.put("a", self._embeddings(0))
+        cache.put("b", self._embeddings(1))
+        cache.get("a")
+        cache.put("c", self._embeddings(2))
+
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertLessEqual(cache.nbytes, cache.max_bytes)
+
+    def test_disk_tier_persists(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            EmbeddingCache(cache_dir=cache_dir).put("a", self._embeddings(3))
+
+            cache = EmbeddingCache(cache_dir=cache_dir)
+            np.testing.assert_array_equal(cache.get("a"), self._embeddings(3))
+            self.assertEqual(cache.disk_hits, 1)
+
+            # Promoted to the in-memory tier
+            cache.get("a")
+            self.assertEqual(cache.disk_hits, 1)
+            self.assertEqual(cache.hits, 2)
+
+    def test_counters(self):
+        cache = EmbeddingCache()
+
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", self._embeddings(0))
+        cache.get("a")
+
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertFalse(cache.get("a").flags.writeable)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import numpy as np
+import os
+import tempfile
+import unittest
+
+from python_coreml_stable_diffusion.latent_history import LatentHistory
+
+
+class TestLatentHistory(unittest.TestCase):
+    """ Test the latent generation history for:
+
+    - Growing past the preallocated capacity
+    - Memory-mapped storage
+    - Batched decoding of selected frames
+    - Decoding a single sample of batched latents
+    """
+
+    SHAPE = (4, 8, 8)
+
+    def _fill(self, history, num_frames):
+        for i in range(num_frames):
+            history.append(np.full((1, ) + self.SHAPE, i, dtype=np.float32))
+
+    def test_grows_past_capacity(self):
+        history = LatentHistory(self.SHAPE, capacity=2)
+        self._fill(history, 5)
+
+        self.assertEqual(len(history), 5)
+        self.assertEqual(history.latents.dtype, np.float16)
+        np.testing.assert_array_equal(history[:, 0, 0, 0], np.arange(5))
+
+    def test_memory_mapped(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "history.npy")
+
+            history = LatentHistory(self.SHAPE, capacity=2, path=path)
+            self._fill(history, 3)
+            self.assertIsInstance(history.latents, np.memmap)
+            np.testing.assert_array_equal(history[:, 0, 0, 0], np.arange(3))
+
+            history.close()
+            self.assertFalse(os.path.exists(path))
+
+    def test_decode_in_batches(self):
+        history = LatentHistory(self.SHAPE)
+        self._fill(history, 5)
+
+        batch_sizes = []
+
+        def decode_fn(latents):
+            batch_sizes.append(len(latents))
+            return np.repeat(latents[:, :3].transpose(0, 2, 3, 1), 2, axis=1) / 255
+
+        frames = list(history.decode(decode_fn, indices=[4, 0, 2], batch_size=2))
+
+        self.assertEqual(batch_sizes, [2, 1])
+        self.assertEqual(frames[0].shape, (16, 8, 3))
+        self.assertEqual(frames[0].dtype, np.uint8)
+        self.assertEqual([frame[0, 0, 0] for frame in frames], [4, 0, 2])
+
+    def test_decode_sample_of_batched_latents(self):
+        history = LatentHistory((2, ) + self.SHAPE)
+        for i in range(3):
+            history.append(np.stack([np.full(self.SHAPE, i), np.full(self.SHAPE, 10 + i)]))
+
+        decode_fn = lambda latents: latents[:, :3].transpose(0, 2, 3, 1) / 255
+        frames = list(history.decode(decode_fn, sample=1))
+
+        self.assertEqual([frame[0, 0, 0] for frame in frames], [10, 11, 12])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import os
+import tempfile
+import time
+import unittest
+
+from python_coreml_stable_diffusion.model_cache import ModelCache
+
+SPECS = {
+    "inputs": {"sample": {"shape": [2, 4, 64, 64], "dtype": "float16"}},
+    "outputs": {"noise_pred": {"shape": [2, 4, 64, 64], "dtype": "float32"}},
+}
+
+
+class _Compiler:
+    """ Stands in for `coreml_model.compile_mlpackage`, writes `size` bytes per model
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.calls = []
+
+    def __call__(self, mlpackage_path, compiled_path):
+        self.calls.append(mlpackage_path)
+        os.makedirs(compiled_path)
+        with open(os.path.join(compiled_path, "model.mil"), "wb") as f:
+            f.write(b"\0" * self.size)
+        return SPECS
+
+
+class TestModelCache(unittest.TestCase):
+    """ Test the compiled Core ML model cache for:
+
+    - Compiling once per mlpackage content and compute unit
+    - Manifests with the input and output specs
+    - Least recently used eviction by disk size
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, "cache")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _mlpackage(self, name, weights):
+        path = os.path.join(self.tmp_dir.name, f"{name}.mlpackage")
+        os.makedirs(os.path.join(path, "Data"), exist_ok=True)
+        with open(os.path.join(path, "Data", "weight.bin"), "wb") as f:
+            f.write(weights)
+        return path
+
+    def test_hit(self):
+        unet = self._mlpackage("unet", b"unet weights")
+        compiler = _Compiler()
+
+        compiled_path, manifest = ModelCache(self.cache_dir, compile_fn=compiler).get(unet, "ALL")
+        self.assertTrue(os.path.isdir(compiled_path))
+        self.assertEqual(manifest["inputs"], SPECS["inputs"])
+        self.assertEqual(manifest["outputs"], SPECS["outputs"])
+
+        # A new cache instance (i.e. a later run) reuses the compiled model
+        cache = ModelCache(self.cache_dir, compile_fn=compiler)
+        self.assertEqual(cache.get(unet, "ALL")[0], compiled_path)
+        self.assertEqual(len(compiler.calls), 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+        # Other compute units and changed weights are compiled again
+        cache.get(unet, "CPU_ONLY")
+        self.assertEqual(len(compiler.calls), 2)
+        self._mlpackage("unet", b"fine-tuned unet weights")
+        self.assertNotEqual(cache.get(unet, "ALL")[0], compiled_path)
+        self.assertEqual(len(compiler.calls), 3)
+
+    def test_copies_share_entries(self):
+        compiler = _Compiler()
+        cache = ModelCache(self.cache_dir, compile_fn=compiler)
+
+        first = cache.get(self._mlpackage("a", b"weights"), "ALL")[0]
+        second = cache.get(self._mlpackage("b", b"weights"), "ALL")[0]
+        self.assertEqual(first, second)
+        self.assertEqual(len(compiler.calls), 1)
+
+    def test_lru_eviction(self):
+        compiler = _Compiler(size=1000)
+        cache = ModelCache(self.cache_dir, max_bytes=2500, compile_fn=compiler)
+
+        paths = [self._mlpackage(name, name.encode()) for name in ("a", "b", "c")]
+        compiled_a = cache.get(paths[0], "ALL")[0]
+        compiled_b = cache.get(paths[1], "ALL")[0]
+        # Makes `b` the least recently used entry
+        time.sleep(0.01)
+        cache.get(paths[0], "ALL")
+        compiled_c = cache.get(paths[2], "ALL")[0]
+
+        self.assertTrue(os.path.exists(compiled_a))
+        self.assertFalse(os.path.exists(compiled_b))
+        self.assertTrue(os.path.exists(compiled_c))
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertLessEqual(cache.stats()["bytes"], 2500)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+from threading import Event
+import time
+import unittest
+from unittest import mock
+
+from python_coreml_stable_diffusion import coreml_model
+from python_coreml_stable_diffusion.coreml_model import LazyCoreMLModel, _load_mlpackages
+
+LOAD_SECONDS = 0.2
+
+
+class _Model:
+    """ Stands in for `CoreMLModel`
+    """
+
+    expected_inputs = {"x": {"shape": (1, ), "dtype": None}}
+
+    def __init__(self, name, load_time):
+        self.name = name
+        self.load_time = load_time
+
+    def __call__(self, **kwargs):
+        return {"name": self.name}
+
+
+class TestModelLoading(unittest.TestCase):
+    """ Test concurrent and lazy Core ML model loading for:
+
+    - Models loading in parallel with per-model load times
+    - Lazy models returned before they finish loading and waited for on first use
+    """
+
+    def setUp(self):
+        self.release_lazy = Event()
+
+        def load(name, *args, **kwargs):
+            if name == "safety_checker":
+                self.release_lazy.wait(timeout=10)
+            time.sleep(LOAD_SECONDS)
+            return _Model(name, LOAD_SECONDS)
+
+        patcher = mock.patch.object(coreml_model, "_load_mlpackage", side_effect=load)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parallel(self):
+        names = ["text_encoder", "unet", "vae_decoder"]
+        load_timings = {}
+
+        start = time.perf_counter()
+        models = _load_mlpackages(names, "", "", "ALL", load_timings=load_timings)
+        elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, LOAD_SECONDS * len(names))
+        self.assertEqual([models[name].name for name in names], names)
+        self.assertEqual(set(load_timings), set(names))
+
+    def test_lazy(self):
+        load_timings = {}
+        models = _load_mlpackages(["unet", "safety_checker"], "", "", "ALL",
+                                  lazy_submodule_names=("safety_checker", ),
+                                  load_timings=load_timings)
+
+        safety_checker = models["safety_checker"]
+        self.assertIsInstance(safety_checker, LazyCoreMLModel)
+        self.assertFalse(safety_checker.loaded)
+        self.assertNotIn("safety_checker", load_timings)
+
+        self.release_lazy.set()
+        self.assertEqual(safety_checker(x=None), {"name": "safety_checker"})
+        self.assertEqual(safety_checker.expected_inputs["x"]["shape"], (1, ))
+        self.assertTrue(safety_checker.loaded)
+        self.assertIn("safety_checker", load_timings)
+
+
+if __name__ == "__main__":
+    unittest.main()
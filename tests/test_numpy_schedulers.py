@@ -0,0 +1,120 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+from diffusers import (
+    DDIMScheduler,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    LMSDiscreteScheduler,
+    PNDMScheduler,
+)
+import numpy as np
+import torch
+import unittest
+
+from python_coreml_stable_diffusion.numpy_schedulers import NUMPY_SCHEDULER_MAP
+
+STABLE_DIFFUSION_CONFIG = dict(beta_start=0.00085,
+                               beta_end=0.012,
+                               beta_schedule="scaled_linear",
+                               num_train_timesteps=1000)
+
+TEST_CASES = [
+    (PNDMScheduler, dict(skip_prk_steps=True, steps_offset=1, set_alpha_to_one=False)),
+    (PNDMScheduler, dict(skip_prk_steps=False, steps_offset=1)),
+    (DDIMScheduler, dict(clip_sample=False, set_alpha_to_one=False, steps_offset=1)),
+    (DDIMScheduler, dict(clip_sample=True, prediction_type="v_prediction")),
+    (DPMSolverMultistepScheduler, dict()),
+    (DPMSolverMultistepScheduler, dict(solver_order=3, solver_type="heun")),
+    (DPMSolverMultistepScheduler, dict(algorithm_type="dpmsolver", solver_order=3)),
+    (DPMSolverMultistepScheduler, dict(thresholding=True)),
+    (EulerDiscreteScheduler, dict()),
+    (EulerDiscreteScheduler, dict(prediction_type="v_prediction")),
+    (EulerAncestralDiscreteScheduler, dict()),
+    (LMSDiscreteScheduler, dict()),
+]
+
+# Relative to the largest latent value
+TOLERANCE = 1e-5
+
+
+class _FixedNoise:
+    """ Stands in for a np.random.Generator that returns noise drawn by torch
+    """
+
+    def __init__(self, noise):
+        self.noise = noise
+
+    def standard_normal(self, shape):
+        return self.noise
+
+
+class TestNumpySchedulers(unittest.TestCase):
+    """ Test the NumPy schedulers against their diffusers counterparts for:
+
+    - Identical timesteps
+    - Matching scaled model inputs and denoised latents across all steps
+    - Latents staying in float32
+    """
+
+    def _run_parity(self, scheduler_cls, kwargs, num_inference_steps):
+        reference = scheduler_cls(**STABLE_DIFFUSION_CONFIG, **kwargs)
+        reference.set_timesteps(num_inference_steps)
+
+        name = scheduler_cls.__name__.replace("Scheduler", "")
+        scheduler = NUMPY_SCHEDULER_MAP[name].from_config(reference.config)
+        scheduler.set_timesteps(num_inference_steps)
+
+        np.testing.assert_array_equal(reference.timesteps.numpy(), scheduler.timesteps)
+
+        latents = np.random.RandomState(0).randn(1, 4, 8, 8).astype(np.float32)
+        latents = latents * np.float32(scheduler.init_noise_sigma)
+        reference_latents = torch.from_numpy(latents.copy())
+
+        for reference_t, t in zip(reference.timesteps, scheduler.timesteps):
+            reference_input = reference.scale_model_input(reference_latents, reference_t).numpy()
+            model_input = scheduler.scale_model_input(latents, t)
+            self._assert_close(reference_input, model_input)
+
+            # Deterministic stand-in for the unet
+            model_output = np.tanh(0.7 * model_input + 0.1).astype(np.float32)
+
+            reference_kwargs, kwargs = {}, {}
+            if scheduler_cls is EulerAncestralDiscreteScheduler:
+                reference_kwargs["generator"] = torch.Generator().manual_seed(int(t))
+                noise = torch.randn(latents.shape, generator=torch.Generator().manual_seed(int(t)))
+                kwargs["generator"] = _FixedNoise(noise.numpy())
+
+            reference_latents = reference.step(torch.from_numpy(model_output), reference_t,
+                                               reference_latents, **reference_kwargs).prev_sample
+            latents = scheduler.step(model_output, t, latents, **kwargs).prev_sample
+
+            self.assertEqual(latents.dtype, np.float32)
+
+        self._assert_close(reference_latents.numpy(), latents)
+
+    def _assert_close(self, expected, actual):
+        error = np.abs(expected - actual).max() / np.abs(expected).max()
+        self.assertLess(error, TOLERANCE)
+
+    def test_parity(self):
+        for scheduler_cls, kwargs in TEST_CASES:
+            for num_inference_steps in (10, 25):
+                with self.subTest(scheduler=scheduler_cls.__name__,
+                                  num_inference_steps=num_inference_steps,
+                                  **kwargs):
+                    self._run_parity(scheduler_cls, kwargs, num_inference_steps)
+
+    def test_from_config_ignores_unknown_keys(self):
+        config = dict(PNDMScheduler(**STABLE_DIFFUSION_CONFIG).config)
+        config["unknown_key"] = True
+
+        scheduler = NUMPY_SCHEDULER_MAP["DDIM"].from_config(config)
+        self.assertEqual(scheduler.config["beta_schedule"], "scaled_linear")
+
+
+if __name__ == "__main__":
+    unittest.main()
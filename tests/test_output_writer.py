@@ -0,0 +1,66 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import numpy as np
+import os
+from PIL import Image
+import tempfile
+from threading import Event
+import unittest
+
+from python_coreml_stable_diffusion.output_writer import OutputWriter
+
+
+class TestOutputWriter(unittest.TestCase):
+    """ Test the background output writer for:
+
+    - Flushing pending jobs on close
+    - Bounding the number of pending jobs
+    - Continuing after a failed job
+    """
+
+    def test_close_flushes_pending_images(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            writer = OutputWriter(compress_level=1)
+            paths = [os.path.join(tmp_dir, f"{i}.png") for i in range(5)]
+            for i, path in enumerate(paths):
+                writer.write_image(path, np.full((8, 8, 3), i, dtype=np.uint8))
+            writer.close()
+
+            for i, path in enumerate(paths):
+                self.assertEqual(np.asarray(Image.open(path))[0, 0, 0], i)
+            self.assertEqual([path for path, _ in writer.latencies], paths)
+
+    def test_queue_is_bounded(self):
+        unblock = Event()
+        writer = OutputWriter(max_pending=2)
+
+        writer.submit(unblock.wait, "blocking job")
+        # Wait until the worker picked up the blocking job
+        while not writer.queue.empty():
+            pass
+        for i in range(2):
+            writer.submit(lambda: None, f"job {i}")
+
+        self.assertTrue(writer.queue.full())
+        unblock.set()
+        writer.close()
+
+    def test_failed_job_does_not_stop_writer(self):
+        def failing_job():
+            raise IOError("disk full")
+
+        written = []
+        writer = OutputWriter()
+        with self.assertLogs("python_coreml_stable_diffusion.output_writer", level="ERROR"):
+            writer.submit(failing_job, "failing job")
+            writer.submit(lambda: written.append(True), "job")
+            writer.close()
+
+        self.assertEqual(written, [True])
+
+
+if __name__ == "__main__":
+    unittest.main()
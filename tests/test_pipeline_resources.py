@@ -0,0 +1,72 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+from argparse import Namespace
+from diffusers import DPMSolverMultistepScheduler
+import os
+import tempfile
+from transformers import CLIPFeatureExtractor, CLIPTokenizer
+import unittest
+
+from python_coreml_stable_diffusion.pipeline import load_pipeline_resources
+from python_coreml_stable_diffusion.pipeline_resources import PipelineResources, get_resources_path
+
+TOKENIZER_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "swift", "StableDiffusionTests",
+                             "Resources")
+MODEL_VERSION = "stabilityai/stable-diffusion-2-base"
+
+
+class TestPipelineResources(unittest.TestCase):
+    """ Test the offline pipeline resources for:
+
+    - Tokenizer, scheduler and feature extractor round trips through a resources directory
+    - Loading them from next to the mlpackages without the PyTorch pipeline
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _resources(self, requires_safety_checker):
+        return PipelineResources(
+            tokenizer=CLIPTokenizer(os.path.join(TOKENIZER_DIR, "vocab.json"),
+                                    os.path.join(TOKENIZER_DIR, "merges.txt"),
+                                    model_max_length=77,
+                                    pad_token="<|endoftext|>"),
+            scheduler=DPMSolverMultistepScheduler(beta_start=0.00085,
+                                                  beta_end=0.012,
+                                                  beta_schedule="scaled_linear"),
+            feature_extractor=CLIPFeatureExtractor(crop_size=224),
+            requires_safety_checker=requires_safety_checker,
+        )
+
+    def test_round_trip(self):
+        for requires_safety_checker in (True, False):
+            resources = self._resources(requires_safety_checker)
+            resources_dir = os.path.join(self.tmp_dir.name, str(requires_safety_checker))
+            resources.save(resources_dir)
+            loaded = PipelineResources.load(resources_dir)
+
+            self.assertEqual(loaded.requires_safety_checker, requires_safety_checker)
+            self.assertIsInstance(loaded.scheduler, DPMSolverMultistepScheduler)
+            self.assertEqual(dict(loaded.scheduler.config), dict(resources.scheduler.config))
+            self.assertEqual(loaded.tokenizer("a photo of a cat", padding="max_length").input_ids,
+                             resources.tokenizer("a photo of a cat", padding="max_length").input_ids)
+            self.assertEqual(loaded.tokenizer.model_max_length, 77)
+            self.assertEqual(loaded.feature_extractor.crop_size, resources.feature_extractor.crop_size)
+
+    def test_load_next_to_mlpackages(self):
+        self._resources(False).save(get_resources_path(self.tmp_dir.name, MODEL_VERSION))
+
+        args = Namespace(i=self.tmp_dir.name, model_version=MODEL_VERSION)
+        resources = load_pipeline_resources(args)
+        self.assertFalse(resources.requires_safety_checker)
+        self.assertIsInstance(resources.scheduler, DPMSolverMultistepScheduler)
+
+
+if __name__ == "__main__":
+    unittest.main()
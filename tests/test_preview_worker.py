@@ -0,0 +1,108 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import numpy as np
+from threading import Event
+import unittest
+
+from python_coreml_stable_diffusion.preview_cadence import AdaptivePreviewCadence
+from python_coreml_stable_diffusion.preview_worker import PreviewWorker
+
+
+class TestPreviewWorker(unittest.TestCase):
+    """ Test the asynchronous step callback hand-off for:
+
+    - Dropping intermediate frames while the callback is busy
+    - Always delivering the last submitted frame
+    - Cancellation through the callback return value
+    """
+
+    def test_drops_intermediate_frames_and_delivers_last(self):
+        unblock = Event()
+        delivered = []
+
+        def callback(i, t, latents):
+            unblock.wait()
+            delivered.append((i, latents[0]))
+
+        worker = PreviewWorker(callback)
+        for i in range(10):
+            worker.submit(i, 0, np.full((1, ), i))
+        unblock.set()
+        worker.close()
+
+        self.assertEqual(delivered[-1], (9, 9))
+        self.assertLess(len(delivered), 10)
+        self.assertEqual(worker.delivered_frames + worker.dropped_frames, 10)
+
+    def test_submitted_latents_are_copied(self):
+        delivered = []
+        worker = PreviewWorker(lambda i, t, latents: delivered.append(latents))
+
+        latents = np.zeros((2, ))
+        worker.submit(0, 0, latents)
+        latents[:] = 1
+        worker.close()
+
+        np.testing.assert_array_equal(delivered[0], np.zeros((2, )))
+
+    def test_cancel_from_callback(self):
+        delivered = []
+
+        def callback(i, t, latents):
+            delivered.append(i)
+            return False
+
+        worker = PreviewWorker(callback)
+        worker.submit(0, 0, np.zeros((1, )))
+        worker.close()
+
+        self.assertTrue(worker.cancelled)
+
+        worker.submit(1, 0, np.zeros((1, )))
+        self.assertEqual(delivered, [0])
+
+
+class TestAdaptivePreviewCadence(unittest.TestCase):
+    """ Test the adaptive preview schedule for:
+
+    - Keeping previews within the time budget
+    - Always previewing the final step
+    """
+
+    def _simulate(self, budget, step_time, preview_time, num_steps):
+        cadence = AdaptivePreviewCadence(budget)
+        previewed = []
+        for i in range(num_steps):
+            cadence.record_step(step_time)
+            if cadence.should_preview(i, num_steps):
+                cadence.record_preview(preview_time)
+                previewed.append(i)
+        return previewed
+
+    def test_previews_stay_within_budget(self):
+        num_steps = 50
+        previewed = self._simulate(budget=0.2, step_time=1.0, preview_time=0.5, num_steps=num_steps)
+
+        # The first (measuring) and the final preview may exceed the budget
+        preview_total = 0.5 * (len(previewed) - 2)
+        self.assertLessEqual(preview_total / (num_steps * 1.0 + preview_total), 0.2)
+        self.assertGreater(len(previewed), 2)
+
+    def test_final_step_is_always_previewed(self):
+        previewed = self._simulate(budget=0.01, step_time=0.1, preview_time=10.0, num_steps=20)
+        self.assertEqual(previewed, [0, 19])
+
+    def test_cheap_previews_run_every_step(self):
+        previewed = self._simulate(budget=0.1, step_time=1.0, preview_time=1e-3, num_steps=20)
+        self.assertEqual(previewed, list(range(20)))
+
+    def test_invalid_budget(self):
+        with self.assertRaises(ValueError):
+            AdaptivePreviewCadence(budget=1.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import json
+from threading import Event, Thread
+import unittest
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from python_coreml_stable_diffusion.pipeline import ModelMock
+from python_coreml_stable_diffusion.server import GenerationService, make_server
+from tests.test_continuous_batching import _make_pipe
+
+
+class _BlockingModelMock(ModelMock):
+    """ `ModelMock` that waits for `release` before its first step
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.started = Event()
+        self.release = Event()
+
+    def __call__(self, prompt, callback=None, **kwargs):
+        self.started.set()
+        self.release.wait(timeout=10)
+        return super().__call__(prompt, callback=callback, **kwargs)
+
+
+class TestServer(unittest.TestCase):
+    """ Test the HTTP generation service (mostly with `ModelMock`) for:
+
+    - Submitting jobs and streaming their progress as server-sent events
+    - Admission by queue depth
+    - Cancelling queued jobs
+    - Queue wait and latency metrics
+    - Continuous batching of concurrent jobs
+    """
+
+    def _start(self, coreml_pipe, max_queue=8, continuous_batching=False):
+        self.service = GenerationService(coreml_pipe,
+                                         max_queue=max_queue,
+                                         continuous_batching=continuous_batching)
+        self.server = make_server(self.service, port=0)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.close()
+
+    def _request(self, method, path, body=None):
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        with urlopen(Request(self.url + path, data=data, method=method), timeout=10) as response:
+            return json.loads(response.read())
+
+    def _events(self, job_id):
+        with urlopen(f"{self.url}/jobs/{job_id}/events", timeout=10) as response:
+            return [
+                json.loads(line[len("data: "):])
+                for line in response.read().decode("utf-8").splitlines()
+                if line.startswith("data: ")
+            ]
+
+    def test_submit_and_stream_progress(self):
+        self._start(ModelMock())
+
+        job = self._request("POST", "/jobs", {"prompt": "a cat", "num_inference_steps": 3})
+        self.assertEqual(job["status"], "queued")
+
+        events = self._events(job["id"])
+        self.assertEqual([event["event"] for event in events],
+                         ["queued", "running", "progress", "progress", "progress", "done"])
+        self.assertEqual(events[-2]["step"], 3)
+
+        job = self._request("GET", f"/jobs/{job['id']}")
+        self.assertEqual(job["status"], "done")
+        self.assertFalse(job["has_image"])
+
+        metrics = self._request("GET", "/metrics")
+        self.assertEqual(metrics["jobs"]["done"], 1)
+        self.assertIn("p50", metrics["queue_wait"])
+        self.assertIn("p50", metrics["latency"])
+
+    def test_queue_full_and_cancel(self):
+        coreml_pipe = _BlockingModelMock()
+        self._start(coreml_pipe, max_queue=1)
+
+        running = self._request("POST", "/jobs", {"prompt": "a", "num_inference_steps": 1})
+        self.assertTrue(coreml_pipe.started.wait(timeout=10))
+        queued = self._request("POST", "/jobs", {"prompt": "b", "num_inference_steps": 1})
+
+        with self.assertRaises(HTTPError) as context:
+            self._request("POST", "/jobs", {"prompt": "c"})
+        self.assertEqual(context.exception.code, 429)
+
+        self._request("DELETE", f"/jobs/{queued['id']}")
+        coreml_pipe.release.set()
+
+        self.assertEqual(self._events(running["id"])[-1]["event"], "done")
+        self.assertEqual(self._events(queued["id"])[-1]["event"], "cancelled")
+
+    def test_continuous_batching(self):
+        self._start(_make_pipe(unet_batch_size=4), continuous_batching=True)
+
+        jobs = [
+            self._request("POST", "/jobs", {"prompt": prompt, "seed": 1, "num_inference_steps": 4})
+            for prompt in ("a cat", "a dog")
+        ]
+        for job in jobs:
+            self.assertEqual(self._events(job["id"])[-1]["event"], "done")
+            with urlopen(f"{self.url}/jobs/{job['id']}/result", timeout=10) as response:
+                self.assertEqual(response.headers["Content-Type"], "image/png")
+
+        self.assertEqual(self._request("GET", "/metrics")["batching"]["max_active"], 2)
+
+    def test_bad_requests(self):
+        self._start(ModelMock())
+
+        for method, path, body, code in [
+            ("POST", "/jobs", {"negative_prompt": "a"}, 400),
+            ("POST", "/jobs", {"prompt": "a", "strength": 1}, 400),
+            ("GET", "/jobs/unknown", None, 404),
+            ("GET", "/unknown", None, 404),
+        ]:
+            with self.subTest(method=method, path=path, body=body):
+                with self.assertRaises(HTTPError) as context:
+                    self._request(method, path, body)
+                self.assertEqual(context.exception.code, code)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+import numpy as np
+import unittest
+
+from python_coreml_stable_diffusion.staged_pipeline import STAGES, StagedJob, StagedPipeline
+from tests.test_continuous_batching import REQUESTS, _make_pipe
+
+
+class TestStagedPipeline(unittest.TestCase):
+    """ Test the pipelined encode, denoise, decode and save stages for:
+
+    - Images identical to calling the pipeline for every job in turn
+    - Per-stage utilization
+    - Errors failing their job only
+    """
+
+    def test_matches_sequential(self):
+        pipe = _make_pipe(unet_batch_size=2)
+        expected = [
+            np.asarray(pipe(seed=[request.pop("seed")], **request).images[0])
+            for request in [dict(request) for request in REQUESTS]
+        ]
+
+        pipe = _make_pipe(unet_batch_size=2)
+        staged_pipe = StagedPipeline(pipe, save_fn=lambda job: np.asarray(job.images[0]))
+        jobs = []
+        for request in [dict(request) for request in REQUESTS]:
+            seed = request.pop("seed")
+            jobs.append(staged_pipe.submit(StagedJob(seed=[seed], **request)))
+        staged_pipe.close()
+
+        for job, image in zip(jobs, expected):
+            np.testing.assert_array_equal(job.wait(timeout=10), image)
+            self.assertEqual(set(job.stage_timings), set(STAGES))
+
+        utilization = staged_pipe.utilization()
+        self.assertEqual(set(utilization), set(STAGES))
+        for stats in utilization.values():
+            self.assertEqual(stats["num_jobs"], len(REQUESTS))
+            self.assertGreaterEqual(stats["utilization"], 0.)
+            self.assertLessEqual(stats["utilization"], 1.)
+
+    def test_error(self):
+        pipe = _make_pipe(unet_batch_size=2)
+        staged_pipe = StagedPipeline(pipe)
+
+        # Negative callback steps fail `check_inputs` in the encode stage
+        failed = staged_pipe.submit(StagedJob(callback_steps=-1, **REQUESTS[1]))
+        completed = staged_pipe.submit(StagedJob(**REQUESTS[1]))
+        staged_pipe.close()
+
+        with self.assertRaises(ValueError):
+            failed.wait(timeout=10)
+        self.assertNotIn("denoise", failed.stage_timings)
+        completed.wait(timeout=10)
+        self.assertEqual(len(completed.images), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
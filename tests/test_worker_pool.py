@@ -0,0 +1,94 @@
+#
+# For licensing see accompanying LICENSE.md file.
+# Copyright (C) 2022 Apple Inc. All Rights Reserved.
+#
+
+from argparse import Namespace
+from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
+import os
+from PIL import Image
+import tempfile
+import unittest
+
+from python_coreml_stable_diffusion.worker_pool import WorkerPool, fit_workers_to_memory
+
+
+class _Pipe:
+    """ Stands in for `CoreMLStableDiffusionPipeline` in worker processes. Crashes its
+    process the first time it generates the prompt "crash"
+    """
+
+    batch_size = 2
+    height = width = 8
+
+    def __init__(self, crash_marker):
+        self.scheduler = None
+        self.stage_timings = {}
+        self.crash_marker = crash_marker
+
+    def __call__(self, prompt, num_images_per_prompt, seed, **kwargs):
+        if prompt == "crash" and not os.path.exists(self.crash_marker):
+            open(self.crash_marker, "w").close()
+            os._exit(1)
+
+        self.stage_timings = {"denoise": 0.01}
+        images = [Image.new("RGB", (self.width, self.height)) for _ in range(num_images_per_prompt)]
+        return StableDiffusionPipelineOutput(images=images, nsfw_content_detected=None)
+
+
+def _load_pipe(args):
+    return _Pipe(os.path.join(args.o, "crashed"))
+
+
+def _jobs(prompts):
+    return [
+        dict(id=str(i), prompt=prompt, negative_prompt=None, seed=i, num_inference_steps=1,
+             guidance_scale=7.5, scheduler=None)
+        for i, prompt in enumerate(prompts)
+    ]
+
+
+class TestWorkerPool(unittest.TestCase):
+    """ Test the multi-process worker pool for:
+
+    - Results in job order from several workers
+    - Reassigning the jobs of crashed workers
+    - Limiting workers to the memory budget
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.args = Namespace(o=self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _pool(self, num_workers):
+        return WorkerPool(self.args, num_workers, load_fn=_load_pipe, num_threads=1, worker_memory=0)
+
+    def test_results_in_order(self):
+        jobs = _jobs(["a", "b", "a", "c", "b", "a"])
+        entries = self._pool(num_workers=2).run(jobs)
+
+        self.assertEqual([entry["id"] for entry in entries], [job["id"] for job in jobs])
+        for entry in entries:
+            self.assertTrue(os.path.exists(entry["path"]))
+
+    def test_worker_crash(self):
+        jobs = _jobs(["a", "crash", "b"])
+        results = []
+        entries = self._pool(num_workers=2).run(jobs, on_result=results.append)
+
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir.name, "crashed")))
+        self.assertEqual([entry["id"] for entry in entries], ["0", "1", "2"])
+        self.assertEqual(len(results), 3)
+
+    def test_memory_budget(self):
+        self.assertEqual(fit_workers_to_memory(8, worker_memory=4, memory_budget=10), 2)
+        self.assertEqual(fit_workers_to_memory(8, worker_memory=20, memory_budget=10), 1)
+        self.assertEqual(fit_workers_to_memory(2, worker_memory=4, memory_budget=10), 2)
+        self.assertEqual(fit_workers_to_memory(8, worker_memory=None, memory_budget=10), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()